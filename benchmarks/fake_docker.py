@@ -0,0 +1,71 @@
+"""
+A stub of the docker executable for benchmarks.
+Commands producing output (build, push) write a configurable amount of
+output over a configurable duration. All other commands succeed silently,
+except for the inspect commands, which fail like they would for unknown images.
+Usage: fake_docker.py [--lines N] [--line-size B] [--duration S] -- docker ARGS...
+"""
+import argparse
+import sys
+import time
+
+
+def emit_output(lines, line_size, duration, out=sys.stdout):
+    """
+    Write lines of output, evenly spread over duration.
+    :param lines: number of lines to write
+    :type lines: int
+    :param line_size: size of each line in bytes, including the newline
+    :type line_size: int
+    :param duration: seconds to spread the output over
+    :type duration: float
+    :param out: file to write to
+    :type out: file-like object
+    """
+    line = "#" * max(line_size - 1, 0) + "\n"
+    if lines == 0:
+        time.sleep(duration)
+        return
+    interval = float(duration) / lines
+    start = time.time()
+    for i in range(lines):
+        out.write(line)
+        if interval > 0:
+            out.flush()
+            delay = start + (i + 1) * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    out.flush()
+
+
+def main():
+    """the main function."""
+    if "--" in sys.argv:
+        i = sys.argv.index("--")
+        own, args = sys.argv[1:i], sys.argv[i + 1:]
+    else:
+        own, args = [], sys.argv[1:]
+    parser = argparse.ArgumentParser(description="fake docker executable")
+    parser.add_argument("--lines", type=int, default=100, help="lines of output per build")
+    parser.add_argument("--line-size", type=int, default=80, dest="line_size", help="bytes per line of output")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds per build")
+    ns = parser.parse_args(own)
+
+    if len(args) > 0 and args[0] == "docker":
+        # argv[0] as passed by fbad
+        args = args[1:]
+    if len(args) == 0:
+        sys.exit(0)
+    if args[0] == "build" or args[:2] == ["buildx", "build"]:
+        emit_output(ns.lines, ns.line_size, ns.duration)
+    elif args[0] == "push":
+        emit_output(min(ns.lines, 10), ns.line_size, 0)
+    elif args[0] == "info":
+        print("Swarm: inactive")
+    elif args[:2] in (["image", "inspect"], ["manifest", "inspect"]):
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Load generator opening many concurrent client sessions against a single buildserver using a fake docker executable.
+Reports latency percentiles of the handshake, the upload, the first line of output and the completion of the builds,
+as well as the CPU usage and memory of the buildserver:
+
+    python benchmarks/loadgen.py --clients 200 --archive-size 1048576 --lines 500
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from twisted.internet import defer, task  # noqa: E402
+
+from benchmarks.run import install_fake_docker, ServerPool, PASSWORD  # noqa: E402
+
+
+def create_archive(path, size):
+    """
+    Create a project archive containing a single image with a file of random content.
+    :param path: path of the archive to create
+    :type path: str
+    :param size: size of the file in bytes
+    :type size: int
+    """
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        zf.writestr("app/Dockerfile", "FROM scratch\nCOPY blob /blob\n")
+        zf.writestr("app/blob", os.urandom(size))
+
+
+def percentile(values, p):
+    """
+    Return a percentile of values, using the nearest rank.
+    :param values: the values
+    :type values: list of float
+    :param p: the percentile (0-100)
+    :type p: float
+    :return: the percentile or None if there are no values
+    :rtype: float or None
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class ProcessSampler(object):
+    """
+    Periodically samples the CPU time and the memory of a process from /proc.
+    :param pid: pid of the process
+    :type pid: int
+    :param interval: seconds between samples
+    :type interval: float
+    """
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.samples = []  # list of (time, cpu seconds, rss bytes)
+        self.loop = task.LoopingCall(self.sample)
+
+    def start(self):
+        """start sampling."""
+        self.loop.start(self.interval, now=True)
+
+    def stop(self):
+        """stop sampling."""
+        if self.loop.running:
+            self.loop.stop()
+        self.sample()
+
+    def sample(self):
+        """take a sample."""
+        try:
+            with open("/proc/{}/stat".format(self.pid), "r") as fin:
+                fields = fin.read().rsplit(")", 1)[1].split()
+            with open("/proc/{}/status".format(self.pid), "r") as fin:
+                rss = 0
+                for line in fin:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) * 1024
+        except (IOError, OSError, IndexError):
+            # process exited or /proc is not available
+            return
+        # utime and stime are the 14th and 15th field, the first two were split off
+        cpu = (int(fields[11]) + int(fields[12])) / float(self.ticks)
+        self.samples.append((time.time(), cpu, rss))
+
+    def get_results(self):
+        """
+        Return the average and peak CPU usage and the peak RSS.
+        :return: dict of metric name -> value
+        :rtype: dict
+        """
+        if len(self.samples) < 2:
+            return {}
+        peak_cpu = 0.0
+        for (t0, c0, r0), (t1, c1, r1) in zip(self.samples, self.samples[1:]):
+            if t1 > t0:
+                peak_cpu = max(peak_cpu, (c1 - c0) / (t1 - t0))
+        first, last = self.samples[0], self.samples[-1]
+        return {
+            "server_cpu_avg": (last[1] - first[1]) / max(last[0] - first[0], 1e-9),
+            "server_cpu_peak": peak_cpu,
+            "server_rss_peak": max([s[2] for s in self.samples]),
+            }
+
+
+class FirstLineRecorder(object):
+    """
+    A file-like object recording when output was first written to it.
+    """
+    def __init__(self):
+        self.first = None
+        self.count = 0
+
+    def write(self, data):
+        if self.first is None:
+            self.first = time.time()
+        self.count += len(data)
+
+
+@defer.inlineCallbacks
+def run_session(reactor, host, port, project, zippath, delay):
+    """
+    Run a single client session: connect, upload and wait for the build.
+    :return: a deferred which fires with a dict of latencies in seconds
+    :rtype: Deferred
+    """
+    from fbad import client
+    yield task.deferLater(reactor, delay, lambda: None)
+    out = FirstLineRecorder()
+    start = time.time()
+    proto = yield client.connect(reactor, host, port, password=PASSWORD, out=out)
+    connected = time.time()
+    try:
+        exitcodes = yield proto.remote_build(project, zippath)
+    finally:
+        proto.disconnect()
+    end = time.time()
+    if any(exitcodes) or len(exitcodes) == 0:
+        raise Exception("Build failed: " + repr(exitcodes))
+    defer.returnValue({
+        "handshake": connected - start,
+        "upload": proto.stats.project.get("upload", 0.0),
+        "first_output": (out.first - connected) if out.first is not None else None,
+        "completion": end - start,
+        })
+
+
+@defer.inlineCallbacks
+def run(reactor, ns):
+    """
+    Run the load test.
+    :return: a deferred which fires with the results
+    :rtype: Deferred
+    """
+    from fbad import Project, Image
+    workdir = tempfile.mkdtemp(prefix="fbad-loadgen-")
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    install_fake_docker(bindir, ns.lines, ns.line_size, ns.duration)
+    zippath = os.path.join(workdir, "project.zip")
+    create_archive(zippath, ns.archive_size)
+    project = Project(name="loadgen", images=[Image(path="app", tag="fbad-loadgen/app")])
+    pool = ServerPool(1, bindir)
+    pool.start()
+    sampler = ProcessSampler(pool.processes[0].pid)
+    sampler.start()
+    start = time.time()
+    try:
+        ds = []
+        for i in range(ns.clients):
+            delay = ns.ramp * i / max(ns.clients, 1)
+            ds.append(run_session(reactor, pool.hosts[0], pool.port, project, zippath, delay))
+        results = yield defer.DeferredList(ds, consumeErrors=True)
+    finally:
+        duration = time.time() - start
+        sampler.stop()
+        pool.stop()
+        shutil.rmtree(workdir)
+
+    latencies = {}
+    errors = []
+    for success, result in results:
+        if not success:
+            errors.append(result.getErrorMessage())
+            continue
+        for k, v in result.items():
+            if v is not None:
+                latencies.setdefault(k, []).append(v)
+    metrics = {
+        "clients": ns.clients,
+        "errors": len(errors),
+        "duration": duration,
+        "builds_per_second": (ns.clients - len(errors)) / duration,
+        }
+    for name in ("handshake", "upload", "first_output", "completion"):
+        values = latencies.get(name, [])
+        for p in (50, 90, 99, 100):
+            metrics["{}_p{}".format(name, p)] = percentile(values, p)
+    metrics.update(sampler.get_results())
+    defer.returnValue({
+        "params": {
+            "clients": ns.clients,
+            "ramp": ns.ramp,
+            "archive_size": ns.archive_size,
+            "lines": ns.lines,
+            "line_size": ns.line_size,
+            "duration": ns.duration,
+            },
+        "metrics": metrics,
+        "error_messages": sorted(set(errors)),
+        })
+
+
+@defer.inlineCallbacks
+def _main(reactor, ns):
+    """
+    Run the load test, then print and write the results.
+    :return: a deferred which fires when done
+    :rtype: Deferred
+    """
+    results = yield run(reactor, ns)
+    for name in sorted(results["metrics"].keys()):
+        value = results["metrics"][name]
+        print "{:<24} {}".format(name, "-" if value is None else "{:.4g}".format(value))
+    for msg in results["error_messages"]:
+        print "Error: " + msg
+    if ns.output is not None:
+        with open(ns.output, "w") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+
+
+def main():
+    """the main function."""
+    parser = argparse.ArgumentParser(description="Load test a fbad buildserver")
+    parser.add_argument("--clients", type=int, default=100, help="number of concurrent client sessions")
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds over which the sessions are started")
+    parser.add_argument("--archive-size", type=int, default=256 * 1024, dest="archive_size", help="bytes of (incompressible) project data per session")
+    parser.add_argument("--lines", type=int, default=200, help="lines of output per docker build")
+    parser.add_argument("--line-size", type=int, default=100, dest="line_size", help="bytes per line of output")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per docker build")
+    parser.add_argument("-o", "--output", action="store", default=None, help="write results as JSON to this file")
+    ns = parser.parse_args()
+    task.react(_main, (ns, ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""
+Benchmarks of fbad using synthetic projects, a fake docker executable and buildservers on loopback.
+Results are written as JSON and can be compared with the results of a previous run:
+
+    python benchmarks/run.py -o baseline.json
+    python benchmarks/run.py --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from twisted.internet import defer, task  # noqa: E402
+
+SERVER_SCRIPT = "import sys; sys.path.insert(0, {!r}); from fbad.runner import server_main; server_main()".format(ROOT)
+IMPORT_SCRIPT = "import sys; sys.path.insert(0, {!r}); import fbad".format(ROOT)
+CLI_SCRIPT = "import sys; sys.path.insert(0, {!r}); from fbad import Project; Project('benchmark').main()".format(ROOT)
+PASSWORD = "benchmark"
+STARTUP_BUDGET = 0.25  # seconds
+
+
+def install_fake_docker(bindir, lines, line_size, duration):
+    """
+    Create a 'docker' executable running fake_docker.py with the specified options.
+    :param bindir: directory to create the executable in
+    :type bindir: str
+    :param lines: lines of output per build
+    :type lines: int
+    :param line_size: bytes per line of output
+    :type line_size: int
+    :param duration: seconds per build
+    :type duration: float
+    """
+    path = os.path.join(bindir, "docker")
+    with open(path, "w") as fout:
+        fout.write("#!/bin/sh\n")
+        fout.write('exec {} {} --lines {} --line-size {} --duration {} -- "$@"\n'.format(
+            sys.executable,
+            os.path.join(HERE, "fake_docker.py"),
+            lines,
+            line_size,
+            duration,
+            ))
+    os.chmod(path, 0o755)
+
+
+def find_free_port():
+    """
+    Return a port which is currently not in use.
+    :return: the port
+    :rtype: int
+    """
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class ServerPool(object):
+    """
+    Buildservers running as subprocesses on different loopback addresses, but the same port.
+    :param n: number of buildservers
+    :type n: int
+    :param bindir: directory containing the fake docker executable
+    :type bindir: str
+    """
+    def __init__(self, n, bindir):
+        self.hosts = ["127.0.0.{}".format(i + 1) for i in range(n)]
+        self.port = find_free_port()
+        self.bindir = bindir
+        self.processes = []
+
+    def start(self):
+        """
+        Start the buildservers and wait until they accept connections.
+        """
+        env = dict(os.environ)
+        env["PATH"] = self.bindir + os.pathsep + env.get("PATH", "")
+        for host in self.hosts:
+            p = subprocess.Popen(
+                [sys.executable, "-c", SERVER_SCRIPT, "-i", host, "-p", str(self.port), "-P", PASSWORD],
+                env=env,
+                )
+            self.processes.append(p)
+        for host in self.hosts:
+            self._wait_for(host)
+
+    def _wait_for(self, host, timeout=30):
+        """
+        Wait until a buildserver accepts connections.
+        :param host: host of the buildserver
+        :type host: str
+        :param timeout: seconds to wait at most
+        :type timeout: float
+        """
+        end = time.time() + timeout
+        while True:
+            try:
+                socket.create_connection((host, self.port), timeout=1).close()
+                return
+            except socket.error:
+                if time.time() > end:
+                    raise
+                time.sleep(0.1)
+
+    def stop(self):
+        """
+        Stop all buildservers.
+        """
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.wait()
+        self.processes = []
+
+
+class CountingWriter(object):
+    """
+    A file-like object counting the bytes written to it.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+
+    def flush(self):
+        pass
+
+
+def median(values):
+    """
+    Return the median of a list of values.
+    :param values: the values
+    :type values: list of float
+    :return: the median
+    :rtype: float
+    """
+    values = sorted(values)
+    n = len(values)
+    if n % 2 == 1:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def get_tree_size(path):
+    """
+    Return the total size of the files in a directory.
+    :param path: the directory
+    :type path: str
+    :return: the size in bytes
+    :rtype: int
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+    return total
+
+
+def bench_archive(project, workdir, repeat):
+    """
+    Measure the creation of the project archive.
+    :return: dict of metric name -> value
+    :rtype: dict
+    """
+    times = []
+    zp = os.path.join(workdir, "bench.zip")
+    for i in range(repeat):
+        start = time.time()
+        project.create_zip(zp)
+        times.append(time.time() - start)
+    size = get_tree_size(project.project_path)
+    seconds = median(times)
+    return {
+        "archive_seconds": seconds,
+        "archive_throughput": size / seconds,
+        "archive_ratio": float(os.path.getsize(zp)) / size,
+        }
+
+
+def bench_startup(repeat):
+    """
+    Measure the time until fbad is imported and until the command line of a project is parsed.
+    :return: dict of metric name -> value
+    :rtype: dict
+    """
+    results = {}
+    for name, args in (("import_seconds", ["-c", IMPORT_SCRIPT]), ("cli_startup_seconds", ["-c", CLI_SCRIPT, "--help"])):
+        times = []
+        for i in range(repeat):
+            with open(os.devnull, "w") as devnull:
+                start = time.time()
+                subprocess.check_call([sys.executable] + args, stdout=devnull)
+                times.append(time.time() - start)
+        results[name] = median(times)
+    return results
+
+
+@defer.inlineCallbacks
+def bench_single(reactor, project, pool, repeat):
+    """
+    Measure a build of all images on a single buildserver.
+    The first build is a warm-up and not included in the results.
+    :return: a deferred which fires with a dict of metric name -> value
+    :rtype: Deferred
+    """
+    from fbad import project as fbad_project
+    from fbad.timing import BuildReport
+    results = {}
+    for i in range(repeat + 1):
+        out = CountingWriter()
+        report = BuildReport()
+        start = time.time()
+        exitcodes = yield fbad_project._run_single_build(
+            reactor, pool.hosts[0], pool.port, project, None, out, password=PASSWORD, noexit=True, report=report,
+            )
+        wall = time.time() - start
+        if any(exitcodes):
+            raise Exception("Build failed: " + repr(exitcodes))
+        stats = report.servers.values()[0]
+        build = sum([phases.get("build", 0.0) for phases in stats.images.values()])
+        sample = {
+            "single_build_seconds": wall,
+            "upload_seconds": stats.project.get("upload", 0.0),
+            "upload_throughput": stats.bytes_received / max(stats.project.get("receive", 0.0), 1e-9),
+            "extract_seconds": stats.project.get("extract", 0.0),
+            "relay_throughput": out.count / max(build, 1e-9),
+            "relayed_bytes": out.count,
+            "peak_buffered_bytes": stats.peak_buffered,
+            }
+        if i == 0:
+            continue
+        for k, v in sample.items():
+            results.setdefault(k, []).append(v)
+    defer.returnValue(dict([(k, median(v)) for k, v in results.items()]))
+
+
+@defer.inlineCallbacks
+def bench_distributed(reactor, project, pool, buildmode, repeat):
+    """
+    Measure the end-to-end time of a build using all buildservers.
+    :return: a deferred which fires with a dict of metric name -> value
+    :rtype: Deferred
+    """
+    from fbad import project as fbad_project
+    if buildmode == "parallel":
+        f = fbad_project._run_parallel_build
+    else:
+        f = fbad_project._run_multi_build
+    times = []
+    for i in range(repeat):
+        stdout = sys.stdout
+        sys.stdout = CountingWriter()  # the summary table
+        start = time.time()
+        try:
+            yield f(reactor, list(pool.hosts), pool.port, project, None, CountingWriter(), password=PASSWORD)
+        except SystemExit as e:
+            if e.code:
+                raise Exception("Build failed with exitcode {}".format(e.code))
+        finally:
+            sys.stdout = stdout
+        times.append(time.time() - start)
+    defer.returnValue({"{}_build_seconds".format(buildmode): median(times)})
+
+
+# metric name -> (unit, whether higher values are better)
+METRICS = {
+    "import_seconds": ("s", False),
+    "cli_startup_seconds": ("s", False),
+    "archive_seconds": ("s", False),
+    "archive_throughput": ("B/s", True),
+    "archive_ratio": ("", False),
+    "single_build_seconds": ("s", False),
+    "upload_seconds": ("s", False),
+    "upload_throughput": ("B/s", True),
+    "extract_seconds": ("s", False),
+    "relay_throughput": ("B/s", True),
+    "relayed_bytes": ("B", True),
+    "peak_buffered_bytes": ("B", False),
+    "parallel_build_seconds": ("s", False),
+    "multi_build_seconds": ("s", False),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print a comparison of results with a baseline.
+    :param results: the results of this run
+    :type results: dict
+    :param baseline: the results of a previous run
+    :type baseline: dict
+    :param threshold: relative change considered a regression
+    :type threshold: float
+    :return: number of regressions
+    :rtype: int
+    """
+    if baseline.get("params") != results["params"]:
+        print "Warning: the parameters differ from the baseline, results may not be comparable."
+    regressions = 0
+    print "{:<24} {:>14} {:>14} {:>8}".format("metric", "baseline", "current", "change")
+    for name in sorted(results["metrics"].keys()):
+        if name not in baseline.get("metrics", {}):
+            continue
+        old = baseline["metrics"][name]["value"]
+        new = results["metrics"][name]["value"]
+        change = (new - old) / old if old else 0.0
+        higher_is_better = METRICS[name][1]
+        worse = (change < -threshold) if higher_is_better else (change > threshold)
+        if worse:
+            regressions += 1
+        print "{:<24} {:>14.4g} {:>14.4g} {:>+7.1%}{}".format(name, old, new, change, " REGRESSION" if worse else "")
+    return regressions
+
+
+@defer.inlineCallbacks
+def run(reactor, ns):
+    """
+    Run all benchmarks.
+    :return: a deferred which fires with the results
+    :rtype: Deferred
+    """
+    workdir = tempfile.mkdtemp(prefix="fbad-benchmark-")
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    install_fake_docker(bindir, ns.lines, ns.line_size, ns.duration)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+    from benchmarks.synthetic import generate_project
+    project = generate_project(os.path.join(workdir, "project"), images=ns.images, files=ns.files, file_size=ns.file_size)
+    pool = ServerPool(ns.servers, bindir)
+    pool.start()
+    try:
+        metrics = bench_startup(ns.repeat)
+        metrics.update(bench_archive(project, workdir, ns.repeat))
+        r = yield bench_single(reactor, project, pool, ns.repeat)
+        metrics.update(r)
+        for buildmode in ("parallel", "multi"):
+            r = yield bench_distributed(reactor, project, pool, buildmode, ns.repeat)
+            metrics.update(r)
+    finally:
+        pool.stop()
+        shutil.rmtree(workdir)
+    results = {
+        "params": {
+            "images": ns.images,
+            "files": ns.files,
+            "file_size": ns.file_size,
+            "servers": ns.servers,
+            "lines": ns.lines,
+            "line_size": ns.line_size,
+            "duration": ns.duration,
+            "repeat": ns.repeat,
+            },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            },
+        "metrics": dict([(k, {"value": v, "unit": METRICS[k][0]}) for k, v in metrics.items()]),
+        }
+    defer.returnValue(results)
+
+
+def main():
+    """the main function."""
+    parser = argparse.ArgumentParser(description="Benchmark fbad")
+    parser.add_argument("--images", type=int, default=4, help="number of images of the synthetic project")
+    parser.add_argument("--files", type=int, default=200, help="number of files per image")
+    parser.add_argument("--file-size", type=int, default=8192, dest="file_size", help="size of each file in bytes")
+    parser.add_argument("--servers", type=int, default=2, help="number of buildservers")
+    parser.add_argument("--lines", type=int, default=2000, help="lines of output per docker build")
+    parser.add_argument("--line-size", type=int, default=100, dest="line_size", help="bytes per line of output")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds per docker build")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of each benchmark (the median is reported)")
+    parser.add_argument("-o", "--output", action="store", default=None, help="write results as JSON to this file")
+    parser.add_argument("--compare", action="store", default=None, help="compare the results with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change considered a regression")
+    parser.add_argument("--startup-budget", type=float, dest="startup_budget", default=STARTUP_BUDGET, help="maximum seconds until the command line of a project is parsed")
+    ns = parser.parse_args()
+    task.react(_main, (ns, ))
+
+
+@defer.inlineCallbacks
+def _main(reactor, ns):
+    """
+    Run the benchmarks, then print, write and compare the results.
+    :return: a deferred which fires when done
+    :rtype: Deferred
+    """
+    results = yield run(reactor, ns)
+    for name in sorted(results["metrics"].keys()):
+        metric = results["metrics"][name]
+        print "{:<24} {:>14.4g} {}".format(name, metric["value"], metric["unit"])
+    if ns.output is not None:
+        with open(ns.output, "w") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    failed = False
+    startup = results["metrics"]["cli_startup_seconds"]["value"]
+    if startup > ns.startup_budget:
+        print "Startup took {:.3f}s, exceeding the budget of {:.3f}s".format(startup, ns.startup_budget)
+        failed = True
+    if ns.compare is not None:
+        with open(ns.compare, "r") as fin:
+            baseline = json.load(fin)
+        print ""
+        if compare(results, baseline, ns.threshold) > 0:
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""generation of synthetic projects for benchmarks."""
+import os
+import random
+
+from fbad import Project, Image
+
+
+def generate_project(path, images=4, files=100, file_size=4096, seed=0):
+    """
+    Generate the files of a synthetic project and return the project.
+    Each image has its own directory with a Dockerfile and files of random content.
+    :param path: directory to create the project files in
+    :type path: str
+    :param images: number of images
+    :type images: int
+    :param files: number of files per image
+    :type files: int
+    :param file_size: size of each file in bytes
+    :type file_size: int
+    :param seed: seed for the random content, so that runs are comparable
+    :type seed: int
+    :return: the project
+    :rtype: Project
+    """
+    rng = random.Random(seed)
+    block = bytes(bytearray(rng.getrandbits(8) for i in range(65536)))
+    imagelist = []
+    for i in range(images):
+        name = "image{}".format(i)
+        ip = os.path.join(path, name)
+        # spread files over subdirectories, like a real source tree
+        for j in range(files):
+            dp = os.path.join(ip, "src", "dir{}".format(j % 10))
+            if not os.path.exists(dp):
+                os.makedirs(dp)
+            with open(os.path.join(dp, "file{}.txt".format(j)), "wb") as fout:
+                # half random (incompressible), half repetitive (compressible) content
+                half = file_size // 2
+                written = 0
+                while written < half:
+                    offset = rng.randrange(len(block))
+                    data = block[offset:offset + half - written]
+                    fout.write(data)
+                    written += len(data)
+                fout.write(b"a" * (file_size - half))
+        with open(os.path.join(ip, "Dockerfile"), "w") as fout:
+            fout.write("FROM scratch\nCOPY src /src\n")
+        imagelist.append(Image(path=name, tag="fbad-benchmark/" + name))
+    project = Project(name="benchmark", images=imagelist)
+    project.project_path = path
+    return project
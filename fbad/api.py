@@ -0,0 +1,225 @@
+"""
+this module implements an API for building, pushing and deploying projects from other programs.
+All functions return deferreds instead of exiting the process, so multiple projects
+can be built concurrently using the same reactor.
+"""
+import os
+
+from twisted.internet import defer
+
+from fbad import constants
+from fbad.timing import BuildReport, BuildStats
+
+
+class BuildResult(object):
+    """
+    The result of a build.
+    :param exitcodes: the exitcodes of the build, push and deploy processes
+    :type exitcodes: list of int
+    :param report: the durations of the build phases per server
+    :type report: BuildReport
+    :param jobs: server and job id of each job of a detached build
+    :type jobs: list of dict
+    """
+    def __init__(self, exitcodes, report, jobs=None):
+        self.exitcodes = exitcodes
+        self.report = report
+        if jobs is None:
+            jobs = []
+        self.jobs = jobs
+
+    @property
+    def success(self):
+        """
+        True if all processes succeeded.
+        A build without any processes (e.g. no matching images) did not succeed,
+        unless it was detached.
+        :rtype: bool
+        """
+        if len(self.exitcodes) == 0:
+            return len(self.jobs) > 0
+        return max(self.exitcodes) == 0
+
+    def __repr__(self):
+        return "<BuildResult exitcodes={!r} jobs={!r}>".format(self.exitcodes, self.jobs)
+
+
+class Progress(object):
+    """
+    A chunk of output of a build, push or deploy.
+    :param project: the project the output belongs to
+    :type project: Project
+    :param message: the output
+    :type message: str
+    """
+    def __init__(self, project, message):
+        self.project = project
+        self.message = message
+
+    def __repr__(self):
+        return "<Progress project={!r} message={!r}>".format(self.project.name, self.message)
+
+
+class ProgressWriter(object):
+    """
+    A file-like object passing everything written to it as Progress to a callback.
+    :param callback: callable to call with each Progress or None to discard the output
+    :type callback: callable or None
+    :param project: the project the output belongs to
+    :type project: Project
+    """
+    def __init__(self, callback, project):
+        self.callback = callback
+        self.project = project
+
+    def write(self, data):
+        """
+        Pass data to the callback.
+        :param data: the output
+        :type data: str
+        """
+        if self.callback is not None and data:
+            self.callback(Progress(self.project, data))
+
+    def flush(self):
+        """
+        Does nothing, provided for compatibility with files.
+        """
+        pass
+
+
+def _get_reactor(reactor):
+    """
+    Return reactor or, if it is None, the global reactor.
+    :param reactor: the reactor or None
+    :type reactor: IReactor or None
+    :return: the reactor
+    :rtype: IReactor
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    return reactor
+
+
+@defer.inlineCallbacks
+def build(project, hosts=None, port=constants.DEFAULT_PORT, password=None, only=None, buildmode="parallel", push=False, deploy=False, detach=False, push_concurrency=constants.PUSH_CONCURRENCY, progress=None, tracer=None, reactor=None, arch=None):
+    """
+    Build a project, either locally or on the specified buildservers.
+    :param project: the project to build
+    :type project: Project
+    :param hosts: hosts of the buildservers or None to build locally
+    :type hosts: list of str or None
+    :param port: port of the buildservers
+    :type port: int
+    :param password: password for the buildservers
+    :type password: str or None
+    :param only: names of the images to build or None to build all images
+    :type only: list of str or None
+    :param buildmode: how to build images if more than one buildserver is specified ("parallel" or "multi")
+    :type buildmode: str
+    :param push: whether to push built images to registry or not
+    :type push: bool
+    :param deploy: whether to deploy project after the build or not.
+    :type deploy: bool
+    :param detach: do not wait for the build, the job ids are available as BuildResult.jobs instead.
+    :type detach: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param progress: callable to call with a Progress for each chunk of output
+    :type progress: callable or None
+    :param tracer: tracer to write the spans of the build to
+    :type tracer: Tracer or None
+    :param reactor: the twisted reactor or None to use the global reactor
+    :type reactor: IReactor or None
+    :param arch: when building using a broker (as the only host), build each image once for each of these architectures
+    :type arch: list of str or None
+    :return: a deferred which will fire with a BuildResult
+    :rtype: Deferred
+    """
+    from fbad import project as projectmodule  # import here to keep the import of this module cheap
+    reactor = _get_reactor(reactor)
+    if only is not None:
+        only = project.expand_names(only)
+    if buildmode not in ("parallel", "multi"):
+        raise ValueError("Unknown buildmode: " + repr(buildmode))
+    if hosts is not None and len(hosts) == 0:
+        hosts = None
+    if arch is not None and (hosts is None or len(hosts) != 1):
+        raise ValueError("arch requires a single broker as host")
+    out = ProgressWriter(progress, project)
+    report = BuildReport()
+    jobs = []
+    kwargs = dict(push=push, deploy=deploy, push_concurrency=push_concurrency, tracer=tracer, noexit=True, report=report)
+    if hosts is None:
+        if detach:
+            raise ValueError("Detached builds require a buildserver")
+        exitcodes = yield projectmodule._run_local_build(reactor, project, only, out, **kwargs)
+    elif len(hosts) == 1:
+        exitcodes = yield projectmodule._run_single_build(reactor, hosts[0], port, project, only, out, password=password, detach=detach, jobs=jobs, arch=arch, **kwargs)
+    elif buildmode == "multi":
+        exitcodes = yield projectmodule._run_multi_build(reactor, hosts, port, project, only, out, password=password, detach=detach, jobs=jobs, **kwargs)
+    else:
+        exitcodes = yield projectmodule._run_parallel_build(reactor, hosts, port, project, only, out, password=password, detach=detach, jobs=jobs, **kwargs)
+    defer.returnValue(BuildResult(exitcodes, report, jobs=jobs))
+
+
+def _get_protocolfactory(project, progress):
+    """
+    Return a protocolfactory relaying the output of processes as Progress.
+    :param project: the project the output belongs to
+    :type project: Project
+    :param progress: callable to call with a Progress for each chunk of output
+    :type progress: callable or None
+    :return: the protocolfactory
+    :rtype: callable
+    """
+    from fbad.project import OutputWriter
+    from fbad.server import OutputRelayProtocol
+    writer = OutputWriter(ProgressWriter(progress, project))
+    return lambda: OutputRelayProtocol(writer)
+
+
+@defer.inlineCallbacks
+def push(project, only=None, concurrency=constants.PUSH_CONCURRENCY, progress=None):
+    """
+    Push the images of a project built locally to the registry.
+    :param project: the project to push
+    :type project: Project
+    :param only: names of the images to push or None to push all images
+    :type only: list of str or None
+    :param concurrency: maximum number of images to push concurrently
+    :type concurrency: int
+    :param progress: callable to call with a Progress for each chunk of output
+    :type progress: callable or None
+    :return: a deferred which will fire with a BuildResult
+    :rtype: Deferred
+    """
+    if only is not None:
+        only = project.expand_names(only)
+    stats = BuildStats()
+    exitcodes = yield project.push(only=only, protocolfactory=_get_protocolfactory(project, progress), concurrency=concurrency, stats=stats)
+    report = BuildReport()
+    report.add("local", stats)
+    defer.returnValue(BuildResult(exitcodes, report))
+
+
+@defer.inlineCallbacks
+def deploy(project, pull=False, hosts=None, progress=None):
+    """
+    Deploy a project from its directory using the docker-compose file of the project.
+    :param project: the project to deploy
+    :type project: Project
+    :param pull: whether to pull the images before deploying or not
+    :type pull: bool
+    :param hosts: docker hosts or swarm managers to deploy to concurrently, defaults to the deploy_hosts of the project
+    :type hosts: list of str or None
+    :param progress: callable to call with a Progress for each chunk of output
+    :type progress: callable or None
+    :return: a deferred which will fire with a BuildResult containing one exitcode per host
+    :rtype: Deferred
+    """
+    if project.compose_file is None:
+        raise ValueError("Project {} has no compose file".format(project.name))
+    path = os.path.join(project.project_path, project.compose_file)
+    exitcodes = yield project.deploy_compose(path, pull=pull, protocolfactory=_get_protocolfactory(project, progress), hosts=hosts)
+    defer.returnValue(BuildResult(exitcodes, BuildReport()))
@@ -0,0 +1,770 @@
+"""
+this module implements a broker distributing the builds of many clients across a pool of buildservers.
+Clients connect to the broker like to a buildserver. Buildservers register with the broker and
+report their load, the broker keeps a global queue of images and dispatches them to the buildservers.
+"""
+import os
+import json
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from fbad import constants
+from fbad.jobs import Job, JobManager
+from fbad.server import FBADServerProtocol, FBADServerFactory, OutputRelayProtocol
+from fbad.cache import get_arch
+from fbad.client import connect
+
+
+class Worker(object):
+    """
+    A buildserver registered with the broker.
+    :param host: host to connect to
+    :type host: str
+    :param port: port to connect to
+    :type port: int
+    :param arch: architecture of the buildserver
+    :type arch: str
+    :param cpus: CPUs the buildserver has for builds
+    :type cpus: float
+    :param memory: bytes of memory the buildserver has for builds or None for no limit
+    :type memory: int or None
+    """
+    def __init__(self, host, port, arch, cpus, memory=None):
+        self.host = host
+        self.port = port
+        self.arch = arch
+        self.cpus = max(float(cpus), 1.0)
+        self.memory = memory
+        self.load = (0.0, 0)  # (cpus, memory) of the builds running or waiting, as reported by the buildserver
+        self.building = 0  # images building or waiting, as reported by the buildserver
+        self.jobs = 0  # running jobs, as reported by the buildserver
+        self.assigned = (0.0, 0)  # (cpus, memory) of the images dispatched to the buildserver by the broker
+        self.built = set()  # (project name, image name) successfully built on the buildserver
+        self.owner = None  # connection the buildserver registered with
+
+    @property
+    def name(self):
+        """the name of this worker."""
+        return "{}:{}".format(self.host, self.port)
+
+    @property
+    def used(self):
+        """the (cpus, memory) in use, the higher of the reported and the dispatched load."""
+        return (max(self.load[0], self.assigned[0]), max(self.load[1], self.assigned[1]))
+
+    @property
+    def utilization(self):
+        """the fraction of the CPUs or memory in use, whichever is higher."""
+        cpus, memory = self.used
+        if self.memory:
+            return max(cpus / self.cpus, float(memory) / self.memory)
+        return cpus / self.cpus
+
+    def fits(self, requirements):
+        """
+        Check whether an image may be dispatched to this worker.
+        Images needing more than this worker has may be dispatched to it when it is idle.
+        :param requirements: the (cpus, memory) the image needs
+        :type requirements: tuple of (float, int)
+        :return: True if the image fits
+        :rtype: bool
+        """
+        cpus, memory = self.used
+        if cpus <= 0 and memory <= 0:
+            return True
+        if cpus + requirements[0] > self.cpus + 1e-9:
+            return False
+        if self.memory is not None and memory + requirements[1] > self.memory:
+            return False
+        return True
+
+    def assign(self, requirements, n=1):
+        """
+        Add the requirements of dispatched images to the assigned load.
+        :param requirements: the (cpus, memory) the images need
+        :type requirements: tuple of (float, int)
+        :param n: 1 to assign, -1 to unassign
+        :type n: int
+        """
+        self.assigned = (
+            max(self.assigned[0] + n * requirements[0], 0.0),
+            max(self.assigned[1] + n * requirements[1], 0),
+            )
+
+    def update_load(self, load):
+        """
+        Update the load reported by the buildserver.
+        :param load: the load, as send using FBADClientProtocol.send_load()
+        :type load: dict
+        """
+        self.load = (load.get("cpus", 0.0), load.get("memory", 0))
+        self.building = load.get("building", 0)
+        self.jobs = load.get("jobs", 0)
+
+    def get_status(self):
+        """
+        Return a dict describing the status of this worker.
+        :return: the status
+        :rtype: dict
+        """
+        return {
+            "name": self.name,
+            "arch": self.arch,
+            "cpus": self.cpus,
+            "memory": self.memory,
+            "used_cpus": self.used[0],
+            "used_memory": self.used[1],
+            "building": self.building,
+            "jobs": self.jobs,
+            }
+
+
+class Task(object):
+    """
+    An image of a job waiting in the queue of the broker.
+    :param submission: the submission the image belongs to
+    :type submission: Submission
+    :param name: name of the image
+    :type name: str
+    :param arch: architecture to build the image on or None for any architecture
+    :type arch: str or None
+    :param requirements: the (cpus, memory) the image needs
+    :type requirements: tuple of (float, int)
+    """
+    def __init__(self, submission, name, arch=None, requirements=(constants.DEFAULT_IMAGE_CPUS, constants.DEFAULT_IMAGE_MEMORY)):
+        self.submission = submission
+        self.name = name
+        self.arch = arch
+        self.requirements = requirements
+        self.attempts = 0
+
+
+class Submission(object):
+    """
+    The images of a job submitted to the scheduler.
+    :param job: the job
+    :type job: BrokerJob
+    :param push: whether the buildservers should push the built images or not
+    :type push: bool
+    :param push_concurrency: maximum number of images to push concurrently per buildserver
+    :type push_concurrency: int
+    """
+    def __init__(self, job, push=False, push_concurrency=constants.PUSH_CONCURRENCY):
+        self.job = job
+        self.push = push
+        self.push_concurrency = push_concurrency
+        self.tasks = []
+        self.remaining = 0
+        self.exitcodes = []
+        self.protocols = set()  # connections to buildservers building images of this submission
+        self.done = False
+        self.d = None
+
+
+class _JobOutput(object):
+    """
+    A file-like object relaying everything written to it to a job.
+    :param job: the job
+    :type job: Job
+    """
+    def __init__(self, job):
+        self.job = job
+
+    def write(self, data):
+        """
+        Relay data to the job.
+        :param data: the data
+        :type data: str
+        """
+        self.job.send_message(data)
+
+
+class Scheduler(object):
+    """
+    Keeps the global queue of the broker and dispatches the images to the registered buildservers.
+    An image is dispatched to a buildserver of the requested architecture which has the
+    CPUs and memory the image needs available, preferring buildservers which built the image
+    before (as they have its layers cached) and then the least utilized buildserver. All images of a job dispatched to the
+    same buildserver at once are built using a single upload.
+    :param password: password for the buildservers
+    :type password: str or None
+    :param reactor: the twisted reactor or None to use the global reactor
+    :type reactor: IReactor or None
+    """
+    def __init__(self, password=None, reactor=None):
+        self.password = password
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.workers = {}
+        self.queue = []
+
+    def add_worker(self, worker, owner=None):
+        """
+        Add a buildserver to the pool.
+        If the buildserver is already known (e.g. because it registered again after
+        the connection was lost), the known Worker is updated and returned instead,
+        keeping its cache locality and assigned load.
+        :param worker: the buildserver
+        :type worker: Worker
+        :param owner: the connection the buildserver registered with
+        :type owner: BrokerProtocol or None
+        :return: the worker in the pool
+        :rtype: Worker
+        """
+        known = self.workers.get(worker.name, None)
+        if known is None:
+            known = self.workers[worker.name] = worker
+        else:
+            known.arch = worker.arch
+            known.cpus = worker.cpus
+            known.memory = worker.memory
+        known.owner = owner
+        log.msg("Buildserver {} ({}, {} CPUs, {} bytes of memory) registered".format(known.name, known.arch, known.cpus, known.memory))
+        self.schedule()
+        return known
+
+    def remove_worker(self, worker, owner=None):
+        """
+        Remove a buildserver from the pool, unless it registered again using another connection.
+        Images already dispatched to it are not affected.
+        :param worker: the buildserver
+        :type worker: Worker
+        :param owner: the connection the buildserver registered with
+        :type owner: BrokerProtocol or None
+        """
+        if self.workers.get(worker.name, None) is worker and worker.owner is owner:
+            del self.workers[worker.name]
+            log.msg("Buildserver {} unregistered".format(worker.name))
+
+    def update_load(self, worker, load):
+        """
+        Update the load of a buildserver and dispatch images if they fit now.
+        :param worker: the buildserver
+        :type worker: Worker
+        :param load: the reported load
+        :type load: dict
+        """
+        worker.update_load(load)
+        self.schedule()
+
+    def get_status(self):
+        """
+        Return a dict describing the pool and the queue.
+        :return: the status
+        :rtype: dict
+        """
+        return {
+            "workers": [w.get_status() for w in sorted(self.workers.values(), key=lambda w: w.name)],
+            "queued": len(self.queue),
+            }
+
+    def submit(self, job, names, archs=None, push=False, push_concurrency=constants.PUSH_CONCURRENCY):
+        """
+        Queue the images of a job.
+        :param job: the job
+        :type job: BrokerJob
+        :param names: names of the images to build
+        :type names: list of str
+        :param archs: build each image once for each of these architectures or None to build it once on any buildserver
+        :type archs: list of str or None
+        :param push: whether the buildservers should push the built images or not
+        :type push: bool
+        :param push_concurrency: maximum number of images to push concurrently per buildserver
+        :type push_concurrency: int
+        :return: a deferred which will fire with the exitcodes of all images
+        :rtype: Deferred
+        """
+        submission = Submission(job, push=push, push_concurrency=push_concurrency)
+        submission.d = defer.Deferred(canceller=lambda d: self.cancel(submission))
+        if not archs:
+            archs = [None]
+        images = dict([(image.name, image) for image in job.project.images])
+        for arch in archs:
+            if arch is not None and arch not in [w.arch for w in self.workers.values()]:
+                job.send_message("No buildserver with architecture {} registered, waiting.\n".format(arch))
+            for name in names:
+                if name in images:
+                    requirements = images[name].get_requirements()
+                else:
+                    requirements = (constants.DEFAULT_IMAGE_CPUS, constants.DEFAULT_IMAGE_MEMORY)
+                submission.tasks.append(Task(submission, name, arch=arch, requirements=requirements))
+        submission.remaining = len(submission.tasks)
+        if submission.remaining == 0:
+            submission.done = True
+            submission.d.callback([])
+            return submission.d
+        self.queue += submission.tasks
+        self.schedule()
+        return submission.d
+
+    def cancel(self, submission):
+        """
+        Cancel a submission.
+        Queued images are removed and the builds of dispatched images are cancelled.
+        :param submission: the submission to cancel
+        :type submission: Submission
+        """
+        submission.done = True
+        self.queue = [t for t in self.queue if t.submission is not submission]
+        for proto in list(submission.protocols):
+            proto.cancel_build()
+
+    def fail(self, submission, failure):
+        """
+        Fail a submission.
+        :param submission: the submission
+        :type submission: Submission
+        :param failure: the reason
+        :type failure: Failure or Exception
+        """
+        if submission.done:
+            return
+        self.cancel(submission)
+        submission.d.errback(failure)
+
+    def select_worker(self, t):
+        """
+        Select the buildserver to dispatch an image to.
+        :param t: the queued image
+        :type t: Task
+        :return: the buildserver or None if no buildserver can build the image now
+        :rtype: Worker or None
+        """
+        key = (t.submission.job.project.name, t.name)
+        candidates = [w for w in self.workers.values() if (t.arch is None or w.arch == t.arch) and w.fits(t.requirements)]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda w: (key not in w.built, w.utilization, w.name))
+
+    def schedule(self):
+        """
+        Dispatch as many queued images as possible, oldest first.
+        Images which can not be dispatched do not block images of other architectures.
+        """
+        batches = []
+        worker_batches = {}
+        remaining = []
+        for t in self.queue:
+            worker = self.select_worker(t)
+            if worker is None:
+                remaining.append(t)
+                continue
+            worker.assign(t.requirements)
+            bk = (id(t.submission), worker.name)
+            if bk not in worker_batches:
+                worker_batches[bk] = (t.submission, worker, [])
+                batches.append(worker_batches[bk])
+            worker_batches[bk][2].append(t)
+        self.queue = remaining
+        for submission, worker, tasks in batches:
+            self.dispatch(submission, worker, tasks)
+
+    @defer.inlineCallbacks
+    def dispatch(self, submission, worker, tasks):
+        """
+        Build images on a buildserver.
+        The requirements of the images must already be assigned to the buildserver.
+        :param submission: the submission the images belong to
+        :type submission: Submission
+        :param worker: the buildserver
+        :type worker: Worker
+        :param tasks: the images
+        :type tasks: list of Task
+        """
+        job = submission.job
+        names = [t.name for t in tasks]
+        try:
+            proto = yield connect(self.reactor, worker.host, worker.port, password=self.password, out=_JobOutput(job))
+            submission.protocols.add(proto)
+            try:
+                if submission.done:
+                    raise defer.CancelledError()
+                exitcodes = yield proto.remote_build(
+                    job.project,
+                    job.archive_path,
+                    only=names,
+                    push=submission.push,
+                    push_concurrency=submission.push_concurrency,
+                    span=job.stats.span,
+                    )
+            finally:
+                submission.protocols.discard(proto)
+                proto.disconnect()
+        except Exception as e:
+            for t in tasks:
+                worker.assign(t.requirements, -1)
+            if not submission.done:
+                self._retry(submission, worker, tasks, e)
+            self.schedule()
+            return
+        for t in tasks:
+            worker.assign(t.requirements, -1)
+        if proto.stats is not None:
+            job.stats.merge(proto.stats)
+        if submission.done:
+            pass
+        elif len(exitcodes) == 0:
+            # cancelled or failed on the buildserver
+            self._retry(submission, worker, tasks, Exception("no images built"))
+        else:
+            if max(exitcodes) == 0:
+                for name in names:
+                    worker.built.add((job.project.name, name))
+            submission.exitcodes += exitcodes
+            submission.remaining -= len(tasks)
+            if submission.remaining == 0:
+                submission.done = True
+                submission.d.callback(submission.exitcodes)
+        self.schedule()
+
+    def _retry(self, submission, worker, tasks, reason):
+        """
+        Queue images again after their build on a buildserver failed.
+        If an image was dispatched too often, the submission fails.
+        :param submission: the submission the images belong to
+        :type submission: Submission
+        :param worker: the buildserver the images were dispatched to
+        :type worker: Worker
+        :param tasks: the images
+        :type tasks: list of Task
+        :param reason: the reason the build failed
+        :type reason: Exception
+        """
+        submission.job.send_message("Building {} on {} failed: {}\n".format(", ".join([t.name for t in tasks]), worker.name, reason))
+        for t in tasks:
+            t.attempts += 1
+            if t.attempts >= constants.BROKER_MAX_ATTEMPTS:
+                self.fail(submission, Exception("Building {} failed {} times".format(t.name, t.attempts)))
+                return
+        self.queue = tasks + self.queue
+
+
+class BrokerJob(Job):
+    """
+    A job of the broker.
+    Instead of building the images itself, the images are dispatched using a Scheduler.
+    :param scheduler: the scheduler to dispatch the images with
+    :type scheduler: Scheduler
+    See Job for the other arguments.
+    """
+    def __init__(self, scheduler, *args, **kwargs):
+        Job.__init__(self, *args, **kwargs)
+        self.scheduler = scheduler
+
+    def start(self, protocolfactory, only=None, push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, arch=None, **kwargs):
+        """
+        Start running this job.
+        See BrokerJob.run() for the arguments, other arguments of Job.start() are ignored.
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        self.d = self.run(protocolfactory, only=only, push=push, deploy=deploy, push_concurrency=push_concurrency, arch=arch)
+        return self.d
+
+    @defer.inlineCallbacks
+    def run(self, protocolfactory, only=None, push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, arch=None):
+        """
+        Dispatch the images of the received project and optionally deploy the project.
+        :param protocolfactory: a callable which returns a protocol to communicate with the deploy child process
+        :type protocolfactory: callable
+        :param only: which images to build
+        :type only: list or None
+        :param push: whether the buildservers should push the built images or not
+        :type push: bool
+        :param deploy: whether to deploy the compose file after the build.
+        :type deploy: bool
+        :param push_concurrency: maximum number of images to push concurrently per buildserver
+        :type push_concurrency: int
+        :param arch: build each image once for each of these architectures
+        :type arch: list of str or None
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        self.state = self.STATE_RUNNING
+        if only is None:
+            only = [image.name for image in self.project.images]
+        protocolfactory = self.track_processes(protocolfactory)
+        try:
+            exitcodes = yield self.scheduler.submit(self, only, archs=arch, push=push, push_concurrency=push_concurrency)
+            if deploy:
+                with self.stats.measure("deploy"):
+                    exitcodes += (yield self.project.deploy_from_zip(self.archive_path, pull=push, protocolfactory=protocolfactory))
+        except defer.CancelledError:
+            yield self.wait_for_processes()
+            self.send_message("Job cancelled.\n")
+            self._finish_unsuccessful(self.STATE_CANCELLED)
+            defer.returnValue([])
+        except Exception as e:
+            log.err(None, "Job {} failed".format(self.id))
+            yield self.wait_for_processes()
+            self.send_message("Job failed: {}\n".format(e))
+            self._finish_unsuccessful(self.STATE_FAILED)
+            defer.returnValue([])
+        finally:
+            self.d = None
+            self.cleanup()
+        self.send_exitcodes(exitcodes)
+        defer.returnValue(exitcodes)
+
+
+class BrokerProtocol(FBADServerProtocol):
+    """
+    The protocol of the broker.
+    In addition to the commands of a buildserver, buildservers may register and report their load.
+    """
+    def connectionMade(self):
+        """
+        Called when the connection to a client or buildserver was established.
+        """
+        FBADServerProtocol.connectionMade(self)
+        self.worker = None  # the buildserver registered using this connection
+
+    def connectionLost(self, reason):
+        """
+        Called when the connection was lost.
+        A buildserver registered using this connection is removed from the pool.
+        :param reason: reason the connection was lost
+        :type reason: Failure
+        """
+        FBADServerProtocol.connectionLost(self, reason)
+        if self.worker is not None:
+            self.factory.scheduler.remove_worker(self.worker, owner=self)
+            self.worker = None
+
+    def handle_command(self, msg):
+        """
+        Handle a command.
+        :param msg: the command
+        :type msg: str
+        """
+        info = json.loads(msg.decode(constants.ENCODING))
+        command = info.get("command", None)
+        if command == "register":
+            self.handle_register(info)
+        elif command == "load":
+            self.handle_load(info)
+        else:
+            FBADServerProtocol.handle_command(self, msg)
+
+    def handle_register(self, info):
+        """
+        Handle a register command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        host = info.get("host", None)
+        if host is None:
+            host = self.transport.getPeer().host
+        worker = Worker(host, info.get("port", constants.DEFAULT_PORT), info.get("arch", None), info.get("cpus", constants.DEFAULT_IMAGE_CPUS), info.get("memory", None))
+        if self.worker is not None:
+            self.factory.scheduler.remove_worker(self.worker, owner=self)
+        self.sendString(json.dumps({"type": "ok"}).encode(constants.ENCODING))
+        self.worker = self.factory.scheduler.add_worker(worker, owner=self)
+
+    def handle_load(self, info):
+        """
+        Handle a load command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        if self.worker is not None:
+            self.factory.scheduler.update_load(self.worker, info.get("load", {}))
+
+    def handle_info(self, info):
+        """
+        Handle an info command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        jdata = {
+            "type": "info",
+            "version": constants.COM_VERSION,
+            "arch": None,
+            "broker": self.factory.scheduler.get_status(),
+            }
+        self.sendString(json.dumps(jdata).encode(constants.ENCODING))
+
+    def handle_build(self, info):
+        """
+        Handle a build command.
+        Project files can not be kept on the broker.
+        :param info: the decoded command
+        :type info: dict
+        """
+        info["keep"] = False
+        FBADServerProtocol.handle_build(self, info)
+
+    def handle_update(self, info):
+        """
+        Handle an update command, which is not supported by the broker.
+        :param info: the decoded command
+        :type info: dict
+        """
+        self.discard_upload("Updating kept project files is not supported by the broker!")
+
+    def receive_and_run(self, info, source_path=None, deleted=None):
+        """
+        Create a job, receive the project files and run the job.
+        Base images are pulled by the buildservers, not by the broker.
+        See FBADServerProtocol.receive_and_run() for the arguments.
+        """
+        info["prefetch"] = None
+        return FBADServerProtocol.receive_and_run(self, info, source_path=source_path, deleted=deleted)
+
+    def start_job(self, job, info, deleted=None):
+        """
+        Start a job after its project files were received.
+        :param job: the job
+        :type job: BrokerJob
+        :param info: the decoded build command
+        :type info: dict
+        :param deleted: ignored
+        :type deleted: list of str or None
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        metrics = self.factory.metrics
+        protofactory = lambda job=job: OutputRelayProtocol(job, metrics=metrics)
+        return job.start(
+            protofactory,
+            only=info.get("only", None),
+            push=info.get("push", False),
+            deploy=info.get("deploy", False),
+            push_concurrency=info.get("push_concurrency", constants.PUSH_CONCURRENCY),
+            arch=info.get("arch", None),
+            )
+
+
+class BrokerFactory(FBADServerFactory):
+    """
+    The factory for the broker.
+    :param password: password for clients and buildservers connecting to the broker
+    :type password: str or None
+    :param worker_password: password for connecting to the buildservers
+    :type worker_password: str or None
+    :param tracer: tracer to write the spans of jobs to
+    :type tracer: Tracer or None
+    :param profiler: profiler to write a dump to whenever a connection was closed
+    :type profiler: ConnectionProfiler or None
+    """
+    protocol = BrokerProtocol
+
+    def __init__(self, password=None, worker_password=None, tracer=None, profiler=None):
+        self.scheduler = Scheduler(password=worker_password)
+        jobs = JobManager(
+            path=os.path.join(tempfile.gettempdir(), constants.BROKER_JOB_DIR_NAME),
+            job_factory=self.create_job,
+            )
+        # the broker has no workspaces to collect
+        FBADServerFactory.__init__(self, password, jobs=jobs, tracer=tracer, profiler=profiler, collect=False)
+
+    def create_job(self, *args, **kwargs):
+        """
+        Create a job.
+        :return: the new job
+        :rtype: BrokerJob
+        """
+        return BrokerJob(self.scheduler, *args, **kwargs)
+
+
+def get_load(factory):
+    """
+    Return the load of a buildserver, as reported to a broker.
+    :param factory: the factory of the buildserver
+    :type factory: FBADServerFactory
+    :return: the load
+    :rtype: dict
+    """
+    status = factory.resources.get_status()
+    return {
+        "cpus": status["used_cpus"] + status["waiting_cpus"],
+        "memory": status["used_memory"] + status["waiting_memory"],
+        "building": status["running"] + status["waiting"],
+        "jobs": len([job for job in factory.jobs.jobs.values() if not job.done]),
+        }
+
+
+class BrokerRegistration(object):
+    """
+    Keeps a buildserver registered with a broker and reports its load.
+    If the connection to the broker is lost, the buildserver registers again.
+    :param factory: the factory of the buildserver
+    :type factory: FBADServerFactory
+    :param host: host of the broker
+    :type host: str
+    :param port: port of the broker
+    :type port: int
+    :param password: password for the broker
+    :type password: str or None
+    :param advertise_host: host the broker should connect to or None to use the address the broker sees
+    :type advertise_host: str or None
+    :param advertise_port: port the broker should connect to
+    :type advertise_port: int
+    :param interval: seconds between load reports
+    :type interval: float
+    """
+    def __init__(self, factory, host, port=constants.DEFAULT_BROKER_PORT, password=None, advertise_host=None, advertise_port=constants.DEFAULT_PORT, interval=constants.BROKER_LOAD_INTERVAL):
+        self.factory = factory
+        self.host = host
+        self.port = port
+        self.password = password
+        self.advertise_host = advertise_host
+        self.advertise_port = advertise_port
+        self.interval = interval
+        self.proto = None
+        self.connecting = False
+        self.next_attempt = 0
+        self.loop = task.LoopingCall(self.tick)
+
+    def start(self):
+        """
+        Register with the broker and start reporting the load.
+        """
+        self.loop.start(self.interval, now=True).addErrback(log.err, "Broker registration loop failed")
+
+    def stop(self):
+        """
+        Stop reporting the load and disconnect from the broker.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        if self.proto is not None:
+            self.proto.disconnect()
+            self.proto = None
+
+    def tick(self):
+        """
+        Report the load or, if not connected, register with the broker.
+        """
+        from twisted.internet import reactor
+        if self.proto is not None and self.proto.transport.connected:
+            self.proto.send_load(get_load(self.factory))
+        elif not self.connecting and reactor.seconds() >= self.next_attempt:
+            self.proto = None
+            self.register()
+
+    @defer.inlineCallbacks
+    def register(self):
+        """
+        Connect and register with the broker.
+        :return: a deferred which will fire when done
+        :rtype: Deferred
+        """
+        from twisted.internet import reactor
+        self.connecting = True
+        try:
+            proto = yield connect(reactor, self.host, self.port, password=self.password)
+            resources = self.factory.resources
+            yield proto.register(self.advertise_host, self.advertise_port, get_arch(), resources.cpus, resources.memory)
+        except Exception as e:
+            log.msg("Could not register with broker {}:{}: {}".format(self.host, self.port, e))
+            self.next_attempt = reactor.seconds() + constants.BROKER_RECONNECT_DELAY
+        else:
+            log.msg("Registered with broker {}:{}".format(self.host, self.port))
+            self.proto = proto
+            proto.send_load(get_load(self.factory))
+        finally:
+            self.connecting = False
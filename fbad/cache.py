@@ -0,0 +1,484 @@
+"""this module implements the sharing of build caches between buildservers."""
+import os
+import re
+import shutil
+import posixpath
+import hashlib
+import tempfile
+import platform
+import uuid
+import json
+import zipfile
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from fbad import constants
+
+
+def get_arch():
+    """
+    Return the architecture of this machine.
+    This is the same value as the '{arch}' placeholder of tags.
+    :return: the architecture
+    :rtype: str
+    """
+    return platform.uname()[4]
+
+
+def parse_peer(s):
+    """
+    Parse a peer specified as 'host' or 'host:port'.
+    :param s: string to parse
+    :type s: str
+    :return: a tuple of (host, port)
+    :rtype: tuple of (str, int)
+    """
+    if ":" in s:
+        host, port = s.rsplit(":", 1)
+        return (host, int(port))
+    return (s, constants.DEFAULT_PORT)
+
+
+def is_blob_path(path):
+    """
+    Check whether a path is the path of a blob relative to a cache.
+    :param path: the path
+    :type path: str or unicode
+    :return: True if the path is a valid blob path
+    :rtype: bool
+    """
+    return path == posixpath.normpath(path) and path.startswith("blobs/") and ".." not in path.split("/")
+
+
+def list_blobs(path):
+    """
+    Return the blobs of an exported cache.
+    Blobs are content-addressed, so blobs with the same path have the same content in every cache.
+    :param path: path of the cache
+    :type path: str or unicode
+    :return: paths of the blobs, relative to the cache
+    :rtype: list of str
+    """
+    blobs = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(path, "blobs")):
+        for fn in filenames:
+            blobs.append(os.path.relpath(os.path.join(dirpath, fn), path).replace(os.sep, "/"))
+    return sorted(blobs)
+
+
+def get_cache_fingerprint(path):
+    """
+    Return a hash of the index and the blobs of an exported cache.
+    :param path: path of the cache
+    :type path: str or unicode
+    :return: the hash or None if the cache does not exist
+    :rtype: str or None
+    """
+    ip = os.path.join(path, "index.json")
+    if not os.path.exists(ip):
+        return None
+    h = hashlib.sha256()
+    with open(ip, "rb") as fin:
+        h.update(fin.read())
+    for blob in list_blobs(path):
+        h.update("\0" + blob)
+    return h.hexdigest()
+
+
+class LayerCache(object):
+    """
+    A directory containing the exported BuildKit caches of images.
+    Caches are stored per architecture and can be shared with the
+    LayerCaches of other buildservers ('peers') of the same architecture.
+    :param path: directory to store caches in
+    :type path: str or unicode
+    :param peers: list of (host, port) tuples of buildservers to share caches with
+    :type peers: list of tuple of (str, int) or None
+    :param password: password for the peers
+    :type password: str or None
+    :param builder: name of the buildx builder to build with (see dockerutils.setup_buildx_builder())
+    :type builder: str
+    """
+    def __init__(self, path, peers=None, password=None, builder=constants.BUILDX_BUILDER_NAME):
+        self.path = path
+        if peers is None:
+            peers = []
+        self.peers = peers
+        self.password = password
+        self.builder = builder
+        self.arch = get_arch()
+
+    def get_key(self, project_name, image_name):
+        """
+        Return the key of the cache for an image.
+        :param project_name: name of the project
+        :type project_name: str or unicode
+        :param image_name: name of the image
+        :type image_name: str or unicode
+        :return: the key
+        :rtype: str
+        """
+        key = u"{}-{}".format(project_name, image_name)
+        return str(re.sub(r"[^A-Za-z0-9_.-]", "_", key))
+
+    def get_path(self, key):
+        """
+        Return the path of the cache with the specified key.
+        :param key: key of the cache
+        :type key: str
+        :return: the path of the cache
+        :rtype: str or unicode
+        """
+        if (key != os.path.basename(key)) or key.startswith("."):
+            raise ValueError("Invalid cache key: " + repr(key))
+        return os.path.join(self.path, self.arch, key)
+
+    def get_image_cache(self, project_name, image_name):
+        """
+        Return an ImageCache for the specified image.
+        :param project_name: name of the project
+        :type project_name: str or unicode
+        :param image_name: name of the image
+        :type image_name: str or unicode
+        :return: the cache of the image
+        :rtype: ImageCache
+        """
+        return ImageCache(self, self.get_key(project_name, image_name))
+
+    def list_blobs(self, key):
+        """
+        Return the blobs of the cache with the specified key.
+        :param key: key of the cache
+        :type key: str
+        :return: paths of the blobs, relative to the cache
+        :rtype: list of str
+        """
+        return list_blobs(self.get_path(key))
+
+    def pack(self, key, dest, exclude=()):
+        """
+        Write the cache with the specified key to a zipfile at dest.
+        :param key: key of the cache
+        :type key: str
+        :param dest: path to write zipfile to
+        :type dest: str or unicode
+        :param exclude: blobs not to write to the zipfile (e.g. because the receiver already has them)
+        :type exclude: set of str
+        :return: paths of all blobs of the cache, including the excluded ones
+        :rtype: list of str
+        """
+        cp = self.get_path(key)
+        blobs = []
+        # the blobs are already compressed
+        with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for dirpath, dirnames, filenames in os.walk(cp):
+                for fn in filenames:
+                    lp = os.path.join(dirpath, fn)
+                    rp = os.path.relpath(lp, cp).replace(os.sep, "/")
+                    if rp.startswith("blobs/"):
+                        blobs.append(rp)
+                    if rp not in exclude:
+                        zf.write(lp, rp)
+        return sorted(blobs)
+
+    def unpack(self, key, path, blobs=None):
+        """
+        Replace the cache with the specified key with the content of the zipfile at path.
+        :param key: key of the cache
+        :type key: str
+        :param path: path of the zipfile
+        :type path: str or unicode
+        :param blobs: if specified, all blobs of the new cache. Blobs missing in the zipfile are taken from the current cache.
+        :type blobs: list of str or None
+        """
+        cp = self.get_path(key)
+        tp = cp + ".tmp-" + uuid.uuid4().hex
+        try:
+            with zipfile.ZipFile(path, "r", allowZip64=True) as zf:
+                zf.extractall(tp)
+            for blob in (blobs or []):
+                if not is_blob_path(blob):
+                    raise ValueError("Invalid blob path: " + repr(blob))
+                dest = os.path.join(tp, blob)
+                if os.path.exists(dest):
+                    continue
+                src = os.path.join(cp, blob)
+                if not os.path.exists(src):
+                    raise ValueError("Missing blob: " + blob)
+                parent = os.path.dirname(dest)
+                if not os.path.exists(parent):
+                    os.makedirs(parent)
+                shutil.copyfile(src, dest)
+        except Exception:
+            shutil.rmtree(tp, ignore_errors=True)
+            raise
+        self.replace(key, tp)
+
+    def replace(self, key, path):
+        """
+        Replace the cache with the specified key with the directory at path.
+        :param key: key of the cache
+        :type key: str
+        :param path: directory to move to the cache
+        :type path: str or unicode
+        """
+        cp = self.get_path(key)
+        op = cp + ".old-" + uuid.uuid4().hex
+        parent = os.path.dirname(cp)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        if os.path.exists(cp):
+            os.rename(cp, op)
+        os.rename(path, cp)
+        if os.path.exists(op):
+            shutil.rmtree(op)
+
+    @defer.inlineCallbacks
+    def publish(self, key):
+        """
+        Send the cache with the specified key to all peers of the same architecture.
+        Errors are logged, but not raised.
+        :param key: key of the cache
+        :type key: str
+        :return: a deferred which will fire when the cache was send to all peers
+        :rtype: Deferred
+        """
+        if len(self.peers) == 0:
+            return
+        ds = []
+        for host, port in self.peers:
+            d = self._send_to_peer(host, port, key)
+            d.addErrback(log.err, "Error sending cache {} to {}:{}".format(key, host, port))
+            ds.append(d)
+        yield defer.gatherResults(ds)
+
+    @defer.inlineCallbacks
+    def _send_to_peer(self, host, port, key):
+        """
+        Send a cache to a peer.
+        Only the blobs the peer does not have in its cache with the same key are send.
+        :param host: host of the peer
+        :type host: str
+        :param port: port of the peer
+        :type port: int
+        :param key: key of the cache
+        :type key: str
+        :return: a deferred which will fire when the cache was send
+        :rtype: Deferred
+        """
+        from twisted.internet import reactor
+        from fbad.client import connect
+        peer = yield connect(reactor, host, port, password=self.password)
+        zp = self.get_path(key) + ".send-" + uuid.uuid4().hex + ".zip"
+        try:
+            info = yield peer.get_info()
+            if info.get("arch", None) != self.arch:
+                return
+            present = yield peer.get_cache_blobs(self.arch, key)
+            blobs = yield threads.deferToThread(self.pack, key, zp, exclude=set(present))
+            yield peer.send_cache(self.arch, key, zp, blobs=blobs)
+        finally:
+            peer.disconnect()
+            if os.path.exists(zp):
+                os.remove(zp)
+
+
+class ImageCache(object):
+    """
+    The cache of a single image in a LayerCache.
+    :param layercache: the LayerCache this cache is part of
+    :type layercache: LayerCache
+    :param key: the key of this cache
+    :type key: str
+    """
+    def __init__(self, layercache, key):
+        self.layercache = layercache
+        self.key = key
+        self.path = layercache.get_path(key)
+        self.export_path = self.path + ".export-" + uuid.uuid4().hex
+
+    def get_build_options(self):
+        """
+        Return the options for 'docker buildx build' to import and export this cache.
+        :return: the options
+        :rtype: list of str
+        """
+        options = ["--builder", self.layercache.builder]
+        if os.path.exists(self.path):
+            options += ["--cache-from", "type=local,src=" + self.path]
+        options += ["--cache-to", "type=local,mode=max,dest=" + self.export_path]
+        return options
+
+    def is_unchanged(self):
+        """
+        Check whether the exported cache is the same as the current cache.
+        :return: True if nothing changed
+        :rtype: bool
+        """
+        current = get_cache_fingerprint(self.path)
+        return current is not None and current == get_cache_fingerprint(self.export_path)
+
+    @defer.inlineCallbacks
+    def commit(self, success=True):
+        """
+        Replace the cache with the exported cache and publish it to all peers.
+        If success is False or the exported cache is the same as the current one, discard the exported cache instead.
+        :param success: whether the build was successful
+        :type success: bool
+        :return: a deferred which will fire when the cache was replaced
+        :rtype: Deferred
+        """
+        if not os.path.exists(self.export_path):
+            return
+        if success:
+            unchanged = yield threads.deferToThread(self.is_unchanged)
+        if not success or unchanged:
+            yield threads.deferToThread(shutil.rmtree, self.export_path)
+            return
+        yield threads.deferToThread(self.layercache.replace, self.key, self.export_path)
+        # publish in the background
+        self.layercache.publish(self.key).addErrback(log.err, "Error publishing cache " + self.key)
+
+
+class PreexecCache(object):
+    """
+    A directory containing the files generated by preexec commands.
+    Outputs are stored per architecture and keyed by the command and the content of its inputs.
+    :param path: directory to store outputs in (defaults to a directory in the temp dir)
+    :type path: str or unicode or None
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), constants.PREEXEC_CACHE_DIR_NAME)
+        self.path = path
+        self.arch = get_arch()
+
+    def get_key(self, command, buildpath, inputs, outputs):
+        """
+        Return the key of the outputs of a preexec command.
+        :param command: the preexec command
+        :type command: list of str
+        :param buildpath: path the command is executed in
+        :type buildpath: str or unicode
+        :param inputs: paths of the inputs, relative to buildpath. None means the whole buildpath.
+        :type inputs: list or None
+        :param outputs: paths of the outputs, relative to buildpath
+        :type outputs: list
+        :return: the key
+        :rtype: str
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps([self.arch, command, sorted(outputs)]))
+        if inputs is None:
+            inputs = ["."]
+        outputs = [os.path.normpath(o) for o in outputs]
+        for ip in sorted(inputs):
+            for rp in self._list_files(buildpath, os.path.normpath(ip), outputs):
+                h.update(json.dumps(rp))
+                with open(os.path.join(buildpath, rp), "rb") as fin:
+                    while True:
+                        data = fin.read(constants.READ_CHUNK_SIZE)
+                        if not data:
+                            break
+                        h.update(data)
+        return h.hexdigest()
+
+    def _list_files(self, buildpath, relpath, exclude):
+        """
+        Return the files at relpath, recursively and sorted, skipping the paths in exclude.
+        :param buildpath: path relpath is relative to
+        :type buildpath: str or unicode
+        :param relpath: path of the file or directory to list
+        :type relpath: str or unicode
+        :param exclude: normalized paths to skip
+        :type exclude: list of str
+        :return: the paths of the files, relative to buildpath
+        :rtype: list of str
+        """
+        if relpath in exclude:
+            return []
+        fp = os.path.join(buildpath, relpath)
+        if os.path.isfile(fp):
+            return [relpath]
+        if not os.path.isdir(fp):
+            return []
+        files = []
+        for fn in sorted(os.listdir(fp)):
+            files += self._list_files(buildpath, os.path.normpath(os.path.join(relpath, fn)), exclude)
+        return files
+
+    def get_path(self, key):
+        """
+        Return the path of the outputs with the specified key.
+        :param key: key of the outputs
+        :type key: str
+        :return: the path of the outputs
+        :rtype: str or unicode
+        """
+        return os.path.join(self.path, self.arch, key)
+
+    def restore(self, key, buildpath, outputs):
+        """
+        Copy the cached outputs with the specified key into buildpath.
+        :param key: key of the outputs
+        :type key: str
+        :param buildpath: path the outputs are relative to
+        :type buildpath: str or unicode
+        :param outputs: paths of the outputs, relative to buildpath
+        :type outputs: list
+        :return: True if the outputs were cached, False otherwise
+        :rtype: bool
+        """
+        cp = self.get_path(key)
+        if not os.path.isdir(cp):
+            return False
+        try:
+            # the garbage collection of buildservers removes outputs which were not used for a while
+            os.utime(cp, None)
+        except OSError:
+            return False
+        for op in outputs:
+            src = os.path.join(cp, os.path.normpath(op))
+            dest = os.path.join(buildpath, op)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            elif os.path.exists(dest):
+                os.remove(dest)
+            if os.path.isdir(src):
+                shutil.copytree(src, dest)
+            elif os.path.exists(src):
+                parent = os.path.dirname(dest)
+                if parent and not os.path.exists(parent):
+                    os.makedirs(parent)
+                shutil.copy2(src, dest)
+        return True
+
+    def store(self, key, buildpath, outputs):
+        """
+        Store the outputs in buildpath with the specified key.
+        :param key: key of the outputs
+        :type key: str
+        :param buildpath: path the outputs are relative to
+        :type buildpath: str or unicode
+        :param outputs: paths of the outputs, relative to buildpath
+        :type outputs: list
+        """
+        cp = self.get_path(key)
+        tp = cp + ".tmp-" + uuid.uuid4().hex
+        os.makedirs(tp)
+        for op in outputs:
+            src = os.path.join(buildpath, op)
+            dest = os.path.join(tp, os.path.normpath(op))
+            if os.path.isdir(src):
+                shutil.copytree(src, dest)
+            elif os.path.exists(src):
+                parent = os.path.dirname(dest)
+                if not os.path.exists(parent):
+                    os.makedirs(parent)
+                shutil.copy2(src, dest)
+        if os.path.exists(cp):
+            # stored concurrently
+            shutil.rmtree(tp)
+        else:
+            os.rename(tp, cp)
@@ -1,14 +1,18 @@
 """the client protocol."""
+import os
 import hashlib
 import json
 
-from twisted.internet import defer, threads
+from twisted.internet import defer, threads, task, endpoints
 from twisted.protocols.basic import IntNStringReceiver
+from twisted.protocols.policies import TimeoutMixin
 
 from fbad import constants, errors
+from fbad.timing import BuildStats
+from fbad.workspace import get_zip_content_size
 
 
-class FBADClientProtocol(IntNStringReceiver):
+class FBADClientProtocol(IntNStringReceiver, TimeoutMixin):
     """
     The protocol for the FBAD client.
     :param password: password for the server
@@ -28,11 +32,19 @@ class FBADClientProtocol(IntNStringReceiver):
     STATE_WAIT_AUTH_RESPONSE = 1
     STATE_READY = 2
     STATE_BUILDING = 3
+    STATE_WAIT_RESPONSE = 4
 
     def __init__(self, password=None, d=None, out=None):
         self.password = password
         self.d = d
         self.out = out
+        self.job_id = None  # id of the current job
+        self.job_d = None  # deferred to callback with the job id
+        self.build_d = None  # deferred to callback with the exitcodes
+        self.response_d = None  # deferred to callback with a response
+        self.stats = None  # BuildStats of the current or last build
+        self.uploading = False  # whether the files of a build are currently send
+        self.upload_cancelled = False  # whether the build was cancelled during the upload
 
     def connectionMade(self):
         """
@@ -40,6 +52,47 @@ class FBADClientProtocol(IntNStringReceiver):
         """
         self.send_version()
         self.state = self.STATE_WAIT_VERSION_RESPONSE
+        self.setTimeout(constants.HEARTBEAT_TIMEOUT)
+        self.heartbeat_loop = task.LoopingCall(self.send_heartbeat)
+        self.heartbeat_loop.start(constants.HEARTBEAT_INTERVAL, now=False)
+
+    def dataReceived(self, data):
+        """
+        Called when data was received.
+        :param data: the received data
+        :type data: str
+        """
+        self.resetTimeout()
+        IntNStringReceiver.dataReceived(self, data)
+
+    def timeoutConnection(self):
+        """
+        Called when the server did not send anything (including heartbeats) for too long.
+        """
+        self.transport.abortConnection()
+
+    def connectionLost(self, reason):
+        """
+        Called when the connection was lost.
+        All pending deferreds will errback with reason.
+        :param reason: reason the connection was lost
+        :type reason: Failure
+        """
+        self.setTimeout(None)
+        if self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+        self.state = self.STATE_IGNORE
+        for attr in ("d", "job_d", "build_d", "response_d"):
+            d = getattr(self, attr)
+            setattr(self, attr, None)
+            if d is not None and not d.called:
+                d.errback(reason)
+
+    def send_heartbeat(self):
+        """
+        Send a heartbeat to the server.
+        """
+        self.sendString(constants.HEARTBEAT_MESSAGE)
 
     def send_version(self):
         """
@@ -54,7 +107,11 @@ class FBADClientProtocol(IntNStringReceiver):
         :type msg: str
         """
 
-        if self.state == self.STATE_IGNORE:
+        if msg == constants.HEARTBEAT_MESSAGE:
+            # heartbeat; the timeout was already reset
+            pass
+
+        elif self.state == self.STATE_IGNORE:
             # ignore message
             pass
 
@@ -67,6 +124,9 @@ class FBADClientProtocol(IntNStringReceiver):
         elif self.state == self.STATE_BUILDING:
             self.handle_build_message(msg)
 
+        elif self.state == self.STATE_WAIT_RESPONSE:
+            self.handle_response(msg)
+
         else:
             self.handle_protocol_violation(msg)
 
@@ -149,18 +209,44 @@ class FBADClientProtocol(IntNStringReceiver):
                 self.out.write(s)
         elif ty == "finish":
             exitcodes = data.get("exitcodes", [])
+            if data.get("stats", None) is not None:
+                if self.stats is None:
+                    self.stats = BuildStats()
+                self.stats.merge(BuildStats.from_dict(data["stats"]))
             self.build_d.callback(exitcodes)
+        elif ty == "job":
+            self.job_id = data["job"]
+            if self.job_d is not None:
+                d, self.job_d = self.job_d, None
+                d.callback(self.job_id)
+        elif ty == "error":
+            self.state = self.STATE_READY
+            self.build_d.errback(errors.RemoteError(data.get("message", "Unknown error")))
         else:
             self.handle_protocol_violation(msg)
 
+    def handle_response(self, msg):
+        """
+        Handles a response to a non-build command.
+        :param msg: the response
+        :type msg: str
+        """
+        data = json.loads(msg)
+        ty = data["type"]
+        self.state = self.STATE_READY
+        d, self.response_d = self.response_d, None
+        if ty == "error":
+            d.errback(errors.RemoteError(data.get("message", "Unknown error")))
+        else:
+            d.callback(data)
+
     def disconnect(self):
         """
         Disconnect from the server.
         """
         self.transport.loseConnection()
 
-    @defer.inlineCallbacks
-    def remote_build(self, project, zippath, only=None, push=False, deploy=False):
+    def remote_build(self, project, zippath, only=None, push=False, deploy=False, detach=False, prefetch=None, push_concurrency=constants.PUSH_CONCURRENCY, keep=False, span=None, arch=None):
         """
         Run a remote build.
         :param project: project to build
@@ -173,32 +259,374 @@ class FBADClientProtocol(IntNStringReceiver):
         :type push: bool
         :param deploy: whether to deploy the compose file after the build.
         :type deploy: bool
-        :return: a deferred which fires with the exitcodes of the build processes.
+        :param detach: if True, return the job id after the upload instead of waiting for the build.
+        :type detach: bool
+        :param prefetch: images the server should pull while receiving the project files
+        :type prefetch: list of str or None
+        :param push_concurrency: maximum number of images to push concurrently
+        :type push_concurrency: int
+        :param keep: if True, keep the project files on the server for remote_update()
+        :type keep: bool
+        :param span: span of this build. Its context is propagated to the server.
+        :type span: Span or None
+        :param arch: when building using a broker, build each image once on a buildserver of each of these architectures
+        :type arch: list of str or None
+        :return: a deferred which fires with the exitcodes of the build processes or the job id
+        :rtype: Deferred
+        """
+        command = {
+            "command": "build",
+            "project": project.dumps(),
+            "only": only,
+            "push": push,
+            "deploy": deploy,
+            "detach": detach,
+            "prefetch": prefetch,
+            "push_concurrency": push_concurrency,
+            "keep": keep,
+            }
+        if arch is not None:
+            command["arch"] = arch
+        return self._run_build_command(command, zippath, detach=detach, span=span)
+
+    def remote_update(self, zippath, deleted=None, only=None, push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, span=None):
+        """
+        Update the project files kept by a previous remote_build() and build again.
+        :param zippath: path of zip containing the changed files
+        :type zippath: str or unicode
+        :param deleted: paths of deleted files, relative to the project path
+        :type deleted: list of str or None
+        :param only: which images to built, specified by their name
+        :type only: list or None
+        :param push: if True, push images to the registry
+        :type push: bool
+        :param deploy: whether to deploy the compose file after the build.
+        :type deploy: bool
+        :param push_concurrency: maximum number of images to push concurrently
+        :type push_concurrency: int
+        :param span: span of this build. Its context is propagated to the server.
+        :type span: Span or None
+        :return: a deferred which fires with the exitcodes of the build processes
+        :rtype: Deferred
+        """
+        if deleted is None:
+            deleted = []
+        command = {
+            "command": "update",
+            "deleted": deleted,
+            "only": only,
+            "push": push,
+            "deploy": deploy,
+            "push_concurrency": push_concurrency,
+            }
+        return self._run_build_command(command, zippath, span=span)
+
+    @defer.inlineCallbacks
+    def _run_build_command(self, command, zippath, detach=False, span=None):
+        """
+        Send a build or update command followed by a zipfile and wait for the result.
+        :param command: the command to send
+        :type command: dict
+        :param zippath: path of the zip to send
+        :type zippath: str or unicode
+        :param detach: if True, return the job id after the upload instead of waiting for the build.
+        :type detach: bool
+        :param span: span of this build
+        :type span: Span or None
+        :return: a deferred which fires with the exitcodes of the build processes or the job id
+        :rtype: Deferred
+        """
+        if span is not None:
+            command["trace"] = span.get_context()
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_BUILDING
+        self.build_d = build_d = defer.Deferred()
+        self.job_d = job_d = defer.Deferred()
+        self.stats = BuildStats(span=span)
+        # lets the server decide whether the files fit into memory
+        command["size"] = os.path.getsize(zippath)
+        command["context_size"] = yield threads.deferToThread(get_zip_content_size, zippath)
+        self.sendString(json.dumps(command).encode(constants.ENCODING))
+        self.uploading = True
+        self.upload_cancelled = False
+        try:
+            with self.stats.measure("upload"):
+                with open(zippath, "rb") as fin:
+                    yield self.send_file(fin)
+        finally:
+            self.uploading = False
+        if detach:
+            job_id = yield job_d
+            self.build_d = None
+            self.state = self.STATE_READY
+            defer.returnValue(job_id)
+        exitcodes = yield build_d
+        self.state = self.STATE_READY
+        defer.returnValue(exitcodes)
+
+    @defer.inlineCallbacks
+    def attach(self, job_id, offset=0):
+        """
+        Attach to a job running on the server.
+        The log of the job will be written to out, starting at offset.
+        :param job_id: id of the job to attach to
+        :type job_id: str or unicode
+        :param offset: offset in the log of the job to start at
+        :type offset: int
+        :return: a deferred which fires with the exitcodes of the job.
         :rtype: Deferred
         """
         if self.state != self.STATE_READY:
             raise RuntimeError("Protocol not yet ready!")
 
         self.state = self.STATE_BUILDING
+        self.job_id = job_id
         self.build_d = defer.Deferred()
-        ser_project = project.dumps()
+        self.stats = None
         self.sendString(
             json.dumps(
                 {
-                    "command": "build",
-                    "project": ser_project,
-                    "only": only,
-                    "push": push,
-                    "deploy": deploy,
+                    "command": "attach",
+                    "job": job_id,
+                    "offset": offset,
                 }
                 ).encode(constants.ENCODING),
             )
-        with open(zippath, "rb") as fin:
-            yield self.send_file(fin)
         exitcodes = yield self.build_d
         self.state = self.STATE_READY
         defer.returnValue(exitcodes)
 
+    @defer.inlineCallbacks
+    def get_status(self, job_id=None):
+        """
+        Query the status of a job.
+        :param job_id: id of the job to query. If None, query all jobs.
+        :type job_id: str or unicode or None
+        :return: a deferred which fires with the status dict (or a list of them).
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = defer.Deferred()
+        self.sendString(
+            json.dumps(
+                {
+                    "command": "status",
+                    "job": job_id,
+                }
+                ).encode(constants.ENCODING),
+            )
+        response = yield self.response_d
+        defer.returnValue(response["status"])
+
+    @defer.inlineCallbacks
+    def cancel(self, job_id):
+        """
+        Cancel a job.
+        :param job_id: id of the job to cancel
+        :type job_id: str or unicode
+        :return: a deferred which fires with the status dict of the cancelled job.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = defer.Deferred()
+        self.sendString(
+            json.dumps(
+                {
+                    "command": "cancel",
+                    "job": job_id,
+                }
+                ).encode(constants.ENCODING),
+            )
+        response = yield self.response_d
+        defer.returnValue(response["status"])
+
+    @defer.inlineCallbacks
+    def get_info(self):
+        """
+        Query information about the server.
+        :return: a deferred which fires with a dict containing the information.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = defer.Deferred()
+        self.sendString(json.dumps({"command": "info"}).encode(constants.ENCODING))
+        response = yield self.response_d
+        defer.returnValue(response)
+
+    @defer.inlineCallbacks
+    def get_cache_blobs(self, arch, key):
+        """
+        Query the blobs of a build cache of the server.
+        :param arch: architecture of the cache
+        :type arch: str
+        :param key: key of the cache
+        :type key: str
+        :return: a deferred which fires with the paths of the blobs, relative to the cache.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = defer.Deferred()
+        self.sendString(json.dumps({"command": "cache_blobs", "arch": arch, "key": key}).encode(constants.ENCODING))
+        response = yield self.response_d
+        defer.returnValue(response["blobs"])
+
+    @defer.inlineCallbacks
+    def send_cache(self, arch, key, zippath, blobs=None):
+        """
+        Send a build cache to the server.
+        :param arch: architecture of the cache
+        :type arch: str
+        :param key: key of the cache
+        :type key: str
+        :param zippath: path of zip containing the cache
+        :type zippath: str or unicode
+        :param blobs: if specified, all blobs of the cache. Blobs missing in the zip are taken from the cache of the server.
+        :type blobs: list of str or None
+        :return: a deferred which fires when the server stored the cache.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = response_d = defer.Deferred()
+        self.sendString(
+            json.dumps(
+                {
+                    "command": "cache_put",
+                    "arch": arch,
+                    "key": key,
+                    "blobs": blobs,
+                }
+                ).encode(constants.ENCODING),
+            )
+        with open(zippath, "rb") as fin:
+            yield self.send_file(fin)
+        yield response_d
+
+    @defer.inlineCallbacks
+    def register(self, host, port, arch, cpus, memory):
+        """
+        Register this buildserver with a broker.
+        :param host: host the broker should connect to or None to use the address of this connection
+        :type host: str or None
+        :param port: port the broker should connect to
+        :type port: int
+        :param arch: architecture of this buildserver
+        :type arch: str
+        :param cpus: CPUs this buildserver has for builds
+        :type cpus: float
+        :param memory: bytes of memory this buildserver has for builds or None for no limit
+        :type memory: int or None
+        :return: a deferred which fires when the broker accepted the registration.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = defer.Deferred()
+        self.sendString(
+            json.dumps(
+                {
+                    "command": "register",
+                    "host": host,
+                    "port": port,
+                    "arch": arch,
+                    "cpus": cpus,
+                    "memory": memory,
+                }
+                ).encode(constants.ENCODING),
+            )
+        yield self.response_d
+
+    def send_load(self, load):
+        """
+        Send the current load of this buildserver to a broker it registered with.
+        :param load: the load, see Broker.update_load()
+        :type load: dict
+        """
+        if self.state != self.STATE_READY:
+            return
+        self.sendString(
+            json.dumps(
+                {
+                    "command": "load",
+                    "load": load,
+                }
+                ).encode(constants.ENCODING),
+            )
+
+    @defer.inlineCallbacks
+    def get_image_layers(self):
+        """
+        Query the layers of the images of the docker daemon of the server.
+        :return: a deferred which fires with a list containing the diff ids of the layers of each image.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = defer.Deferred()
+        self.sendString(json.dumps({"command": "image_layers"}).encode(constants.ENCODING))
+        response = yield self.response_d
+        defer.returnValue(response["layers"])
+
+    @defer.inlineCallbacks
+    def send_images(self, tarpath):
+        """
+        Send images saved using 'docker save' to the server, which loads them using 'docker load'.
+        :param tarpath: path of the archive written by 'docker save'
+        :type tarpath: str or unicode
+        :return: a deferred which fires with the output of 'docker load' when the images were loaded.
+        :rtype: Deferred
+        """
+        if self.state != self.STATE_READY:
+            raise RuntimeError("Protocol not yet ready!")
+
+        self.state = self.STATE_WAIT_RESPONSE
+        self.response_d = response_d = defer.Deferred()
+        self.sendString(json.dumps({"command": "image_load"}).encode(constants.ENCODING))
+        with open(tarpath, "rb") as fin:
+            yield self.send_file(fin)
+        response = yield response_d
+        defer.returnValue(response.get("output", ""))
+
+    def cancel_build(self):
+        """
+        Cancel the build currently running on this connection.
+        The deferred returned by remote_build() or attach() will fire when the server stopped the build.
+        """
+        if self.state != self.STATE_BUILDING:
+            return
+        if self.uploading:
+            # the server does not accept commands during the upload, so the upload is ended instead
+            self.upload_cancelled = True
+            return
+        self.sendString(
+            json.dumps(
+                {
+                    "command": "cancel",
+                    "job": self.job_id,
+                }
+                ).encode(constants.ENCODING),
+            )
+
     @defer.inlineCallbacks
     def send_file(self, fin):
         """
@@ -208,8 +636,34 @@ class FBADClientProtocol(IntNStringReceiver):
         """
         while True:
             data = yield threads.deferToThread(fin.read, constants.READ_CHUNK_SIZE)
-            if data:
+            if self.upload_cancelled:
+                self.sendString(constants.MESSAGE_PREFIX_CANCEL)
+                break
+            elif data:
                 self.sendString(constants.MESSAGE_PREFIX_CONTINUE + data)
             else:
                 self.sendString(constants.MESSAGE_PREFIX_END)
                 break
+
+
+def connect(reactor, host, port, password=None, out=None):
+    """
+    Connect to a buildserver.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param host: host of the buildserver
+    :type host: str
+    :param port: port of the buildserver
+    :type port: int
+    :param password: password for the buildserver
+    :type password: str
+    :param out: file to write output to
+    :type out: file-like object
+    :return: a deferred which will fire with the connected FBADClientProtocol
+    :rtype: Deferred
+    """
+    d = defer.Deferred()
+    proto = FBADClientProtocol(password=password, d=d, out=out)
+    ep = endpoints.TCP4ClientEndpoint(reactor, host, port)
+    endpoints.connectProtocol(ep, proto).addErrback(d.errback)
+    return d
@@ -0,0 +1,348 @@
+"""this module implements the garbage collection of workspaces and images on buildservers."""
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from twisted.internet import defer, task, threads
+from twisted.python import log
+
+from fbad import constants
+from fbad.shutils import run_command, is_process_running, CollectingProcessProtocol
+from fbad.workspace import active_workspaces, get_process_dir
+from fbad.dockerutils import get_docker_executable
+
+
+def get_free_space(path):
+    """
+    Return the number of bytes available on the filesystem containing path.
+    :param path: the path
+    :type path: str or unicode
+    :return: the number of available bytes
+    :rtype: int
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def list_dirs(path):
+    """
+    Return the names of the directories in a directory.
+    :param path: the directory
+    :type path: str or unicode
+    :return: the names of the directories, empty if path does not exist
+    :rtype: list of str
+    """
+    if not os.path.isdir(path):
+        return []
+    return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+
+def remove_stale_dirs(path, keep, cutoff):
+    """
+    Remove the directories in path which are not in keep and were not modified after cutoff.
+    :param path: directory containing the directories to check
+    :type path: str or unicode
+    :param keep: paths of directories to keep
+    :type keep: set of str
+    :param cutoff: remove directories last modified before this time
+    :type cutoff: float
+    :return: the paths of the removed directories
+    :rtype: list of str
+    """
+    if not os.path.isdir(path):
+        return []
+    removed = []
+    for name in os.listdir(path):
+        p = os.path.join(path, name)
+        if p in keep or not os.path.isdir(p):
+            continue
+        try:
+            if os.path.getmtime(p) >= cutoff:
+                continue
+        except OSError:
+            # removed in the meantime
+            continue
+        shutil.rmtree(p, ignore_errors=True)
+        removed.append(p)
+    return removed
+
+
+def remove_orphaned_dirs(path, cutoff):
+    """
+    Remove the directories of processes which are no longer running from a directory
+    shared with other processes (see get_process_dir()).
+    Directories not named after a process (left by older versions) are removed
+    if they were not modified after cutoff.
+    :param path: the shared directory
+    :type path: str or unicode
+    :param cutoff: remove directories not named after a process last modified before this time
+    :type cutoff: float
+    :return: the paths of the removed directories
+    :rtype: list of str
+    """
+    if not os.path.isdir(path):
+        return []
+    removed = []
+    for name in os.listdir(path):
+        p = os.path.join(path, name)
+        if not os.path.isdir(p):
+            continue
+        if name.isdigit():
+            if int(name) == os.getpid() or is_process_running(int(name)):
+                continue
+        else:
+            try:
+                if os.path.getmtime(p) >= cutoff:
+                    continue
+            except OSError:
+                # removed in the meantime
+                continue
+        shutil.rmtree(p, ignore_errors=True)
+        removed.append(p)
+    return removed
+
+
+class Collector(object):
+    """
+    Periodically removes stale workspaces of a buildserver, the workspaces of processes
+    which are no longer running, preexec outputs which were not used for a while and,
+    when less disk space than the budget is free, the least recently built images.
+    Images built by fbad are labeled with constants.IMAGE_LABEL, other images are never removed.
+    :param factory: the factory of the buildserver
+    :type factory: FBADServerFactory
+    :param budget: bytes of disk space to keep free or None to never remove images
+    :type budget: int or None
+    :param interval: seconds between collections
+    :type interval: float
+    :param min_age: workspaces modified more recently are never removed
+    :type min_age: float
+    :param preexec_max_age: preexec outputs not used for this many seconds are removed
+    :type preexec_max_age: float
+    """
+    def __init__(self, factory, budget=None, interval=constants.COLLECT_INTERVAL, min_age=constants.COLLECT_MIN_AGE, preexec_max_age=constants.PREEXEC_CACHE_MAX_AGE):
+        self.factory = factory
+        self.budget = budget
+        self.interval = interval
+        self.min_age = min_age
+        self.preexec_max_age = preexec_max_age
+        self.tempdir = tempfile.gettempdir()
+        self.usage_path = os.path.join(self.tempdir, constants.IMAGE_USAGE_FILE_NAME)
+        self.last_built = self.load_usage()
+        self.docker_root = None
+        self.d = None  # deferred of the current collection
+        self.loop = task.LoopingCall(self.collect)
+
+    def start(self):
+        """
+        Start collecting periodically.
+        """
+        self.loop.start(self.interval, now=True).addErrback(log.err, "Garbage collection loop failed")
+
+    def stop(self):
+        """
+        Stop collecting periodically.
+        """
+        if self.loop.running:
+            self.loop.stop()
+
+    def load_usage(self):
+        """
+        Load the times the images were last built.
+        :return: dict of tag -> time
+        :rtype: dict
+        """
+        try:
+            with open(self.usage_path, "r") as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return {}
+
+    def save_usage(self):
+        """
+        Save the times the images were last built in a thread.
+        :return: a deferred which will fire when the file was written
+        :rtype: Deferred
+        """
+        return threads.deferToThread(self._write_usage, json.dumps(self.last_built))
+
+    def _write_usage(self, data):
+        """
+        Write the times the images were last built.
+        :param data: the encoded times
+        :type data: str
+        """
+        with open(self.usage_path, "w") as fout:
+            fout.write(data)
+
+    def observe_job(self, job):
+        """
+        Record the images built by a job.
+        :param job: the finished job
+        :type job: Job
+        """
+        now = time.time()
+        for image in job.project.images:
+            if "build" in job.stats.images.get(image.name, {}):
+                self.last_built[image.format_tag(image.tag)] = now
+
+    def get_active(self):
+        """
+        Return the workspaces and images in use and the time the oldest running job was created.
+        Workspaces are also created while a job runs, so newer workspaces are kept as well.
+        :return: tuple of (set of paths, set of tags, time)
+        :rtype: tuple of (set, set, float)
+        """
+        paths = set(self.factory.sessions) | self.factory.workspaces.moving | active_workspaces
+        tags = set()
+        oldest = time.time()
+        for job in self.factory.jobs.jobs.values():
+            paths.add(job.path)
+            if job.done:
+                continue
+            oldest = min(oldest, job.created)
+            for p in (job.workspace, job.source_path):
+                if p is not None:
+                    paths.add(p)
+            for image in job.project.images:
+                tags.add(image.format_tag(image.tag))
+        return paths, tags, oldest
+
+    def collect(self):
+        """
+        Run a collection, unless one is already running.
+        :return: a deferred which will fire when the collection is done
+        :rtype: Deferred
+        """
+        if self.d is None:
+            self.d = self._collect()
+            self.d.addErrback(log.err, "Error during garbage collection")
+            self.d.addBoth(self._collected)
+        return self.d
+
+    def _collected(self, result):
+        """
+        Called when a collection is done.
+        :param result: ignored
+        :type result: object
+        """
+        self.d = None
+
+    @defer.inlineCallbacks
+    def _collect(self):
+        """
+        Remove stale workspaces and, if required, images.
+        :return: a deferred which will fire when done
+        :rtype: Deferred
+        """
+        paths, tags, oldest = self.get_active()
+        cutoff = min(time.time() - self.min_age, oldest)
+        roots = [
+            os.path.join(self.tempdir, constants.TEMP_DIR_NAME),
+            os.path.join(self.tempdir, constants.JOB_DIR_NAME),
+            ]
+        if self.factory.workspaces.root is not None:
+            roots.append(self.factory.workspaces.root)
+        for root in roots:
+            # other processes may use the same directory
+            removed = yield threads.deferToThread(remove_stale_dirs, get_process_dir(root), paths, cutoff)
+            removed += yield threads.deferToThread(remove_orphaned_dirs, root, cutoff)
+            for p in removed:
+                log.msg("Removed stale workspace " + p)
+        preexec_path = os.path.join(self.tempdir, constants.PREEXEC_CACHE_DIR_NAME)
+        preexec_cutoff = time.time() - self.preexec_max_age
+        for arch in (yield threads.deferToThread(list_dirs, preexec_path)):
+            # restoring outputs updates the modification time of their directory
+            removed = yield threads.deferToThread(remove_stale_dirs, os.path.join(preexec_path, arch), set(), preexec_cutoff)
+            if len(removed) > 0:
+                log.msg("Removed {} unused preexec outputs".format(len(removed)))
+        yield self.save_usage()
+        if self.budget is None:
+            return
+        free = yield self.get_free_space()
+        if free >= self.budget:
+            return
+        yield self.prune_dangling()
+        candidates = yield self.list_images()
+        candidates.sort(key=lambda t: self.last_built.get(t, 0))
+        for tag in candidates:
+            free = yield self.get_free_space()
+            if free >= self.budget:
+                break
+            if tag in tags:
+                # used by a running job
+                continue
+            exitcode = yield self._docker(["docker", "image", "rm", tag])
+            if exitcode == 0:
+                log.msg("Removed image " + tag)
+                self.last_built.pop(tag, None)
+                yield self.prune_dangling()
+        yield self.save_usage()
+
+    @defer.inlineCallbacks
+    def get_free_space(self):
+        """
+        Return the free space of the filesystems containing the workspaces and the docker data.
+        :return: a deferred which will fire with the number of free bytes
+        :rtype: Deferred
+        """
+        if self.docker_root is None:
+            protocol = CollectingProcessProtocol()
+            exitcode = yield self._docker(["docker", "info", "--format", "{{.DockerRootDir}}"], protocol)
+            root = protocol.stdout.strip()
+            if exitcode == 0 and os.path.isdir(root):
+                self.docker_root = root
+            else:
+                # remote docker daemon or no access
+                self.docker_root = self.tempdir
+        free = yield threads.deferToThread(lambda: min(get_free_space(self.tempdir), get_free_space(self.docker_root)))
+        defer.returnValue(free)
+
+    @defer.inlineCallbacks
+    def list_images(self):
+        """
+        Return the tags of the images built by fbad.
+        :return: a deferred which will fire with a list of tags
+        :rtype: Deferred
+        """
+        protocol = CollectingProcessProtocol()
+        exitcode = yield self._docker(
+            ["docker", "image", "ls", "--filter", "label=" + constants.IMAGE_LABEL, "--format", "{{.Repository}}:{{.Tag}}"],
+            protocol,
+            )
+        if exitcode != 0:
+            defer.returnValue([])
+        tags = []
+        for line in protocol.stdout.splitlines():
+            line = line.strip()
+            if line and "<none>" not in line:
+                tags.append(line)
+        defer.returnValue(tags)
+
+    def prune_dangling(self):
+        """
+        Remove dangling images built by fbad.
+        :return: a deferred which will fire with the exitcode
+        :rtype: Deferred
+        """
+        return self._docker(["docker", "image", "prune", "-f", "--filter", "label=" + constants.IMAGE_LABEL])
+
+    def _docker(self, command, protocol=None):
+        """
+        Run a docker command, collecting its output.
+        :param command: the command
+        :type command: list of str
+        :param protocol: protocol to collect the output with
+        :type protocol: CollectingProcessProtocol or None
+        :return: a deferred which will fire with the exitcode
+        :rtype: Deferred
+        """
+        if protocol is None:
+            protocol = CollectingProcessProtocol()
+        return run_command(
+            path=self.tempdir,
+            executable=get_docker_executable(),
+            command=command,
+            protocolfactory=lambda: protocol,
+            )
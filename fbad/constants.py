@@ -1,6 +1,5 @@
 """various constants"""
 import struct
-import subprocess
 
 ENCODING = "UTF-8"
 
@@ -10,21 +9,68 @@ DEFAULT_PORT = 28847
 MESSAGE_LENGTH_PREFIX = "!I"
 MESSAGE_LENGTH_PREFIX_LENGTH = struct.calcsize(MESSAGE_LENGTH_PREFIX)
 MAX_MESSAGE_LENGTH = 130 * 1024  # 130 KB
-COM_VERSION = "0.2"
+COM_VERSION = "0.4"
 
 AUTH_SEED_LENGTH = 16
 
 MESSAGE_PREFIX_CONTINUE = "\x00"
 MESSAGE_PREFIX_END = "\x01"
+MESSAGE_PREFIX_CANCEL = "\x02"  # ends an upload and cancels its job
+
+HEARTBEAT_MESSAGE = ""
+HEARTBEAT_INTERVAL = 3  # seconds
+HEARTBEAT_TIMEOUT = 15  # seconds
+KILL_TIMEOUT = 10  # seconds between SIGTERM and SIGKILL
 
 READ_CHUNK_SIZE = 8192
 
-try:
-    DOCKER_EXECUTABLE = subprocess.check_output(["which", "docker"])[:-1]
-except:
-    DOCKER_EXCUTABLE = "/usr/bin/docker"
+PREFETCH_CONCURRENCY = 4
+PUSH_CONCURRENCY = 4
+PREEXEC_CONCURRENCY = 4
+DEFAULT_IMAGE_CPUS = 1.0  # CPUs an image needs if it does not declare them
+DEFAULT_IMAGE_MEMORY = 1024 ** 3  # bytes of memory an image needs if it does not declare them
+RESOURCE_MAX_BYPASS = 8  # builds started before a waiting build which does not fit yet
+CPU_PERIOD = 100000  # microseconds, used to limit the CPUs of builds
+
+RAM_WORKSPACE_THRESHOLD = 256 * 1024 ** 2  # bytes, larger workspaces are placed on disk
+RAM_WORKSPACE_BUDGET_FRACTION = 0.25  # of the physical memory, if no budget was specified
+
+PREEXEC_CACHE_DIR_NAME = "fbad_preexec"
+BUILDX_BUILDER_NAME = "fbad"  # buildx builder used with a layer cache, created if missing
+
+WATCH_DEBOUNCE = 0.5  # seconds
+WATCH_IGNORE = (".git", ".hg", ".svn")
+
+JOB_DIR_NAME = "fbad_jobs"
+JOB_LOG_SEGMENT_SIZE = 1024 * 1024  # 1 MB
+JOB_LOG_MAX_SEGMENTS = 16
+JOB_MAX_FINISHED = 64
+
+METRICS_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)  # seconds
+
+LOOP_STATS_INTERVAL = 1.0  # seconds
+
+IMAGE_LABEL = "fbad"  # label of all images built by fbad
+IMAGE_USAGE_FILE_NAME = "fbad_images.json"
+COLLECT_INTERVAL = 10 * 60  # seconds
+COLLECT_MIN_AGE = 60 * 60  # seconds
+PREEXEC_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # seconds since preexec outputs were last used
+
+DEFAULT_BROKER_PORT = 28848
+BROKER_JOB_DIR_NAME = "fbad_broker_jobs"
+BROKER_LOAD_INTERVAL = 5  # seconds between load reports of buildservers
+BROKER_RECONNECT_DELAY = 10  # seconds
+BROKER_MAX_ATTEMPTS = 3  # dispatches of an image before a broker job fails
+
+DISTRIBUTE_CONCURRENCY = 4  # buildservers to send images to concurrently
+
+DAEMON_SOCKET_NAME = "fbad-daemon.sock"
+DAEMON_SESSION_TIMEOUT = 30 * 60  # seconds after the last build to close a session of the client daemon
+DAEMON_HASH_CHUNK_SIZE = 64 * 1024
+DAEMON_MAX_MESSAGE_LENGTH = 4 * MAX_MESSAGE_LENGTH  # output is wrapped again by the daemon
+
+SWARM_STATE_MAX_AGE = 5 * 60  # seconds to cache whether a docker host is part of a swarm
 
-try:
-    DOCKER_COMPOSE_EXECUTABLE = subprocess.check_output(["which", "docker-compose"])[:-1]
-except:
-    DOCKER_COMPOSE_EXECUTABLE = "/usr/bin/docker-compose"
+# used if the executables are not found in the PATH
+DEFAULT_DOCKER_EXECUTABLE = "/usr/bin/docker"
+DEFAULT_DOCKER_COMPOSE_EXECUTABLE = "/usr/bin/docker-compose"
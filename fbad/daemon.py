@@ -0,0 +1,581 @@
+"""
+this module implements the client daemon.
+The daemon keeps authenticated sessions to the buildservers and the hashes of the files of the
+projects between builds, so a build only needs to send the files changed since the previous build.
+The command line of a project sends its builds to the daemon using a unix socket.
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+from twisted.internet import defer, threads, endpoints
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import IntNStringReceiver
+from twisted.python import log
+
+from fbad import constants, client, errors
+from fbad.timing import BuildReport
+
+
+def get_socket_path():
+    """
+    Return the default path of the unix socket of the client daemon of the current user.
+    :return: the path of the socket
+    :rtype: str
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", None)
+    if runtime_dir is not None and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, constants.DAEMON_SOCKET_NAME)
+    return os.path.join(tempfile.gettempdir(), "{}-{}".format(constants.DAEMON_SOCKET_NAME, os.getuid()))
+
+
+def hash_file(path):
+    """
+    Return the sha256 hexdigest of the content of a file.
+    :param path: path of the file
+    :type path: str or unicode
+    :return: the hexdigest
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as fin:
+        while True:
+            data = fin.read(constants.DAEMON_HASH_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def get_changes(old, new):
+    """
+    Compare two sets of file hashes.
+    :param old: dict of path -> hash
+    :type old: dict
+    :param new: dict of path -> hash
+    :type new: dict
+    :return: a tuple of (paths which were added or changed, paths which were removed)
+    :rtype: tuple of (list of str, list of str)
+    """
+    changed = [p for p, h in new.items() if old.get(p, None) != h]
+    deleted = [p for p in old.keys() if p not in new]
+    return sorted(changed), sorted(deleted)
+
+
+class FileIndex(object):
+    """
+    The hashes of the files of a project directory.
+    Files are only hashed again if their size or modification time changed.
+    :param root: path of the project directory
+    :type root: str or unicode
+    """
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}  # path -> (size, mtime, hash)
+        self.lock = defer.DeferredLock()
+
+    def update(self):
+        """
+        Update the index in a thread.
+        :return: a deferred which will fire with a dict of path (relative to the root) -> hash
+        :rtype: Deferred
+        """
+        return self.lock.run(threads.deferToThread, self.scan)
+
+    def scan(self):
+        """
+        Update the index.
+        Symlinked directories are followed, like they are when the project is archived.
+        :return: a dict of path (relative to the root) -> hash
+        :rtype: dict
+        """
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(self.root, followlinks=True):
+            for fn in filenames:
+                fp = os.path.join(dirpath, fn)
+                rp = os.path.relpath(fp, self.root)
+                try:
+                    st = os.stat(fp)
+                except OSError:
+                    # removed in the meantime or broken symlink
+                    continue
+                entry = self.entries.get(rp, None)
+                if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+                    try:
+                        entry = (st.st_size, st.st_mtime, hash_file(fp))
+                    except (IOError, OSError):
+                        continue
+                entries[rp] = entry
+        self.entries = entries
+        return dict([(rp, entry[2]) for rp, entry in entries.items()])
+
+
+class Session(object):
+    """
+    A connection to a buildserver keeping the files of a project between builds.
+    The first build uploads the whole project, later builds only upload the changed files.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param host: host of the buildserver
+    :type host: str
+    :param port: port of the buildserver
+    :type port: int
+    :param password: password for the buildserver
+    :type password: str or None
+    :param timeout: seconds after the last build to close the session
+    :type timeout: float
+    """
+    def __init__(self, reactor, host, port, password=None, timeout=constants.DAEMON_SESSION_TIMEOUT):
+        self.reactor = reactor
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.client = None  # connected FBADClientProtocol
+        self.project_data = None  # the serialized project the session was opened with
+        self.files = None  # hashes of the files the buildserver has
+        self.lock = defer.DeferredLock()
+        self.expire_call = None
+
+    @property
+    def label(self):
+        """the name of the buildserver in reports"""
+        return "{}:{}".format(self.host, self.port)
+
+    @property
+    def connected(self):
+        """True if the connection to the buildserver is open"""
+        return self.client is not None and self.client.state not in (self.client.STATE_IGNORE, self.client.STATE_ERROR)
+
+    def build(self, project, files, only, out, push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY):
+        """
+        Build images of a project on the buildserver.
+        Builds using the same session are run one after another.
+        :param project: the project to build
+        :type project: Project
+        :param files: hashes of the current files of the project, as returned by FileIndex.update()
+        :type files: dict
+        :param only: which images to build
+        :type only: list
+        :param out: file to write output to
+        :type out: file-like object
+        :param push: whether to push built images to registry or not
+        :type push: bool
+        :param deploy: whether to deploy project after the build or not.
+        :type deploy: bool
+        :param push_concurrency: maximum number of images to push concurrently
+        :type push_concurrency: int
+        :return: a deferred which will fire with a tuple of (exitcodes, BuildStats)
+        :rtype: Deferred
+        """
+        return self.lock.run(self._build, project, files, only, out, push=push, deploy=deploy, push_concurrency=push_concurrency)
+
+    @defer.inlineCallbacks
+    def _build(self, project, files, only, out, push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY):
+        """
+        Build images of a project on the buildserver.
+        See Session.build() for the arguments.
+        :return: a deferred which will fire with a tuple of (exitcodes, BuildStats)
+        :rtype: Deferred
+        """
+        if self.expire_call is not None and self.expire_call.active():
+            self.expire_call.cancel()
+        data = project.dumps()
+        try:
+            with project.get_temp_build_dir() as p:
+                zp = os.path.join(p, "up.zip")
+                if not self.connected or data != self.project_data:
+                    # (re)open the session by uploading the whole project
+                    self.close()
+                    self.client = yield client.connect(self.reactor, self.host, self.port, password=self.password, out=out)
+                    self.project_data = data
+                    start = time.time()
+                    yield threads.deferToThread(project.create_zip, zp)
+                    archive_time = time.time() - start
+                    prefetch = project.get_base_images(only=only)
+                    exitcodes = yield self.client.remote_build(project, zp, only=only, push=push, deploy=deploy, prefetch=prefetch, push_concurrency=push_concurrency, keep=True)
+                else:
+                    self.client.out = out
+                    changed, deleted = get_changes(self.files, files)
+                    start = time.time()
+                    deleted += yield threads.deferToThread(project.create_partial_zip, zp, changed)
+                    archive_time = time.time() - start
+                    exitcodes = yield self.client.remote_update(zp, deleted=deleted, only=only, push=push, deploy=deploy, push_concurrency=push_concurrency)
+        except Exception:
+            # the files of the session are unknown, start a new one next time
+            self.close()
+            raise
+        self.files = files
+        stats = self.client.stats
+        stats.add("archive", archive_time)
+        self.expire_call = self.reactor.callLater(self.timeout, self.close)
+        defer.returnValue((exitcodes, stats))
+
+    def cancel(self):
+        """
+        Cancel the build currently running in this session.
+        """
+        if self.connected:
+            self.client.cancel_build()
+
+    def close(self):
+        """
+        Close the session.
+        """
+        if self.expire_call is not None and self.expire_call.active():
+            self.expire_call.cancel()
+        self.expire_call = None
+        if self.connected:
+            self.client.disconnect()
+        self.client = None
+        self.project_data = None
+        self.files = None
+
+
+class ClientDaemon(object):
+    """
+    Keeps the sessions to the buildservers and the file indexes of the projects between builds.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param session_timeout: seconds after the last build to close a session
+    :type session_timeout: float
+    """
+    def __init__(self, reactor, session_timeout=constants.DAEMON_SESSION_TIMEOUT):
+        self.reactor = reactor
+        self.session_timeout = session_timeout
+        self.sessions = {}  # (host, port, password, project path) -> Session
+        self.indexes = {}  # project path -> FileIndex
+
+    def get_index(self, path):
+        """
+        Return the file index of a project directory.
+        :param path: path of the project directory
+        :type path: str or unicode
+        :return: the index
+        :rtype: FileIndex
+        """
+        if path not in self.indexes:
+            self.indexes[path] = FileIndex(path)
+        return self.indexes[path]
+
+    def get_session(self, host, port, password, path):
+        """
+        Return the session with a buildserver for a project directory.
+        :param host: host of the buildserver
+        :type host: str
+        :param port: port of the buildserver
+        :type port: int
+        :param password: password for the buildserver
+        :type password: str or None
+        :param path: path of the project directory
+        :type path: str or unicode
+        :return: the session
+        :rtype: Session
+        """
+        key = (host, port, password, path)
+        if key not in self.sessions:
+            self.sessions[key] = Session(self.reactor, host, port, password=password, timeout=self.session_timeout)
+        return self.sessions[key]
+
+    @defer.inlineCallbacks
+    def build(self, project, hosts, port, out, password=None, only=None, buildmode="parallel", push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, sessions=None):
+        """
+        Build a project on the specified buildservers.
+        :param project: the project to build, with project_path set
+        :type project: Project
+        :param hosts: hosts of the buildservers
+        :type hosts: list of str
+        :param port: port of the buildservers
+        :type port: int
+        :param out: file to write output to
+        :type out: file-like object
+        :param password: password for the buildservers
+        :type password: str or None
+        :param only: which images to build
+        :type only: list or None
+        :param buildmode: how to build images if more than one buildserver is specified ("parallel" or "multi")
+        :type buildmode: str
+        :param push: whether to push built images to registry or not
+        :type push: bool
+        :param deploy: whether to deploy project after the build or not.
+        :type deploy: bool
+        :param push_concurrency: maximum number of images to push concurrently
+        :type push_concurrency: int
+        :param sessions: if not None, the sessions used by the build are added to this list
+        :type sessions: list or None
+        :return: a deferred which will fire with a tuple of (exitcodes, BuildReport)
+        :rtype: Deferred
+        """
+        from fbad.project import _get_parallel_batches  # import here so the project module can import this module
+        path = os.path.abspath(project.project_path)
+        files = yield self.get_index(path).update()
+        if only is None:
+            only = [image.name for image in project.images]
+        assigned = []  # list of (host, names)
+        if buildmode == "multi":
+            assigned = [(host, list(only)) for host in hosts]
+        else:
+            for host, batch in _get_parallel_batches(project, hosts, only):
+                for h, names in assigned:
+                    if h == host:
+                        names.extend(batch)
+                        break
+                else:
+                    assigned.append((host, batch))
+        used = []
+        ds = []
+        for i, (host, names) in enumerate(assigned):
+            session = self.get_session(host, port, password, path)
+            used.append(session)
+            if sessions is not None:
+                sessions.append(session)
+            d = session.build(project, files, names, out, push=push, deploy=(deploy and i == 0), push_concurrency=push_concurrency)
+            ds.append(d)
+        try:
+            results = yield defer.gatherResults(ds, consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+        report = BuildReport()
+        exitcodes = []
+        for session, (ecs, stats) in zip(used, results):
+            exitcodes += ecs
+            report.add(session.label, stats)
+        defer.returnValue((exitcodes, report))
+
+    def stop(self):
+        """
+        Close all sessions.
+        """
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+
+class DaemonOutput(object):
+    """
+    A file-like object sending everything written to it to the command line connected to the daemon.
+    :param protocol: the connection to the command line
+    :type protocol: DaemonProtocol
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def write(self, data):
+        """
+        Send output.
+        :param data: the output
+        :type data: str
+        """
+        if data:
+            self.protocol.send_json({"type": "msg", "message": data})
+
+    def flush(self):
+        """
+        Does nothing, provided for compatibility with files.
+        """
+        pass
+
+
+class DaemonProtocol(IntNStringReceiver):
+    """
+    The protocol of the daemon for the connections of the command line.
+    Each connection sends a single build command and receives the output and the result of the build.
+    """
+    structFormat = constants.MESSAGE_LENGTH_PREFIX
+    prefixLength = constants.MESSAGE_LENGTH_PREFIX_LENGTH
+    MAX_LENGTH = constants.DAEMON_MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        """
+        Called when the command line connected.
+        """
+        self.sessions = []  # sessions used by the current build
+        self.connected = True
+
+    def connectionLost(self, reason):
+        """
+        Called when the command line disconnected.
+        A build which is still running is cancelled.
+        :param reason: reason the connection was lost
+        :type reason: Failure
+        """
+        self.connected = False
+        for session in self.sessions:
+            session.cancel()
+
+    def send_json(self, data):
+        """
+        Send a message to the command line.
+        :param data: the message
+        :type data: dict
+        """
+        if self.connected:
+            self.sendString(json.dumps(data).encode(constants.ENCODING))
+
+    def stringReceived(self, msg):
+        """
+        Called when a string was received.
+        :param msg: the received string
+        :type msg: str
+        """
+        try:
+            info = json.loads(msg)
+        except ValueError:
+            self.transport.loseConnection()
+            return
+        if info.get("command", None) == "build":
+            self.handle_build(info)
+        else:
+            self.send_json({"type": "error", "message": "Unknown command!"})
+            self.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def handle_build(self, info):
+        """
+        Handle a build command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        from fbad.project import Project  # import here so the project module can import this module
+        try:
+            project = Project.loads(info["project"])
+            project.project_path = info["path"]
+            password = info.get("password", None)
+            if password is not None:
+                password = password.encode(constants.ENCODING)
+            exitcodes, report = yield self.factory.daemon.build(
+                project,
+                [host.encode(constants.ENCODING) for host in info["hosts"]],
+                info.get("port", constants.DEFAULT_PORT),
+                DaemonOutput(self),
+                password=password,
+                only=info.get("only", None),
+                buildmode=info.get("buildmode", "parallel"),
+                push=info.get("push", False),
+                deploy=info.get("deploy", False),
+                push_concurrency=info.get("push_concurrency", constants.PUSH_CONCURRENCY),
+                sessions=self.sessions,
+                )
+        except Exception as e:
+            log.err(None, "Error building project")
+            self.send_json({"type": "error", "message": str(e) or e.__class__.__name__})
+        else:
+            self.send_json({"type": "finish", "exitcodes": exitcodes, "report": report.to_dict()})
+        self.sessions = []
+        self.transport.loseConnection()
+
+
+class DaemonFactory(Factory):
+    """
+    Factory for the connections of the command line to the daemon.
+    :param daemon: the daemon to run the builds with
+    :type daemon: ClientDaemon
+    """
+    protocol = DaemonProtocol
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+
+class DaemonClientProtocol(IntNStringReceiver):
+    """
+    The protocol of the command line for the connection to the daemon.
+    :param command: the build command to send
+    :type command: dict
+    :param out: file to write the output of the build to
+    :type out: file-like object
+    """
+    structFormat = constants.MESSAGE_LENGTH_PREFIX
+    prefixLength = constants.MESSAGE_LENGTH_PREFIX_LENGTH
+    MAX_LENGTH = constants.DAEMON_MAX_MESSAGE_LENGTH
+
+    def __init__(self, command, out):
+        self.command = command
+        self.out = out
+        self.d = defer.Deferred()
+
+    def connectionMade(self):
+        """
+        Called when the connection to the daemon was established.
+        """
+        self.sendString(json.dumps(self.command).encode(constants.ENCODING))
+
+    def stringReceived(self, msg):
+        """
+        Called when a string was received.
+        :param msg: the received string
+        :type msg: str
+        """
+        data = json.loads(msg)
+        ty = data["type"]
+        if ty == "msg":
+            self.out.write(data["message"])
+        elif ty == "finish":
+            d, self.d = self.d, None
+            d.callback((data["exitcodes"], data["report"]))
+        elif ty == "error":
+            d, self.d = self.d, None
+            d.errback(errors.RemoteError(data.get("message", "Unknown error")))
+
+    def connectionLost(self, reason):
+        """
+        Called when the connection was lost.
+        :param reason: reason the connection was lost
+        :type reason: Failure
+        """
+        if self.d is not None:
+            d, self.d = self.d, None
+            d.errback(reason)
+
+
+@defer.inlineCallbacks
+def build_with_daemon(reactor, socket_path, project, hosts, port, out, password=None, only=None, buildmode="parallel", push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY):
+    """
+    Build a project using the client daemon.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param socket_path: path of the unix socket of the daemon
+    :type socket_path: str
+    :param project: the project to build
+    :type project: Project
+    :param hosts: hosts of the buildservers
+    :type hosts: list of str
+    :param port: port of the buildservers
+    :type port: int
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildservers
+    :type password: str or None
+    :param only: which images to build
+    :type only: list or None
+    :param buildmode: how to build images if more than one buildserver is specified ("parallel" or "multi")
+    :type buildmode: str
+    :param push: whether to push built images to registry or not
+    :type push: bool
+    :param deploy: whether to deploy project after the build or not.
+    :type deploy: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :return: a deferred which will fire with a tuple of (exitcodes, BuildReport)
+    :rtype: Deferred
+    """
+    command = {
+        "command": "build",
+        "project": project.dumps(),
+        "path": os.path.abspath(project.project_path),
+        "hosts": hosts,
+        "port": port,
+        "password": password,
+        "only": only,
+        "buildmode": buildmode,
+        "push": push,
+        "deploy": deploy,
+        "push_concurrency": push_concurrency,
+        }
+    proto = DaemonClientProtocol(command, out)
+    ep = endpoints.UNIXClientEndpoint(reactor, socket_path)
+    yield endpoints.connectProtocol(ep, proto)
+    exitcodes, rdata = yield proto.d
+    defer.returnValue((exitcodes, BuildReport.from_dict(rdata)))
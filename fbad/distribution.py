@@ -0,0 +1,231 @@
+"""
+this module implements the distribution of built images to other buildservers without a registry.
+The images are exported using 'docker save'. Layers the receiving docker daemon already has are
+left out of the archive, as 'docker load' only reads the layers it does not have.
+"""
+import os
+import json
+import hashlib
+import tarfile
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from fbad import constants
+from fbad.shutils import run_command, CollectingProcessProtocol
+from fbad.dockerutils import get_docker_executable
+
+
+def get_chain_ids(diff_ids):
+    """
+    Return the chain ids of layers, which identify a layer including all layers below it.
+    :param diff_ids: the diff ids of the layers, lowest layer first
+    :type diff_ids: list of str
+    :return: the chain ids
+    :rtype: list of str
+    """
+    chain_ids = []
+    for diff_id in diff_ids:
+        if len(chain_ids) == 0:
+            chain_ids.append(diff_id)
+        else:
+            chain_ids.append("sha256:" + hashlib.sha256(chain_ids[-1] + " " + diff_id).hexdigest())
+    return chain_ids
+
+
+def read_saved_layers(path):
+    """
+    Read the layers of the images in an archive written by 'docker save'.
+    :param path: path of the archive
+    :type path: str or unicode
+    :return: a list of (path of the layer in the archive, chain id) tuples
+    :rtype: list of tuple of (str, str)
+    """
+    layers = []
+    with tarfile.open(path, "r") as tf:
+        manifest = json.load(tf.extractfile("manifest.json"))
+        for entry in manifest:
+            config = json.load(tf.extractfile(entry["Config"]))
+            chain_ids = get_chain_ids(config["rootfs"]["diff_ids"])
+            layers += zip(entry["Layers"], chain_ids)
+    return layers
+
+
+def get_missing_layers(layers, present):
+    """
+    Return the paths of the layers a docker daemon needs to load the archive.
+    :param layers: the layers of the archive, as returned by read_saved_layers()
+    :type layers: list of tuple of (str, str)
+    :param present: chain ids of the layers the docker daemon has
+    :type present: set of str
+    :return: the paths of the required layers
+    :rtype: set of str
+    """
+    return set([lp for lp, chain_id in layers if chain_id not in present])
+
+
+def write_partial_archive(src, dest, layers, required):
+    """
+    Copy an archive written by 'docker save', leaving out the layers which are not required.
+    :param src: path of the archive
+    :type src: str or unicode
+    :param dest: path to write the copy to
+    :type dest: str or unicode
+    :param layers: the layers of the archive, as returned by read_saved_layers()
+    :type layers: list of tuple of (str, str)
+    :param required: paths of the layers to include
+    :type required: set of str
+    """
+    skip = set([lp for lp, chain_id in layers]) - required
+    with tarfile.open(src, "r") as tin:
+        with tarfile.open(dest, "w") as tout:
+            for member in tin:
+                if member.name in skip:
+                    continue
+                if member.isfile():
+                    tout.addfile(member, tin.extractfile(member))
+                else:
+                    tout.addfile(member)
+
+
+class Distributor(object):
+    """
+    Sends built images directly to other buildservers, which load them into their docker daemon.
+    Each buildserver only receives the layers it does not have yet and all buildservers receive
+    and load the images concurrently.
+    :param password: password for the buildservers
+    :type password: str or None
+    :param concurrency: maximum number of buildservers to send images to concurrently
+    :type concurrency: int
+    """
+    def __init__(self, password=None, concurrency=constants.DISTRIBUTE_CONCURRENCY):
+        self.password = password
+        self.concurrency = concurrency
+
+    @defer.inlineCallbacks
+    def distribute(self, tags, targets, path, send_message):
+        """
+        Send images to buildservers.
+        Errors are reported using send_message, but not raised.
+        :param tags: tags of the images to send
+        :type tags: list of str
+        :param targets: list of (host, port) tuples of the buildservers
+        :type targets: list of tuple of (str, int)
+        :param path: directory to store the archives in
+        :type path: str or unicode
+        :param send_message: callable to call with messages about the progress
+        :type send_message: callable
+        :return: a deferred which will fire with the number of buildservers which loaded the images
+        :rtype: Deferred
+        """
+        if len(tags) == 0 or len(targets) == 0:
+            defer.returnValue(0)
+        ap = os.path.join(path, "images.tar")
+        protocol = CollectingProcessProtocol()
+        exitcode = yield run_command(
+            path=path,
+            executable=get_docker_executable(),
+            command=["docker", "save", "-o", ap] + list(tags),
+            protocolfactory=lambda: protocol,
+            )
+        if exitcode != 0:
+            send_message("Could not save images for distribution: {}\n".format(protocol.output.strip()))
+            defer.returnValue(0)
+        layers = yield threads.deferToThread(read_saved_layers, ap)
+        total = len(set([lp for lp, chain_id in layers]))
+
+        # ask each buildserver which layers it has
+        ds = []
+        for host, port in targets:
+            d = self._query(host, port, layers)
+            d.addErrback(self._report_error, host, port, send_message)
+            ds.append(d)
+        queried = [r for r in (yield defer.gatherResults(ds)) if r]
+        try:
+            # buildservers requiring the same layers share an archive
+            archives = {}
+            for target, host, port, required in queried:
+                if len(required) == total:
+                    archives[required] = ap
+                elif required not in archives:
+                    pp = os.path.join(path, "images-{}.tar".format(len(archives)))
+                    yield threads.deferToThread(write_partial_archive, ap, pp, layers, required)
+                    archives[required] = pp
+            sem = defer.DeferredSemaphore(self.concurrency)
+            ds = []
+            for target, host, port, required in queried:
+                send_message("Sending {} of {} layers to {}:{}\n".format(len(required), total, host, port))
+                d = sem.run(self._send, target, host, port, archives[required], send_message)
+                d.addErrback(self._report_error, host, port, send_message)
+                ds.append(d)
+            results = yield defer.gatherResults(ds)
+        finally:
+            for target, host, port, required in queried:
+                target.disconnect()
+        defer.returnValue(len([r for r in results if r]))
+
+    @defer.inlineCallbacks
+    def _query(self, host, port, layers):
+        """
+        Connect to a buildserver and determine the layers it requires.
+        :param host: host of the buildserver
+        :type host: str
+        :param port: port of the buildserver
+        :type port: int
+        :param layers: the layers of the archive, as returned by read_saved_layers()
+        :type layers: list of tuple of (str, str)
+        :return: a deferred which will fire with a tuple of (connected FBADClientProtocol, host, port, required layers)
+        :rtype: Deferred
+        """
+        from twisted.internet import reactor
+        from fbad.client import connect
+        target = yield connect(reactor, host, port, password=self.password)
+        try:
+            image_layers = yield target.get_image_layers()
+        except Exception:
+            target.disconnect()
+            raise
+        present = set()
+        for diff_ids in image_layers:
+            present.update(get_chain_ids(diff_ids))
+        defer.returnValue((target, host, port, frozenset(get_missing_layers(layers, present))))
+
+    @defer.inlineCallbacks
+    def _send(self, target, host, port, path, send_message):
+        """
+        Send an archive to a buildserver and wait until the images were loaded.
+        :param target: the connection to the buildserver
+        :type target: FBADClientProtocol
+        :param host: host of the buildserver
+        :type host: str
+        :param port: port of the buildserver
+        :type port: int
+        :param path: path of the archive
+        :type path: str or unicode
+        :param send_message: callable to call with messages about the progress
+        :type send_message: callable
+        :return: a deferred which will fire with True when the images were loaded
+        :rtype: Deferred
+        """
+        output = yield target.send_images(path)
+        send_message("Loaded images on {}:{}: {}\n".format(host, port, output.strip()))
+        defer.returnValue(True)
+
+    def _report_error(self, failure, host, port, send_message):
+        """
+        Report an error sending images to a buildserver.
+        :param failure: the error
+        :type failure: Failure
+        :param host: host of the buildserver
+        :type host: str
+        :param port: port of the buildserver
+        :type port: int
+        :param send_message: callable to call with the message
+        :type send_message: callable
+        :return: None
+        :rtype: None
+        """
+        msg = "Could not distribute images to {}:{}: {}".format(host, port, failure.getErrorMessage())
+        log.msg(msg)
+        send_message(msg + "\n")
+        return None
@@ -1,14 +1,454 @@
 """utilities for interacting with docker."""
+import os
+import re
+import json
+import time
+import tempfile
+import posixpath
 import subprocess
+from distutils.spawn import find_executable
 
+from twisted.internet import defer
+from twisted.python import log
 
-def in_swarm():
+from fbad import constants
+from fbad.errors import BuilderError
+from fbad.shutils import run_command, CollectingProcessProtocol
+
+_executables = {}
+_swarm_states = {}  # docker host -> (active, time of the check)
+
+
+def get_executable(name, default):
+    """
+    Return the path of an executable.
+    The PATH is only searched on the first call for each executable.
+    :param name: name of the executable
+    :type name: str
+    :param default: path to return if the executable was not found
+    :type default: str
+    :return: the path of the executable
+    :rtype: str
+    """
+    if name not in _executables:
+        path = find_executable(name)
+        _executables[name] = (path if path is not None else default)
+    return _executables[name]
+
+
+def get_docker_executable():
+    """
+    Return the path of the docker executable.
+    :return: the path of the executable
+    :rtype: str
+    """
+    return get_executable("docker", constants.DEFAULT_DOCKER_EXECUTABLE)
+
+
+def get_docker_compose_executable():
+    """
+    Return the path of the docker-compose executable.
+    :return: the path of the executable
+    :rtype: str
+    """
+    return get_executable("docker-compose", constants.DEFAULT_DOCKER_COMPOSE_EXECUTABLE)
+
+
+def parse_buildx_driver(output):
+    """
+    Parse the driver of a builder from the output of 'docker buildx inspect'.
+    :param output: the output of 'docker buildx inspect'
+    :type output: str
+    :return: the driver or None if not found
+    :rtype: str or None
+    """
+    match = re.search(r"^Driver:\s*(\S+)", output, re.MULTILINE)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def setup_buildx_builder(name=constants.BUILDX_BUILDER_NAME):
+    """
+    Make sure a buildx builder which can export build caches exists.
+    If no builder with this name exists, one using the 'docker-container' driver is created.
+    The 'docker' driver of the default builder does not support exporting caches.
+    This is called once when the buildserver starts, so it blocks.
+    :param name: name of the builder
+    :type name: str
+    :raises BuilderError: if the builder could not be created or uses the 'docker' driver
+    """
+    docker = get_docker_executable()
+    try:
+        output = subprocess.check_output([docker, "buildx", "inspect", name], stderr=subprocess.STDOUT)
+    except OSError as e:
+        raise BuilderError("Could not run docker: " + str(e))
+    except subprocess.CalledProcessError:
+        # the builder does not exist yet
+        command = [docker, "buildx", "create", "--name", name, "--driver", "docker-container"]
+        try:
+            subprocess.check_output(command, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise BuilderError("Could not create buildx builder '{}': {}".format(name, e.output.strip()))
+        return
+    if parse_buildx_driver(output) == "docker":
+        raise BuilderError("buildx builder '{}' uses the 'docker' driver, which can not export build caches".format(name))
+
+
+def get_host_options(host):
+    """
+    Return the options selecting a docker host for docker and docker-compose.
+    :param host: the docker host (e.g. 'ssh://user@manager' or 'tcp://10.0.0.2:2376') or None for the local daemon
+    :type host: str or None
+    :return: the options
+    :rtype: list of str
+    """
+    if host is None:
+        return []
+    return ["--host", host]
+
+
+@defer.inlineCallbacks
+def get_swarm_state(host=None, max_age=constants.SWARM_STATE_MAX_AGE):
+    """
+    Check whether a docker daemon is running in swarm mode, without blocking.
+    The result is cached per docker host for max_age seconds.
+    :param host: the docker host or None for the local daemon
+    :type host: str or None
+    :param max_age: seconds to use a cached result for
+    :type max_age: float
+    :return: a deferred which will fire with True when running in swarm mode, False otherwise.
+    :rtype: Deferred
+    """
+    now = time.time()
+    if host in _swarm_states:
+        active, checked = _swarm_states[host]
+        if now - checked < max_age:
+            defer.returnValue(active)
+    protocol = CollectingProcessProtocol()
+    exitcode = yield run_command(
+        path=tempfile.gettempdir(),
+        executable=get_docker_executable(),
+        command=["docker"] + get_host_options(host) + ["info", "--format", "{{.Swarm.LocalNodeState}}"],
+        protocolfactory=lambda: protocol,
+        )
+    active = (exitcode == 0 and protocol.stdout.strip() == "active")
+    _swarm_states[host] = (active, now)
+    defer.returnValue(active)
+
+
+def _unquote(value):
+    """
+    Remove the quotes around a YAML scalar.
+    :param value: the value
+    :type value: str
+    :return: the unquoted value
+    :rtype: str
+    """
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        value = value[1:-1]
+    return value
+
+
+def parse_compose_references(content):
+    """
+    Parse the content of a docker-compose.yml and return the files it references,
+    i.e. env files as well as the files of configs, secrets and extended services.
+    This does not fully parse YAML, but handles the usual block and flow styles.
+    References containing variables are not included.
+    :param content: content of the docker-compose.yml
+    :type content: str or unicode
+    :return: list of paths, relative to the directory of the compose file
+    :rtype: list of str
     """
-    Check whether docker is running in swarm mode.
-    :return: True when running in swarm mode, False otherwise.
-    :rtype: bool
+    paths = []
+    list_indent = None  # indentation of an env_file key followed by a block list
+    for line in content.splitlines():
+        if line.lstrip().startswith("#") or line.strip() == "":
+            continue
+        line = re.sub(r"\s+#.*$", "", line).rstrip()
+        indent = len(line) - len(line.lstrip())
+        if list_indent is not None:
+            match = re.match(r"^\s*-\s*(?:path\s*:\s*)?(.+)$", line)
+            if match is not None and indent >= list_indent:
+                paths.append(_unquote(match.group(1)))
+                continue
+            list_indent = None
+        match = re.match(r"^(\s*)(env_file|file)\s*:\s*(.*)$", line)
+        if match is None:
+            continue
+        value = match.group(3).strip()
+        if value == "" and match.group(2) == "env_file":
+            list_indent = len(match.group(1))
+        elif value.startswith("["):
+            paths += [_unquote(v) for v in value.strip("[]").split(",") if v.strip()]
+        elif value != "":
+            paths.append(_unquote(value))
+    result = []
+    for p in paths:
+        if "$" in p or p in result:
+            continue
+        result.append(p)
+    return result
+
+
+def extract_compose_files(zf, compose_file, dest):
+    """
+    Extract a docker-compose.yml, the .env file next to it and the files it references from a zipfile.
+    Referenced files which are not in the zipfile or outside of it are skipped.
+    :param zf: the zipfile
+    :type zf: zipfile.ZipFile
+    :param compose_file: path of the docker-compose.yml inside the zipfile
+    :type compose_file: str or unicode
+    :param dest: directory to extract to
+    :type dest: str or unicode
+    :return: the path of the extracted docker-compose.yml
+    :rtype: str
+    """
+    compose_file = posixpath.normpath(compose_file.replace("\\", "/"))
+    content = zf.read(compose_file)
+    base = posixpath.dirname(compose_file)
+    members = set(zf.namelist())
+    names = [compose_file]
+    for ref in [".env"] + parse_compose_references(content):
+        name = posixpath.normpath(posixpath.join(base, ref))
+        if name.startswith("../") or name.startswith("/") or name not in members:
+            continue
+        if name not in names:
+            names.append(name)
+    for name in names:
+        zf.extract(name, dest)
+    return os.path.join(dest, *compose_file.split("/"))
+
+
+def parse_base_images(content, build_args=None):
+    """
+    Parse the content of a Dockerfile and return the images used by FROM instructions.
+    References to previous build stages, 'scratch' and images which can not be
+    resolved (e.g. because they depend on build args without a default) are not included.
+    :param content: content of the Dockerfile
+    :type content: str or unicode
+    :param build_args: values of build args, overriding the defaults in the Dockerfile
+    :type build_args: dict or None
+    :return: list of images
+    :rtype: list of str
+    """
+    # join continued lines
+    content = re.sub(r"\\[ \t]*\r?\n", " ", content)
+    args = {}
+    stages = set()
+    images = []
+    seen_from = False
+    for line in content.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        parts = line.split()
+        instruction = parts[0].upper()
+        if instruction == "ARG" and not seen_from:
+            # only args declared before the first FROM can be used in FROM
+            for arg in parts[1:]:
+                if "=" in arg:
+                    name, value = arg.split("=", 1)
+                    args[name] = value.strip("\"'")
+                else:
+                    name = arg
+                if build_args is not None and name in build_args:
+                    args[name] = build_args[name]
+        elif instruction == "FROM":
+            seen_from = True
+            operands = [p for p in parts[1:] if not p.startswith("--")]
+            if len(operands) == 0:
+                continue
+            image = re.sub(
+                r"\$\{?([A-Za-z_][A-Za-z0-9_]*)\}?",
+                lambda m: args.get(m.group(1), m.group(0)),
+                operands[0],
+                )
+            if len(operands) >= 3 and operands[1].upper() == "AS":
+                stages.add(operands[2].lower())
+            if "$" in image or image.lower() == "scratch" or image.lower() in stages:
+                continue
+            if image not in images:
+                images.append(image)
+    return images
+
+
+def _pull_failed(f, image):
+    """
+    Called when pulling an image failed.
+    :param f: the error
+    :type f: Failure
+    :param image: the image
+    :type image: str
+    :return: the exitcode to report for the image
+    :rtype: int
+    """
+    if not f.check(defer.CancelledError):
+        log.err(f, "Error pulling " + image)
+    return -1
+
+
+def pull_images(images, concurrency=constants.PREFETCH_CONCURRENCY):
+    """
+    Pull images concurrently, ignoring errors.
+    :param images: images to pull
+    :type images: list of str
+    :param concurrency: maximum number of concurrent pulls
+    :type concurrency: int
+    :return: a deferred which will fire with a dict mapping each image to the exitcode of the pull
+    :rtype: Deferred
+    """
+    sem = defer.DeferredSemaphore(concurrency)
+    ds = []
+    for image in images:
+        d = sem.run(
+            run_command,
+            path=".",
+            executable=get_docker_executable(),
+            command=["docker", "pull", "-q", image],
+            protocolfactory=CollectingProcessProtocol,
+            )
+        d.addErrback(_pull_failed, image)
+        ds.append(d)
+
+    def cancel(d):
+        # cancel the waiting pulls first, so they are not started when the running ones end
+        for pd in reversed(ds):
+            pd.cancel()
+
+    d = defer.Deferred(canceller=cancel)
+    gd = defer.gatherResults(ds)
+    gd.addCallback(lambda exitcodes: dict(zip(images, exitcodes)))
+    gd.chainDeferred(d)
+    return d
+
+
+def get_repository(tag):
+    """
+    Return the repository of a tag (the tag without the ':<tag>' suffix and digest).
+    :param tag: the tag
+    :type tag: str
+    :return: the repository
+    :rtype: str
+    """
+    tag = tag.split("@", 1)[0]
+    if ":" in tag.rsplit("/", 1)[-1]:
+        tag = tag.rsplit(":", 1)[0]
+    return tag
+
+
+@defer.inlineCallbacks
+def get_local_digests(tag):
+    """
+    Return the registry digests of a local image.
+    :param tag: tag of the image
+    :type tag: str
+    :return: a deferred which will fire with a list of digests (empty if the image was never pushed or pulled)
+    :rtype: Deferred
+    """
+    protocol = CollectingProcessProtocol()
+    exitcode = yield run_command(
+        path=".",
+        executable=get_docker_executable(),
+        command=["docker", "image", "inspect", "--format", "{{json .RepoDigests}}", tag],
+        protocolfactory=lambda: protocol,
+        )
+    if exitcode != 0:
+        defer.returnValue([])
+    try:
+        rds = json.loads(protocol.stdout.strip() or "null") or []
+    except ValueError:
+        defer.returnValue([])
+    repo = get_repository(tag)
+    digests = []
+    for rd in rds:
+        if "@" not in rd:
+            continue
+        name, digest = rd.split("@", 1)
+        if name == repo or name.endswith("/" + repo):
+            digests.append(digest)
+    defer.returnValue(digests)
+
+
+@defer.inlineCallbacks
+def get_remote_digest(tag):
+    """
+    Return the digest of the manifest of an image in the registry.
+    :param tag: tag of the image
+    :type tag: str
+    :return: a deferred which will fire with the digest or None if it could not be determined
+    :rtype: Deferred
     """
-    output = subprocess.check_output(["docker", "info"])
-    swarm_enabled = ("Swarm: active" in output)
-    return swarm_enabled
+    protocol = CollectingProcessProtocol()
+    exitcode = yield run_command(
+        path=".",
+        executable=get_docker_executable(),
+        command=["docker", "manifest", "inspect", "-v", tag],
+        protocolfactory=lambda: protocol,
+        )
+    if exitcode != 0:
+        defer.returnValue(None)
+    try:
+        data = json.loads(protocol.stdout)
+    except ValueError:
+        defer.returnValue(None)
+    if not isinstance(data, dict):
+        # manifest list
+        defer.returnValue(None)
+    defer.returnValue(data.get("Descriptor", {}).get("digest", None))
+
 
+@defer.inlineCallbacks
+def is_pushed(tag):
+    """
+    Check whether the registry already contains the local image with the specified tag.
+    :param tag: tag of the image
+    :type tag: str
+    :return: a deferred which will fire with True if the image does not need to be pushed.
+    :rtype: Deferred
+    """
+    local_digests = yield get_local_digests(tag)
+    if len(local_digests) == 0:
+        defer.returnValue(False)
+    remote_digest = yield get_remote_digest(tag)
+    defer.returnValue(remote_digest is not None and remote_digest in local_digests)
+
+
+@defer.inlineCallbacks
+def get_image_layers():
+    """
+    Return the layers of all images (including intermediate images) of the docker daemon.
+    :return: a deferred which will fire with a list containing the diff ids of the layers of each image
+    :rtype: Deferred
+    """
+    protocol = CollectingProcessProtocol()
+    exitcode = yield run_command(
+        path=tempfile.gettempdir(),
+        executable=get_docker_executable(),
+        command=["docker", "image", "ls", "-a", "-q", "--no-trunc"],
+        protocolfactory=lambda: protocol,
+        )
+    if exitcode != 0:
+        defer.returnValue([])
+    ids = sorted(set(protocol.stdout.split()))
+    if len(ids) == 0:
+        defer.returnValue([])
+    protocol = CollectingProcessProtocol()
+    exitcode = yield run_command(
+        path=tempfile.gettempdir(),
+        executable=get_docker_executable(),
+        command=["docker", "image", "inspect", "--format", "{{json .RootFS.Layers}}"] + ids,
+        protocolfactory=lambda: protocol,
+        )
+    layers = []
+    for line in protocol.stdout.splitlines():
+        try:
+            diff_ids = json.loads(line)
+        except ValueError:
+            # error message of a removed image
+            continue
+        if isinstance(diff_ids, list):
+            layers.append(diff_ids)
+    defer.returnValue(layers)
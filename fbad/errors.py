@@ -14,3 +14,31 @@ class InvalidPassword(Exception):
     Exception raised when the server rejected the password.
     """
     pass
+
+
+class RemoteError(Exception):
+    """
+    Exception raised when the server reported an error.
+    """
+    pass
+
+
+class GitError(Exception):
+    """
+    Exception raised when a git command failed.
+    """
+    pass
+
+
+class BuilderError(Exception):
+    """
+    Exception raised when no buildx builder able to export build caches is available.
+    """
+    pass
+
+
+class UploadTooLarge(Exception):
+    """
+    Exception raised when a client sent more data than it announced.
+    """
+    pass
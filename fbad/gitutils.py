@@ -0,0 +1,25 @@
+"""git utilities."""
+import subprocess
+
+from fbad.errors import GitError
+
+
+def get_changed_paths(path, revrange):
+    """
+    Return the paths of the files changed in a revision range.
+    If revrange does not contain '..', it is compared against the working tree.
+    :param path: path of the project, which has to be inside a git repository
+    :type path: str or unicode
+    :param revrange: the revision range (e.g. 'origin/master...HEAD')
+    :type revrange: str
+    :return: paths of the changed files, relative to path
+    :rtype: list of str
+    """
+    command = ["git", "diff", "--name-only", "--relative", "--no-renames", "-z", revrange, "--"]
+    try:
+        output = subprocess.check_output(command, cwd=path)
+    except OSError as e:
+        raise GitError("Could not run git: " + str(e))
+    except subprocess.CalledProcessError as e:
+        raise GitError("git diff failed with exitcode {}".format(e.returncode))
+    return [p for p in output.split("\0") if p]
@@ -1,13 +1,34 @@
 """this module defines the Image class which defines build options for an image."""
 import os
+import re
 import json
+import string
 import subprocess
 import platform
+import itertools
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, threads
+from twisted.python import log
 
 from fbad import constants
 from fbad.shutils import run_command
+from fbad.dockerutils import parse_base_images, is_pushed, get_docker_executable
+from fbad.utils import parse_size
+
+
+def get_placeholders(s):
+    """
+    Return the names of the placeholders in a format string.
+    :param s: the format string
+    :type s: str or unicode
+    :return: the names of the placeholders
+    :rtype: set of str
+    """
+    names = set()
+    for literal, field, spec, conversion in string.Formatter().parse(s):
+        if field:
+            names.add(re.split(r"[.\[]", field)[0])
+    return names
 
 
 class Image(object):
@@ -29,6 +50,35 @@ class Image(object):
     :type buildpath: str or unicode
     :param preexec_command: command to execute first (format: [prog_path, ARG1, ARG2, ...]
     :type preexec_command: list:
+    :param preexec_inputs: paths of the files and directories read by the preexec_command,
+        relative to buildpath (defaults to the whole buildpath).
+    :type preexec_inputs: list or None
+    :param preexec_outputs: paths of the files and directories generated by the preexec_command,
+        relative to buildpath. If specified, the outputs are cached per architecture and the
+        preexec_command is only executed again if its inputs changed.
+    :type preexec_outputs: list or None
+    :param inputs: paths of the files and directories this image depends on,
+        relative to the path of the project file. If specified, only changes of these
+        paths, path and the dockerfile are considered to affect this image.
+        Otherwise, all changes in buildpath are considered to affect this image.
+    :type inputs: list or None
+    :param build_args: build args to pass to docker build. They can also be used as placeholders in the tag.
+    :type build_args: dict or None
+    :param matrix: dict mapping build args to lists of values. If specified, this image is built once for
+        each combination of the values (see Image.get_variants()). name and tag may contain the build args
+        as placeholders (e.g. 'app-py{PYTHON_VERSION}'). Only the tag may contain buildserver-specific
+        placeholders (e.g. '{arch}').
+    :type matrix: dict or None
+    :param variant_of: name of the image this image is a variant of (set by Image.get_variants())
+    :type variant_of: str or unicode or None
+    :param cpus: number of CPUs the build of this image needs (defaults to constants.DEFAULT_IMAGE_CPUS).
+        Buildservers run concurrent builds as long as the CPUs they declared fit and limit the build to them.
+    :type cpus: float or None
+    :param memory: memory the build of this image needs, in bytes or as a size like '4G'
+        (defaults to constants.DEFAULT_IMAGE_MEMORY). Used like cpus.
+    :type memory: int or str or None
+    :param io_weight: relative I/O weight (1-1000, 500 being the default) of the preexec_command
+    :type io_weight: int or None
     """
     def __init__(
         self,
@@ -38,6 +88,15 @@ class Image(object):
         dockerfile="Dockerfile",
         buildpath=None,
         preexec_command=None,
+        inputs=None,
+        preexec_inputs=None,
+        preexec_outputs=None,
+        build_args=None,
+        matrix=None,
+        variant_of=None,
+        cpus=None,
+        memory=None,
+        io_weight=None,
         ):
             self.path = path
             # remove trailing slashes
@@ -58,44 +117,251 @@ class Image(object):
             else:
                 self.buildpath = buildpath
             self.preexec_command = preexec_command
+            self.inputs = inputs
+            self.preexec_inputs = preexec_inputs
+            self.preexec_outputs = preexec_outputs
+            # build args are substituted into tags and Dockerfiles as strings
+            self.build_args = dict([(k, (v if isinstance(v, basestring) else str(v))) for k, v in (build_args or {}).items()])
+            self.matrix = matrix
+            self.variant_of = variant_of
+            self.cpus = cpus
+            self.memory = memory
+            self.io_weight = io_weight
+
+    def get_variants(self):
+        """
+        Return the images to build for this image.
+        If this image has a matrix, an image is returned for each combination of the build args in the
+        matrix. If the name or the tag do not contain any of these build args as placeholders, the values
+        are appended to them, so each variant has its own name and tag.
+        Otherwise, only this image is returned.
+        :return: the images
+        :rtype: list of Image
+        """
+        if not self.matrix:
+            return [self]
+        keys = sorted(self.matrix.keys())
+        # the name must be the same on the client and on each buildserver
+        unknown = get_placeholders(self.name) - set(keys) - set(self.build_args.keys())
+        if len(unknown) > 0:
+            raise ValueError("name of image '{}' may only contain build args as placeholders, not: {}".format(self.name, ", ".join(sorted(unknown))))
+        name_has_values = len(get_placeholders(self.name) & set(keys)) > 0
+        tag_has_values = len(get_placeholders(self.tag) & set(keys)) > 0
+        variants = []
+        for values in itertools.product(*[self.matrix[k] for k in keys]):
+            args = dict(self.build_args)
+            args.update(zip(keys, [str(v) for v in values]))
+            name = self.name.format(**args)
+            if not name_has_values:
+                name = "-".join([name] + [str(v) for v in values])
+            tag = self.tag
+            if not tag_has_values:
+                # buildserver-specific placeholders in the tag are formatted later
+                tag = "-".join([tag] + [str(v) for v in values])
+            variants.append(Image(
+                path=self.path,
+                name=name,
+                tag=tag,
+                dockerfile=self.dockerfile,
+                buildpath=self.buildpath,
+                preexec_command=self.preexec_command,
+                inputs=self.inputs,
+                preexec_inputs=self.preexec_inputs,
+                preexec_outputs=self.preexec_outputs,
+                build_args=args,
+                variant_of=self.name,
+                cpus=self.cpus,
+                memory=self.memory,
+                io_weight=self.io_weight,
+                ))
+        return variants
+
+    def get_requirements(self):
+        """
+        Return the resources the build of this image needs.
+        :return: a tuple of (cpus, bytes of memory)
+        :rtype: tuple of (float, int)
+        """
+        if self.cpus is not None:
+            cpus = float(self.cpus)
+        else:
+            cpus = constants.DEFAULT_IMAGE_CPUS
+        if self.memory is None:
+            memory = constants.DEFAULT_IMAGE_MEMORY
+        elif isinstance(self.memory, (str, unicode)):
+            memory = parse_size(self.memory)
+        else:
+            memory = int(self.memory)
+        return cpus, memory
+
+    def get_resource_options(self):
+        """
+        Return the options of 'docker build' limiting the build to the declared resources.
+        Only resources which were declared are limited.
+        :return: the options
+        :rtype: list of str
+        """
+        cpus, memory = self.get_requirements()
+        options = []
+        if self.cpus is not None:
+            period = constants.CPU_PERIOD
+            options += ["--cpu-period", str(period), "--cpu-quota", str(int(cpus * period))]
+        if self.memory is not None:
+            # do not let the build use swap instead
+            options += ["--memory", str(memory), "--memory-swap", str(memory)]
+        return options
+
+    @defer.inlineCallbacks
+    def preexec(self, path, protocolfactory=None, preexec_cache=None):
+        """
+        Execute the preexec_command, if any.
+        If preexec_outputs and preexec_cache are specified, the outputs are restored
+        from the cache instead if the inputs did not change.
+        :param path: path of the project files
+        :type path: str or unicode
+        :param protocolfactory: a callable which returns a protocol to communicate with the child process
+        :type protocolfactory: callable
+        :param preexec_cache: cache for the outputs of the preexec_command
+        :type preexec_cache: PreexecCache or None
+        :return: a deferred which will fire with the exitcode of the command
+        :rtype: Deferred
+        """
+        if self.preexec_command is None:
+            defer.returnValue(0)
+        bp = os.path.join(path, self.buildpath)
+        key = None
+        if (preexec_cache is not None) and (self.preexec_outputs is not None):
+            key = yield threads.deferToThread(
+                preexec_cache.get_key,
+                self.preexec_command,
+                bp,
+                self.preexec_inputs,
+                self.preexec_outputs,
+                )
+            restored = yield threads.deferToThread(preexec_cache.restore, key, bp, self.preexec_outputs)
+            if restored:
+                log.msg("Using cached preexec outputs of image {}".format(self.name))
+                defer.returnValue(0)
+        pec = yield run_command(
+            path=bp,
+            executable=self.preexec_command[0],
+            command=self.preexec_command,
+            protocolfactory=protocolfactory,
+            io_weight=self.io_weight,
+            )
+        if (pec == 0) and (key is not None):
+            yield threads.deferToThread(preexec_cache.store, key, bp, self.preexec_outputs)
+        defer.returnValue(pec)
 
     @defer.inlineCallbacks
-    def build(self, path, protocolfactory=None):
+    def build(self, path, protocolfactory=None, cache=None, preexec=True):
         """
         Build the image.
+        If cache is not None, the image is built using BuildKit ('docker buildx build'),
+        importing the cache before and exporting it after the build.
+        Otherwise, the build is limited to the declared cpus and memory (BuildKit does not support this).
         :param path: path of the project files
         :type path: str or unicode
         :param protocolfactory: a callable which returns a protocol to communicate with the child process
         :type protocolfactory: callable
+        :param cache: build cache of this image
+        :type cache: ImageCache or None
+        :param preexec: whether to execute the preexec_command first
+        :type preexec: bool
         :return: a deferred which will fire when the project was built
         :rtype: Deferred
         """
         bp = os.path.join(path, self.buildpath)
         df = os.path.join(path, self.path, self.dockerfile)
         tag = self.format_tag(self.tag)
-        command = ["docker", "build", "-t", tag, "-f", df, "."]
-        if self.preexec_command is not None:
-            pec = yield run_command(
-                path=bp,
-                executable=self.preexec_command[0],
-                command=self.preexec_command,
-                protocolfactory=protocolfactory,
-                )
+        options = ["--label", constants.IMAGE_LABEL, "-t", tag, "-f", df]
+        for k in sorted(self.build_args.keys()):
+            options += ["--build-arg", "{}={}".format(k, self.build_args[k])]
+        if cache is None:
+            command = ["docker", "build"] + options + self.get_resource_options() + ["."]
+        else:
+            command = ["docker", "buildx", "build", "--load"] + options + cache.get_build_options() + ["."]
+            if (self.cpus is not None) or (self.memory is not None):
+                # buildx has no options limiting the resources of a build
+                log.msg("Warning: not limiting the CPUs and memory of image {} while using a layer cache".format(self.name))
+        if preexec:
+            pec = yield self.preexec(path, protocolfactory=protocolfactory)
             if pec != 0:
                 # error running command
                 defer.returnValue(pec)
 
-        cec = yield run_command(
-            path=bp,
-            executable=constants.DOCKER_EXECUTABLE,
-            command=command,
-            protocolfactory=protocolfactory,
-            )
+        try:
+            cec = yield run_command(
+                path=bp,
+                executable=get_docker_executable(),
+                command=command,
+                protocolfactory=protocolfactory,
+                )
+        except Exception:
+            if cache is not None:
+                yield cache.commit(success=False)
+            raise
+        if cache is not None:
+            yield cache.commit(success=(cec == 0))
         defer.returnValue(cec)
 
+    def get_base_images(self, path):
+        """
+        Return the images this image is based on, as specified in the Dockerfile.
+        If the Dockerfile does not exist (e.g. because it is generated by the
+        preexec_command), an empty list is returned.
+        :param path: path of the project files
+        :type path: str or unicode
+        :return: list of base images
+        :rtype: list of str
+        """
+        df = os.path.join(path, self.path, self.dockerfile)
+        if not os.path.isfile(df):
+            return []
+        with open(df, "r") as fin:
+            content = fin.read()
+        return parse_base_images(content, build_args=self.build_args)
+
+    def is_affected_by(self, path):
+        """
+        Check whether a change of a file may affect this image.
+        :param path: path of the file, relative to the project path
+        :type path: str or unicode
+        :return: True if the file is one of the inputs of this image.
+        :rtype: bool
+        """
+        path = os.path.normpath(path)
+        if self.inputs is None:
+            paths = [self.buildpath, self.path]
+        else:
+            paths = [self.path] + list(self.inputs)
+        paths.append(os.path.join(self.path, self.dockerfile))
+        for p in paths:
+            p = os.path.normpath(p) if p else ""
+            if p in ("", ".") or path == p or path.startswith(p + os.sep):
+                return True
+        return False
+
+    def matches_reference(self, ref):
+        """
+        Check whether an image reference (e.g. from a FROM instruction) refers to this image.
+        Build args in the tag are replaced by their values, other placeholders match any value.
+        :param ref: the image reference
+        :type ref: str
+        :return: True if ref refers to this image
+        :rtype: bool
+        """
+        tag = self.tag
+        for k, v in self.build_args.items():
+            tag = tag.replace("{" + k + "}", v)
+        pattern = re.sub(r"\\\{[A-Za-z_][A-Za-z0-9_]*\\\}", "[^/:]+", re.escape(tag))
+        if ":" not in tag.rsplit("/", 1)[-1]:
+            pattern += "(:latest)?"
+        return re.match("^" + pattern + "$", ref) is not None
+
     def format_tag(self, s):
         """
-        Format a tag (or another string) with buildserver-specific information.
+        Format a tag (or another string) with buildserver-specific information and the build args.
         :param s: string to format
         :type s: str or unicode
         :return: the formated string
@@ -108,22 +374,30 @@ class Image(object):
             "release": release,
             "arch": arch,
             }
+        info.update(self.build_args)
         return s.format(**info)
 
     @defer.inlineCallbacks
-    def push(self, protocolfactory=None):
+    def push(self, protocolfactory=None, skip_existing=True):
         """
         Push this Image to a docker registry.
         :param protocolfactory: a callable which returns a protocol to communicate with the child process
         :type protocolfactory: callable
+        :param skip_existing: if True, do not push if the registry already has the digest of the local image
+        :type skip_existing: bool
         :return: a deferred which will fire when the command executed successfully
         :rtype: Deferred
         """
         tag = self.format_tag(self.tag)
+        if skip_existing:
+            pushed = yield is_pushed(tag)
+            if pushed:
+                log.msg("Not pushing {}: registry already has this image".format(tag))
+                defer.returnValue(0)
         command = ["docker", "push", tag]
-        exitcode = yield self._run_command(
+        exitcode = yield run_command(
             path=".",
-            executable=constants.DOCKER_EXECUTABLE,
+            executable=get_docker_executable(),
             command=command,
             protocolfactory=protocolfactory,
             )
@@ -142,6 +416,15 @@ class Image(object):
             "dockerfile": self.dockerfile,
             "buildpath": self.buildpath,
             "preexec_command": self.preexec_command,
+            "inputs": self.inputs,
+            "preexec_inputs": self.preexec_inputs,
+            "preexec_outputs": self.preexec_outputs,
+            "build_args": self.build_args,
+            "matrix": self.matrix,
+            "variant_of": self.variant_of,
+            "cpus": self.cpus,
+            "memory": self.memory,
+            "io_weight": self.io_weight,
             }
         return json.dumps(jdata)
 
@@ -0,0 +1,557 @@
+"""this module defines server-side build jobs and their on-disk logs."""
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from fbad import constants
+from fbad.timing import BuildStats
+from fbad.cache import parse_peer
+from fbad.dockerutils import pull_images
+from fbad.workspace import get_process_dir
+
+
+class JobLog(object):
+    """
+    A bounded log stored in multiple segment files on disk.
+    Offsets are absolute byte positions in the output of the job.
+    When more than max_segments segments exist, the oldest segment is removed.
+    :param path: directory to store the segments in
+    :type path: str or unicode
+    :param segment_size: maximum size of a segment in bytes
+    :type segment_size: int
+    :param max_segments: maximum number of segments to keep
+    :type max_segments: int
+    """
+    def __init__(
+        self,
+        path,
+        segment_size=constants.JOB_LOG_SEGMENT_SIZE,
+        max_segments=constants.JOB_LOG_MAX_SEGMENTS,
+        ):
+            self.path = path
+            self.segment_size = segment_size
+            self.max_segments = max_segments
+            self.segments = []  # list of [start_offset, length]
+            self.end = 0
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+    @property
+    def start(self):
+        """the first offset which can still be read."""
+        if len(self.segments) == 0:
+            return self.end
+        return self.segments[0][0]
+
+    def _segment_path(self, start):
+        """
+        Return the path of the segment starting at start.
+        :param start: start offset of the segment
+        :type start: int
+        :return: the path of the segment
+        :rtype: str or unicode
+        """
+        return os.path.join(self.path, "segment.{:016d}".format(start))
+
+    def write(self, data):
+        """
+        Append data to the log.
+        :param data: data to append
+        :type data: str
+        """
+        while len(data) > 0:
+            if len(self.segments) == 0 or self.segments[-1][1] >= self.segment_size:
+                self.segments.append([self.end, 0])
+                while len(self.segments) > self.max_segments:
+                    start, length = self.segments.pop(0)
+                    os.remove(self._segment_path(start))
+            segment = self.segments[-1]
+            tw = data[:self.segment_size - segment[1]]
+            data = data[len(tw):]
+            with open(self._segment_path(segment[0]), "ab") as fout:
+                fout.write(tw)
+            segment[1] += len(tw)
+            self.end += len(tw)
+
+    def read(self, offset, maxlength=constants.READ_CHUNK_SIZE):
+        """
+        Read up to maxlength bytes starting at offset.
+        If offset was already removed from the log, reading starts at the first available offset.
+        :param offset: offset to read from
+        :type offset: int
+        :param maxlength: maximum number of bytes to read
+        :type maxlength: int
+        :return: a tuple of (data, offset of the first byte after data)
+        :rtype: tuple of (str, int)
+        """
+        offset = max(offset, self.start)
+        for start, length in self.segments:
+            if start <= offset < start + length:
+                with open(self._segment_path(start), "rb") as fin:
+                    fin.seek(offset - start)
+                    data = fin.read(min(maxlength, start + length - offset))
+                return (data, offset + len(data))
+        return ("", offset)
+
+    def remove(self):
+        """
+        Remove all segments of this log.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.segments = []
+
+
+class Job(object):
+    """
+    A build job running on the server.
+    The job keeps running when the client which started it disconnects.
+    All output is written to the JobLog and relayed to all listeners.
+    A listener is any object with the send_message() and send_exitcodes() methods
+    (e.g. a FBADServerProtocol). send_exitcodes() also receives the stats of the job.
+    :param job_id: id of the job
+    :type job_id: str
+    :param project: the project to build
+    :type project: Project
+    :param path: directory to store job data in
+    :type path: str or unicode
+    :param source_path: if specified, build the project files in this directory.
+        If receive is True, the received archive will be extracted into this directory.
+    :type source_path: str or unicode or None
+    :param receive: whether the project files will be received as an archive
+    :type receive: bool
+    :param allocator: allocator to create the workspace with
+    :type allocator: WorkspaceAllocator or None
+    :param size: bytes the workspace is expected to need or None if unknown
+    :type size: int or None
+    """
+
+    STATE_RECEIVING = "receiving"
+    STATE_RUNNING = "running"
+    STATE_FINISHED = "finished"
+    STATE_FAILED = "failed"
+    STATE_CANCELLED = "cancelled"
+
+    def __init__(self, job_id, project, path, source_path=None, receive=True, allocator=None, size=None):
+        self.id = job_id
+        self.project = project
+        self.path = path
+        self.log = JobLog(os.path.join(path, "log"))
+        self.state = self.STATE_RECEIVING
+        self.exitcodes = None
+        self.created = time.time()
+        self.finished = None
+        self.listeners = []
+        self.d = None  # deferred of the current stage of this job
+        self.processes = []  # protocols of the processes started by this job
+        self.prefetch_d = None  # deferred of pulling the base images while the project files are received
+        self.stats = BuildStats()
+        self.source_path = source_path
+        self.allocator = allocator
+        if receive and allocator is not None:
+            self.workspace = allocator.allocate(size)
+        elif receive:
+            self.workspace = self.project.get_temp_build_dir_path()
+            os.makedirs(self.workspace)
+        else:
+            self.workspace = None
+
+    @property
+    def archive_path(self):
+        """the path the uploaded project archive is stored at."""
+        return os.path.join(self.workspace, "projectdata.zip")
+
+    @property
+    def done(self):
+        """True if the job is no longer running."""
+        return self.state in (self.STATE_FINISHED, self.STATE_FAILED, self.STATE_CANCELLED)
+
+    def add_listener(self, listener):
+        """
+        Add a listener which will be notified about output and the exit codes.
+        :param listener: listener to add
+        :type listener: object
+        """
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Remove a listener.
+        :param listener: listener to remove
+        :type listener: object
+        """
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def send_message(self, msg):
+        """
+        Log a message and relay it to all listeners.
+        :param msg: the message
+        :type msg: str or unicode
+        """
+        if isinstance(msg, unicode):
+            self.log.write(msg.encode(constants.ENCODING))
+        else:
+            self.log.write(msg)
+        self.stats.add_bytes_sent(len(msg))
+        for listener in list(self.listeners):
+            listener.send_message(msg)
+
+    def send_exitcodes(self, exitcodes):
+        """
+        Finish the job and send the exitcodes to all listeners.
+        :param exitcodes: list of the exitcodes of the processes.
+        :type exitcodes: list of ints
+        """
+        self.exitcodes = exitcodes
+        self.state = self.STATE_FINISHED
+        self.finished = time.time()
+        for listener in list(self.listeners):
+            listener.send_exitcodes(exitcodes, stats=self.stats.to_dict())
+        self.listeners = []
+
+    def get_status(self):
+        """
+        Return a dict describing the status of this job.
+        :return: the status
+        :rtype: dict
+        """
+        return {
+            "job": self.id,
+            "project": self.project.name,
+            "state": self.state,
+            "exitcodes": self.exitcodes,
+            "created": self.created,
+            "finished": self.finished,
+            "log_start": self.log.start,
+            "log_end": self.log.end,
+            "stats": self.stats.to_dict(),
+            }
+
+    def start(self, protocolfactory, only=None, push=False, deploy=False, cache=None, push_concurrency=constants.PUSH_CONCURRENCY, deleted=None, resources=None, distributor=None):
+        """
+        Start running this job.
+        See Job.run() for the arguments.
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        self.d = self.run(protocolfactory, only=only, push=push, deploy=deploy, cache=cache, push_concurrency=push_concurrency, deleted=deleted, resources=resources, distributor=distributor)
+        return self.d
+
+    @defer.inlineCallbacks
+    def run(self, protocolfactory, only=None, push=False, deploy=False, cache=None, push_concurrency=constants.PUSH_CONCURRENCY, deleted=None, resources=None, distributor=None):
+        """
+        Build the received archive (or the source path) and optionally push and deploy the project.
+        :param protocolfactory: a callable which returns a protocol to communicate with the child process
+        :type protocolfactory: callable
+        :param only: which images to built, specified by their name
+        :type only: list or None
+        :param push: if True, push images to the registry
+        :type push: bool
+        :param deploy: whether to deploy the compose file after the build.
+        :type deploy: bool
+        :param cache: LayerCache to import and export the build caches from/to
+        :type cache: LayerCache or None
+        :param push_concurrency: maximum number of images to push concurrently
+        :type push_concurrency: int
+        :param deleted: paths to remove from the source path before building
+        :type deleted: list of str or None
+        :param resources: pool of the resources the concurrent builds need
+        :type resources: ResourcePool or None
+        :param distributor: Distributor to send the built images to the buildservers in project.distribute_to with
+        :type distributor: Distributor or None
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        self.state = self.STATE_RUNNING
+        protocolfactory = self.track_processes(protocolfactory)
+        try:
+            if self.source_path is not None and self.workspace is not None:
+                with self.stats.measure("extract"):
+                    yield threads.deferToThread(self.apply_archive, deleted or [])
+            if self.source_path is not None:
+                exitcodes = yield self.project.build_from_path(self.source_path, protocolfactory=protocolfactory, only=only, cache=cache, stats=self.stats, resources=resources)
+            else:
+                # extract into the workspace, which may be placed in memory
+                path = os.path.join(self.workspace, "project")
+                with self.stats.measure("extract"):
+                    yield threads.deferToThread(self.extract_archive, path)
+                exitcodes = yield self.project.build_from_path(path, protocolfactory=protocolfactory, only=only, cache=cache, stats=self.stats, resources=resources)
+            if push:
+                yield self.project.push(only=only, protocolfactory=protocolfactory, concurrency=push_concurrency, stats=self.stats)
+            if distributor is not None and self.project.distribute_to and len(exitcodes) > 0 and max(exitcodes) == 0:
+                yield self.distribute(distributor, only)
+            if deploy:
+                with self.stats.measure("deploy"):
+                    if self.source_path is not None:
+                        cp = os.path.join(self.source_path, self.project.compose_file)
+                        exitcodes += (yield self.project.deploy_compose(cp, pull=push, protocolfactory=protocolfactory))
+                    else:
+                        exitcodes += (yield self.project.deploy_from_zip(self.archive_path, pull=push, protocolfactory=protocolfactory))
+        except defer.CancelledError:
+            # do not remove the workspace while the killed processes are still using it
+            yield self.wait_for_processes()
+            self.send_message("Job cancelled.\n")
+            self._finish_unsuccessful(self.STATE_CANCELLED)
+            defer.returnValue([])
+        except Exception:
+            log.err(None, "Job {} failed".format(self.id))
+            yield self.wait_for_processes()
+            self._finish_unsuccessful(self.STATE_FAILED)
+            defer.returnValue([])
+        finally:
+            self.d = None
+            self.cleanup()
+        self.send_exitcodes(exitcodes)
+        defer.returnValue(exitcodes)
+
+    @defer.inlineCallbacks
+    def distribute(self, distributor, only=None):
+        """
+        Send the built images to the buildservers in project.distribute_to.
+        Errors are reported in the output, but do not fail the job.
+        :param distributor: the Distributor to send the images with
+        :type distributor: Distributor
+        :param only: names of the built images or None if all images were built
+        :type only: list or None
+        :return: a deferred which will fire when done
+        :rtype: Deferred
+        """
+        tags = [image.format_tag(image.tag) for image in self.project.images if only is None or image.name in only]
+        targets = [parse_peer(p) for p in self.project.distribute_to]
+        path = self.project.get_temp_build_dir_path()
+        os.makedirs(path)
+        try:
+            with self.stats.measure("distribute"):
+                n = yield distributor.distribute(tags, targets, path, self.send_message)
+        finally:
+            yield threads.deferToThread(shutil.rmtree, path, True)
+        self.send_message("Distributed images to {} of {} buildservers.\n".format(n, len(targets)))
+
+    def track_processes(self, protocolfactory):
+        """
+        Return a protocolfactory remembering the protocols of the processes started by this job.
+        :param protocolfactory: a callable which returns a protocol to communicate with the child process
+        :type protocolfactory: callable
+        :return: the wrapped protocolfactory
+        :rtype: callable
+        """
+        def factory():
+            protocol = protocolfactory()
+            self.processes = [p for p in self.processes if not p.ended] + [protocol]
+            return protocol
+        return factory
+
+    def wait_for_processes(self):
+        """
+        Wait until all processes started by this job ended.
+        :return: a deferred which will fire when all processes ended
+        :rtype: Deferred
+        """
+        return defer.gatherResults([p.wait_ended() for p in self.processes])
+
+    def extract_archive(self, path):
+        """
+        Extract the received archive.
+        :param path: directory to extract the archive into
+        :type path: str or unicode
+        """
+        with zipfile.ZipFile(self.archive_path, "r", allowZip64=True) as zf:
+            zf.extractall(path)
+
+    def apply_archive(self, deleted):
+        """
+        Extract the received archive into the source path and remove deleted files.
+        :param deleted: paths to remove, relative to the source path
+        :type deleted: list of str
+        """
+        root = os.path.realpath(self.source_path)
+        for rp in deleted:
+            fp = os.path.realpath(os.path.join(root, rp))
+            if not fp.startswith(root + os.sep):
+                # outside of the source path
+                continue
+            if os.path.isdir(fp) and not os.path.islink(fp):
+                shutil.rmtree(fp)
+            elif os.path.lexists(fp):
+                os.remove(fp)
+        with zipfile.ZipFile(self.archive_path, "r", allowZip64=True) as zf:
+            zf.extractall(root)
+
+    def _finish_unsuccessful(self, state):
+        """
+        Mark this job as done without exitcodes and notify all listeners.
+        :param state: the new state of the job
+        :type state: str
+        """
+        self.state = state
+        self.finished = time.time()
+        for listener in list(self.listeners):
+            listener.send_exitcodes([], stats=self.stats.to_dict())
+        self.listeners = []
+
+    def cancel(self):
+        """
+        Cancel this job.
+        All processes started by this job will be killed.
+        :return: True if the job was cancelled, False if it was already done.
+        :rtype: bool
+        """
+        if self.done:
+            return False
+        self.cancel_prefetch()
+        if self.d is not None:
+            self.d.cancel()
+        else:
+            self.abort(self.STATE_CANCELLED)
+        return True
+
+    def abort(self, state=STATE_FAILED):
+        """
+        Abort the job before it was started (e.g. because the upload failed).
+        :param state: the new state of the job
+        :type state: str
+        """
+        if self.done:
+            return
+        self.cancel_prefetch()
+        self._finish_unsuccessful(state)
+        self.cleanup()
+
+    def prefetch(self, images, concurrency=constants.PREFETCH_CONCURRENCY):
+        """
+        Pull base images in the background while the project files are received.
+        The pulls are cancelled if this job is cancelled or aborted.
+        :param images: images to pull
+        :type images: list of str
+        :param concurrency: maximum number of concurrent pulls
+        :type concurrency: int
+        """
+        self.prefetch_d = d = pull_images(images, concurrency=concurrency)
+        d.addErrback(self._prefetch_failed)
+        d.addBoth(self._prefetch_done)
+
+    def _prefetch_failed(self, f):
+        """
+        Called when pulling the base images failed.
+        :param f: the error
+        :type f: Failure
+        """
+        if not f.check(defer.CancelledError):
+            log.err(f, "Error prefetching base images of job {}".format(self.id))
+
+    def _prefetch_done(self, result):
+        """
+        Called when pulling the base images is done.
+        :param result: result of pull_images()
+        :type result: dict or None
+        """
+        self.prefetch_d = None
+
+    def cancel_prefetch(self):
+        """
+        Cancel pulling the base images, if still running.
+        """
+        if self.prefetch_d is not None:
+            self.prefetch_d.cancel()
+
+    def cleanup(self):
+        """
+        Remove the workspace of this job.
+        The log is kept until the job is removed from the JobManager.
+        """
+        if self.workspace is not None and os.path.exists(self.workspace):
+            shutil.rmtree(self.workspace)
+        if self.workspace is not None and self.allocator is not None:
+            self.allocator.release(self.workspace)
+
+
+class JobManager(object):
+    """
+    Keeps track of all jobs of a server.
+    :param path: directory to store job data in
+    :type path: str or unicode or None
+    :param max_finished: number of finished jobs to keep
+    :type max_finished: int
+    :param job_factory: callable creating the jobs, called with the same arguments as Job()
+    :type job_factory: callable
+    """
+    def __init__(self, path=None, max_finished=constants.JOB_MAX_FINISHED, job_factory=Job):
+        if path is None:
+            path = get_process_dir(os.path.join(tempfile.gettempdir(), constants.JOB_DIR_NAME))
+        self.path = path
+        self.max_finished = max_finished
+        self.job_factory = job_factory
+        self.jobs = {}
+
+    def create(self, project, source_path=None, receive=True, allocator=None, size=None):
+        """
+        Create a new job.
+        :param project: project to build
+        :type project: Project
+        :param source_path: if specified, build the project files in this directory
+        :type source_path: str or unicode or None
+        :param receive: whether the project files will be received as an archive
+        :type receive: bool
+        :param allocator: allocator to create the workspace of the job with
+        :type allocator: WorkspaceAllocator or None
+        :param size: bytes the workspace of the job is expected to need or None if unknown
+        :type size: int or None
+        :return: the new job
+        :rtype: Job
+        """
+        self.expire()
+        job_id = uuid.uuid4().hex
+        job = self.job_factory(job_id, project, os.path.join(self.path, job_id), source_path=source_path, receive=receive, allocator=allocator, size=size)
+        self.jobs[job_id] = job
+        return job
+
+    def get(self, job_id):
+        """
+        Return the job with the specified id.
+        :param job_id: id of job to return
+        :type job_id: str or unicode
+        :return: the job or None if no such job exists
+        :rtype: Job or None
+        """
+        return self.jobs.get(job_id, None)
+
+    def get_status(self):
+        """
+        Return the status of all jobs.
+        :return: list of status dicts, oldest job first
+        :rtype: list of dict
+        """
+        jobs = sorted(self.jobs.values(), key=lambda j: j.created)
+        return [job.get_status() for job in jobs]
+
+    def expire(self):
+        """
+        Remove the oldest finished jobs if more than max_finished finished jobs exist.
+        """
+        finished = sorted([j for j in self.jobs.values() if j.done], key=lambda j: j.finished)
+        while len(finished) > self.max_finished:
+            self.remove(finished.pop(0))
+
+    def remove(self, job):
+        """
+        Remove a finished job and its log.
+        :param job: the job to remove
+        :type job: Job
+        """
+        job.log.remove()
+        shutil.rmtree(job.path, ignore_errors=True)
+        self.jobs.pop(job.id, None)
+        if len(self.jobs) == 0:
+            try:
+                os.rmdir(self.path)
+            except OSError:
+                # not empty or never created
+                pass
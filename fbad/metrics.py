@@ -0,0 +1,352 @@
+"""this module implements server metrics in the prometheus text format."""
+import os
+import tempfile
+
+from twisted.internet import threads
+from twisted.python import log
+from twisted.web import resource, server
+
+from fbad import constants
+from fbad.jobs import Job
+from fbad.workspace import get_process_dir
+
+
+def format_value(value):
+    """
+    Format a sample value.
+    :param value: the value
+    :type value: int or float
+    :return: the formated value
+    :rtype: str
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    """
+    Format the labels of a sample.
+    :param labels: the labels
+    :type labels: dict
+    :return: the formated labels, including the braces
+    :rtype: str
+    """
+    if not labels:
+        return ""
+    items = []
+    for k in sorted(labels.keys()):
+        v = str(labels[k]).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        items.append('{}="{}"'.format(k, v))
+    return "{" + ",".join(items) + "}"
+
+
+class Metric(object):
+    """
+    Base class for metrics.
+    :param name: name of the metric
+    :type name: str
+    :param help: description of the metric
+    :type help: str
+    """
+    type = "untyped"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+
+    def get_samples(self):
+        """
+        Return the samples of this metric.
+        :return: list of (name, labels, value) tuples
+        :rtype: list of tuple
+        """
+        return []
+
+    def render(self):
+        """
+        Render this metric in the prometheus text format.
+        :return: the rendered metric
+        :rtype: str
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+            ]
+        for name, labels, value in self.get_samples():
+            lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    A value which only increases.
+    """
+    type = "counter"
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help)
+        self.value = 0
+
+    def inc(self, n=1):
+        """
+        Increase the value.
+        :param n: amount to increase the value by
+        :type n: int or float
+        """
+        self.value += n
+
+    def get_samples(self):
+        return [(self.name, None, self.value)]
+
+
+class Gauge(Metric):
+    """
+    A value which can increase and decrease.
+    If callback is specified, it is called to get the samples instead.
+    :param callback: callable returning a value or a list of (labels, value) tuples
+    :type callback: callable or None
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, callback=None):
+        Metric.__init__(self, name, help)
+        self.value = 0
+        self.callback = callback
+
+    def inc(self, n=1):
+        """
+        Increase the value.
+        :param n: amount to increase the value by
+        :type n: int or float
+        """
+        self.value += n
+
+    def dec(self, n=1):
+        """
+        Decrease the value.
+        :param n: amount to decrease the value by
+        :type n: int or float
+        """
+        self.value -= n
+
+    def set(self, value):
+        """
+        Set the value.
+        :param value: the new value
+        :type value: int or float
+        """
+        self.value = value
+
+    def get_samples(self):
+        if self.callback is None:
+            return [(self.name, None, self.value)]
+        value = self.callback()
+        if isinstance(value, list):
+            return [(self.name, labels, v) for labels, v in value]
+        return [(self.name, None, value)]
+
+
+class Histogram(Metric):
+    """
+    Counts observed values in buckets.
+    :param buckets: upper bounds of the buckets
+    :type buckets: tuple of float
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=constants.METRICS_DURATION_BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"), )
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Observe a value.
+        :param value: the value
+        :type value: int or float
+        """
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def get_samples(self):
+        samples = []
+        for bound, count in zip(self.buckets, self.counts):
+            samples.append((self.name + "_bucket", {"le": format_value(bound)}, count))
+        samples.append((self.name + "_sum", None, self.sum))
+        samples.append((self.name + "_count", None, self.count))
+        return samples
+
+
+def get_disk_usage(path):
+    """
+    Return the number of bytes used by the files in a directory.
+    :param path: path of the directory
+    :type path: str or unicode
+    :return: the number of bytes
+    :rtype: int
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                # removed in the meantime
+                pass
+    return total
+
+
+class ServerMetrics(object):
+    """
+    The metrics of a FBADServerFactory.
+    :param factory: the factory to collect metrics of
+    :type factory: FBADServerFactory
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.tempdir = get_process_dir(os.path.join(tempfile.gettempdir(), constants.TEMP_DIR_NAME))
+        self.disk_usage = 0
+
+        self.connections = Gauge("fbad_connections", "Number of active client connections.")
+        self.subprocesses_running = Gauge("fbad_subprocesses_running", "Number of running docker and preexec subprocesses.")
+        self.subprocesses_started = Counter("fbad_subprocesses_started_total", "Number of started docker and preexec subprocesses.")
+        self.upload_bytes = Counter("fbad_upload_bytes_total", "Number of bytes of received project files.")
+        self.upload_seconds = Counter("fbad_upload_seconds_total", "Time spent receiving project files.")
+        self.relayed_bytes = Counter("fbad_relayed_bytes_total", "Number of output bytes relayed to clients.")
+        self.build_duration = Histogram("fbad_build_duration_seconds", "Duration of image builds.")
+        self.push_duration = Histogram("fbad_push_duration_seconds", "Duration of image pushes.")
+        self.metrics = [
+            self.connections,
+            Gauge("fbad_builds_uploading", "Number of builds waiting for their project files.", callback=self.count_uploading),
+            Gauge("fbad_builds_running", "Number of running builds.", callback=self.count_running),
+            Gauge("fbad_image_builds_queued", "Number of image builds waiting for CPUs and memory.", callback=lambda: self.factory.resources.get_status()["waiting"]),
+            Gauge("fbad_image_builds_running", "Number of image builds holding CPUs and memory.", callback=lambda: self.factory.resources.get_status()["running"]),
+            Gauge("fbad_jobs", "Number of known jobs by state.", callback=self.count_jobs),
+            self.build_duration,
+            self.push_duration,
+            self.upload_bytes,
+            self.upload_seconds,
+            self.relayed_bytes,
+            Gauge("fbad_tempdir_bytes", "Disk space used by build workspaces.", callback=lambda: self.disk_usage),
+            Gauge("fbad_ram_workspace_bytes", "Memory reserved by build workspaces placed in memory.", callback=lambda: self.factory.workspaces.used),
+            self.subprocesses_running,
+            self.subprocesses_started,
+            ]
+
+    def _count_state(self, state):
+        """
+        Return the number of jobs in the specified state.
+        :param state: the state
+        :type state: str
+        :return: the number of jobs
+        :rtype: int
+        """
+        return len([j for j in self.factory.jobs.jobs.values() if j.state == state])
+
+    def count_uploading(self):
+        """return the number of builds waiting for their project files."""
+        return self._count_state(Job.STATE_RECEIVING)
+
+    def count_running(self):
+        """return the number of running builds."""
+        return self._count_state(Job.STATE_RUNNING)
+
+    def count_jobs(self):
+        """return the number of jobs by state."""
+        counts = {}
+        for job in self.factory.jobs.jobs.values():
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return [({"state": state}, n) for state, n in sorted(counts.items())]
+
+    def observe_job(self, job):
+        """
+        Record the stats of a finished job.
+        :param job: the finished job
+        :type job: Job
+        """
+        stats = job.stats
+        if "receive" in stats.project:
+            self.upload_seconds.inc(stats.project["receive"])
+        self.upload_bytes.inc(stats.bytes_received)
+        for phases in stats.images.values():
+            if "build" in phases:
+                self.build_duration.observe(phases["build"])
+            if "push" in phases:
+                self.push_duration.observe(phases["push"])
+
+    def update_disk_usage(self):
+        """
+        Update the disk usage of the build workspaces in a thread.
+        :return: a deferred which will fire when the disk usage was updated
+        :rtype: Deferred
+        """
+        d = threads.deferToThread(get_disk_usage, self.tempdir)
+        d.addCallback(lambda usage: setattr(self, "disk_usage", usage))
+        return d
+
+    def render(self):
+        """
+        Render all metrics in the prometheus text format.
+        :return: the rendered metrics
+        :rtype: str
+        """
+        return "".join([m.render() for m in self.metrics])
+
+
+class MetricsResource(resource.Resource):
+    """
+    A twisted.web resource serving the metrics of a server.
+    :param metrics: the metrics to serve
+    :type metrics: ServerMetrics
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        """
+        Render the metrics.
+        :param request: the request
+        :type request: Request
+        """
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        closed = []
+        request.notifyFinish().addBoth(closed.append)
+        d = self.metrics.update_disk_usage()
+        d.addErrback(log.err, "Error determining disk usage")
+        d.addCallback(self._finish, request, closed)
+        return server.NOT_DONE_YET
+
+    def _finish(self, ignored, request, closed):
+        """
+        Write the metrics and finish the request, unless the connection was closed.
+        :param ignored: ignored result
+        :type ignored: object
+        :param request: the request
+        :type request: Request
+        :param closed: a non-empty list if the connection was closed
+        :type closed: list
+        """
+        if len(closed) > 0:
+            return
+        request.write(self.metrics.render())
+        request.finish()
+
+
+def get_metrics_site(metrics):
+    """
+    Return a site serving the metrics.
+    :param metrics: the metrics to serve
+    :type metrics: ServerMetrics
+    :return: the site
+    :rtype: Site
+    """
+    return server.Site(MetricsResource(metrics))
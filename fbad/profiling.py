@@ -0,0 +1,154 @@
+"""this module implements profiling of fbad itself and sampling of the event loop."""
+import cProfile
+import json
+import os
+import time
+
+from twisted.internet import task
+
+
+class Profiler(object):
+    """
+    Profiles the whole process using cProfile and writes the stats in the pstats format.
+    """
+    def __init__(self):
+        self.profile = None
+
+    def start(self):
+        """
+        Start profiling.
+        """
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self, path):
+        """
+        Stop profiling and write the stats.
+        :param path: path to write the stats to
+        :type path: str or unicode
+        """
+        if self.profile is None:
+            return
+        profile, self.profile = self.profile, None
+        profile.disable()
+        profile.dump_stats(path)
+
+    def snapshot(self, path):
+        """
+        Write the stats collected since the start or the last snapshot and continue profiling.
+        :param path: path to write the stats to
+        :type path: str or unicode
+        """
+        self.stop(path)
+        self.start()
+
+
+class ConnectionProfiler(Profiler):
+    """
+    A Profiler writing a dump to a directory whenever a connection was closed.
+    As the reactor serves all connections in one thread, each dump contains
+    all activity since the previous dump, not only the activity of the connection.
+    :param path: directory to write the dumps to
+    :type path: str or unicode
+    """
+    def __init__(self, path):
+        Profiler.__init__(self)
+        self.path = path
+        self.n = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def connection_lost(self, peer):
+        """
+        Write a dump for a closed connection.
+        :param peer: description of the peer of the connection
+        :type peer: str
+        """
+        self.n += 1
+        name = "connection-{:05d}-{}.pstats".format(self.n, peer.replace(":", "_").replace("/", "_"))
+        self.snapshot(os.path.join(self.path, name))
+
+    def stop_all(self):
+        """
+        Stop profiling and write a dump of the remaining activity.
+        """
+        self.stop(os.path.join(self.path, "final.pstats"))
+
+
+class LoopMonitor(object):
+    """
+    Samples the lag of the event loop and the queue depth of the reactor's thread pool.
+    Each sample is appended as a JSON line to a file.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param path: path of the file to append the samples to
+    :type path: str or unicode
+    :param interval: seconds between samples
+    :type interval: float
+    """
+    def __init__(self, reactor, path, interval=1.0):
+        self.reactor = reactor
+        self.path = path
+        self.interval = interval
+        self.expected = None
+        self.fout = None
+        self.loop = task.LoopingCall(self.sample)
+        self.loop.clock = reactor
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self.fout = open(self.path, "a")
+        self.expected = self.reactor.seconds() + self.interval
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+
+    def sample(self):
+        """
+        Take a sample.
+        """
+        now = self.reactor.seconds()
+        lag = max(now - self.expected, 0.0)
+        self.expected = now + self.interval
+        pool = self.reactor.getThreadPool()
+        data = {
+            "time": time.time(),
+            "lag": lag,
+            "threadpool_queued": pool.q.qsize(),
+            "threadpool_working": len(pool.working),
+            "threadpool_threads": len(pool.threads),
+            }
+        self.fout.write(json.dumps(data, sort_keys=True) + "\n")
+        self.fout.flush()
+
+
+def setup_profiling(reactor, profile=None, loop_stats=None, interval=1.0):
+    """
+    Profile the process and/or sample the event loop until the reactor stops.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param profile: path to write the pstats dump to or None
+    :type profile: str or None
+    :param loop_stats: path to append event loop samples to or None
+    :type loop_stats: str or None
+    :param interval: seconds between event loop samples
+    :type interval: float
+    """
+    if profile is not None:
+        profiler = Profiler()
+        profiler.start()
+        reactor.addSystemEventTrigger("after", "shutdown", profiler.stop, profile)
+    if loop_stats is not None:
+        monitor = LoopMonitor(reactor, loop_stats, interval=interval)
+        reactor.callWhenRunning(monitor.start)
+        reactor.addSystemEventTrigger("before", "shutdown", monitor.stop)
@@ -1,21 +1,29 @@
 """this module defines the Project class which is the main interface for each project."""
 import os
-import shutil
 import zipfile
 import tempfile
-import contextlib
 import json
-import uuid
 import argparse
 import sys
+import time
+import socket
 
-from twisted.internet import reactor, endpoints, task, defer, threads
+from twisted.internet import task, defer, threads
 from twisted.python import log
 
-from fbad import constants, client
+from fbad import constants
+from fbad.errors import GitError
 from fbad.image import Image
 from fbad.shutils import run_command
-from fbad.dockerutils import in_swarm
+from fbad.dockerutils import get_swarm_state, get_host_options, extract_compose_files, get_docker_executable, get_docker_compose_executable
+from fbad.jobs import JobManager
+from fbad.gitutils import get_changed_paths
+from fbad.cache import PreexecCache
+from fbad.timing import BuildStats, BuildReport
+from fbad.tracing import Tracer
+from fbad.profiling import setup_profiling
+from fbad.resources import ResourcePool, get_host_resources
+from fbad.workspace import get_workspace_path, temporary_workspace
 
 try:
     import __main__
@@ -32,31 +40,60 @@ class Project(object):
     :type images: list of Image()
     :param compose_file: associated docker-compose.yml file.
     :type compose_file: str or unicode
+    :param deploy_hosts: docker hosts or swarm managers to deploy to (e.g. 'ssh://user@manager'), defaults to the local docker daemon
+    :type deploy_hosts: list of str or None
+    :param distribute_to: buildservers ('host[:port]') to send the built images to, without using a registry
+    :type distribute_to: list of str or None
     """
     def __init__(
         self,
         name,
         images=[],
         compose_file="docker-compose.yml",
+        deploy_hosts=None,
+        distribute_to=None,
         ):
             self.name = name
             self.images = images
             self._compose_file = compose_file
+            self.deploy_hosts = deploy_hosts
+            self.distribute_to = distribute_to
             self._project_path = None
 
     @property
     def images(self):
-        """A list containing all images for the project"""
+        """A list containing all images for the project, with images having a matrix replaced by their variants"""
         return self._images
 
     @images.setter
     def images(self, value):
         if not isinstance(value, list):
             raise ValueError("Expected list!")
+        images = []
         for element in value:
             if not isinstance(element, Image):
                 raise ValueError("image list contains non-image value")
-        self._images = value
+            # images with a matrix are replaced by their variants
+            images += element.get_variants()
+        self._images = images
+
+    def expand_names(self, names):
+        """
+        Replace the names of images with a matrix by the names of their variants.
+        :param names: names of images
+        :type names: list of str
+        :return: the names of the images to build
+        :rtype: list of str
+        """
+        expanded = []
+        for name in names:
+            variants = [image.name for image in self.images if image.variant_of == name]
+            if len(variants) == 0:
+                variants = [name]
+            for v in variants:
+                if v not in expanded:
+                    expanded.append(v)
+        return expanded
 
     @property
     def project_path(self):
@@ -75,7 +112,102 @@ class Project(object):
 
     @project_path.setter
     def project_path(self, value):
-        self._project_path = None
+        self._project_path = value
+
+    def get_base_images(self, only=None):
+        """
+        Return the images the images of this project are based on.
+        Images which are built by this project are not included.
+        :param only: names of images to check
+        :type only: list or None
+        :return: list of base images
+        :rtype: list of str
+        """
+        own = [image.tag for image in self.images]
+        base_images = []
+        for image in self.images:
+            if only is not None:
+                if image.name not in only:
+                    # skip image
+                    continue
+            for bi in image.get_base_images(self.project_path):
+                if bi in own or bi.split(":")[0] in own:
+                    continue
+                if any([other.matches_reference(bi) for other in self.images]):
+                    continue
+                if bi not in base_images:
+                    base_images.append(bi)
+        return base_images
+
+    def get_affected_images(self, paths, only=None):
+        """
+        Return the names of the images which may be affected by changes of the specified files.
+        :param paths: paths of changed files, relative to the project path
+        :type paths: iterable of str
+        :param only: names of images to consider
+        :type only: list or None
+        :return: names of the affected images, in the order of the images of this project
+        :rtype: list of str
+        """
+        paths = list(paths)
+        names = []
+        for image in self.images:
+            if only is not None:
+                if image.name not in only:
+                    # skip image
+                    continue
+            if any([image.is_affected_by(p) for p in paths]):
+                names.append(image.name)
+        return names
+
+    def get_dependents(self, names):
+        """
+        Return the names of the specified images and of all images based on them (directly or indirectly).
+        :param names: names of the images
+        :type names: iterable of str
+        :return: names of the images, in the order of the images of this project
+        :rtype: list of str
+        """
+        bases = {}
+        for image in self.images:
+            bases[image.name] = image.get_base_images(self.project_path)
+        selected = set(names)
+        changed = True
+        while changed:
+            changed = False
+            for image in self.images:
+                if image.name in selected:
+                    continue
+                for other in self.images:
+                    if other.name not in selected:
+                        continue
+                    if any([other.matches_reference(bi) for bi in bases[image.name]]):
+                        selected.add(image.name)
+                        changed = True
+                        break
+        return [image.name for image in self.images if image.name in selected]
+
+    def get_changed_images(self, revrange, only=None):
+        """
+        Return the names of the images affected by the changes in a git revision range,
+        including all images based on them.
+        :param revrange: the revision range (e.g. 'origin/master...HEAD')
+        :type revrange: str
+        :param only: names of images to consider
+        :type only: list or None
+        :return: names of the affected images, in the order of the images of this project
+        :rtype: list of str
+        """
+        paths = get_changed_paths(self.project_path, revrange)
+        names = self.get_dependents(self.get_affected_images(paths))
+        if only is not None:
+            names = [n for n in names if n in only]
+        return names
+
+    @property
+    def compose_file(self):
+        """the path of the docker-compose.yml file, relative to project_path."""
+        return self._compose_file
 
     def create_zip(self, dest):
         """
@@ -86,6 +218,29 @@ class Project(object):
         with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
             self._rec_zip_write(zf, self.project_path)
 
+    def create_partial_zip(self, dest, paths):
+        """
+        Write the specified files of the project to a zip stored at dest.
+        Directories are written recursively.
+        :param dest: path to write to
+        :type dest: str or unicode
+        :param paths: paths of files to write, relative to the project path
+        :type paths: iterable of str
+        :return: the paths which do not exist (anymore)
+        :rtype: list of str
+        """
+        deleted = []
+        with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for rp in sorted(paths):
+                lp = os.path.join(self.project_path, rp)
+                if os.path.isdir(lp):
+                    self._rec_zip_write(zf, lp, rp)
+                elif os.path.isfile(lp):
+                    zf.write(lp, rp)
+                else:
+                    deleted.append(rp)
+        return deleted
+
     def _rec_zip_write(self, zf, path, relpath=""):
         """
         Write the content of path to zf.
@@ -105,7 +260,7 @@ class Project(object):
                 zf.write(lp, zp)
 
     @defer.inlineCallbacks
-    def build_from_zip(self, zf, protocolfactory=None, only=None):
+    def build_from_zip(self, zf, protocolfactory=None, only=None, cache=None, stats=None, resources=None):
         """
         Build the project from a zipfile.
         :param zf: zipfile to build from
@@ -114,26 +269,157 @@ class Project(object):
         :type protocolfactory: callable
         :param only: which images to built, specified by their name
         :type only: str or unicode or None
+        :param cache: LayerCache to import and export the build caches from/to
+        :type cache: LayerCache or None
+        :param stats: stats to record the duration of the phases in
+        :type stats: BuildStats or None
+        :param resources: pool of the resources the concurrent builds need
+        :type resources: ResourcePool or None
         :return: a deferred which will fire when the project was built
         :rtype: Deferred
         """
-        exitcodes = []
+        if stats is None:
+            stats = BuildStats()
         with self.get_temp_build_dir() as tbp:
-            zf.extractall(tbp)
-            for image in self.images:
+            with stats.measure("extract"):
+                zf.extractall(tbp)
+            exitcodes = yield self.build_from_path(tbp, protocolfactory=protocolfactory, only=only, cache=cache, stats=stats, resources=resources)
 
-                if only is not None:
-                    if image.name not in only:
-                        # skip image
-                        continue
+        defer.returnValue(exitcodes)
 
-                ec = yield image.build(tbp, protocolfactory=protocolfactory)
-                exitcodes.append(ec)
+    @defer.inlineCallbacks
+    def build_from_path(self, path, protocolfactory=None, only=None, cache=None, stats=None, resources=None):
+        """
+        Build the project from the files in a directory.
+        The images are built in order, except for consecutive variants of the same image,
+        which are built concurrently.
+        :param path: path of the project files
+        :type path: str or unicode
+        :param protocolfactory: a callable which returns a protocol to communicate with the child process
+        :type protocolfactory: callable
+        :param only: which images to built, specified by their name
+        :type only: str or unicode or None
+        :param cache: LayerCache to import and export the build caches from/to
+        :type cache: LayerCache or None
+        :param stats: stats to record the duration of the phases in
+        :type stats: BuildStats or None
+        :param resources: pool of the resources the concurrent builds need (defaults to the resources of this machine per call)
+        :type resources: ResourcePool or None
+        :return: a deferred which will fire when the project was built
+        :rtype: Deferred
+        """
+        if stats is None:
+            stats = BuildStats()
+        if resources is None:
+            resources = ResourcePool(*get_host_resources())
+        images = [image for image in self.images if (only is None) or (image.name in only)]
+        preexec_exitcodes = yield self.run_preexec_commands(path, images, protocolfactory=protocolfactory, stats=stats)
+        # group consecutive variants of the same image
+        groups = []
+        for image in images:
+            if groups and image.variant_of is not None and groups[-1][0].variant_of == image.variant_of:
+                groups[-1].append(image)
+            else:
+                groups.append([image])
+        exitcodes = []
+        for group in groups:
+            ds = []
+            for image in group:
+                cpus, memory = image.get_requirements()
+                ds.append(resources.run(cpus, memory, self._build_image, image, path, protocolfactory, cache, stats, preexec_exitcodes[image.name]))
+            try:
+                exitcodes += (yield defer.gatherResults(ds, consumeErrors=True))
+            except defer.FirstError as e:
+                # raise the original error (e.g. CancelledError)
+                e.subFailure.raiseException()
 
         defer.returnValue(exitcodes)
 
     @defer.inlineCallbacks
-    def build_from_zip_path(self, path, protocolfactory=None, only=None):
+    def _build_image(self, image, path, protocolfactory, cache, stats, preexec_exitcode):
+        """
+        Build a single image, unless its preexec command failed.
+        :return: a deferred which will fire with the exitcode
+        :rtype: Deferred
+        """
+        if preexec_exitcode != 0:
+            # error running preexec command
+            defer.returnValue(preexec_exitcode)
+        if cache is not None:
+            image_cache = cache.get_image_cache(self.name, image.name)
+        else:
+            image_cache = None
+        start = time.time()
+        try:
+            ec = yield image.build(path, protocolfactory=protocolfactory, cache=image_cache, preexec=False)
+        finally:
+            stats.add("build", time.time() - start, image=image.name, start=start)
+        defer.returnValue(ec)
+
+    @defer.inlineCallbacks
+    def run_preexec_commands(self, path, images, protocolfactory=None, concurrency=constants.PREEXEC_CONCURRENCY, stats=None):
+        """
+        Execute the preexec commands of the specified images concurrently.
+        Images with the same preexec command and buildpath share a single execution.
+        :param path: path of the project files
+        :type path: str or unicode
+        :param images: images to execute the preexec commands of
+        :type images: list of Image
+        :param protocolfactory: a callable which returns a protocol to communicate with the child process
+        :type protocolfactory: callable
+        :param concurrency: maximum number of preexec commands to execute concurrently
+        :type concurrency: int
+        :param stats: stats to record the duration of the phases in
+        :type stats: BuildStats or None
+        :return: a deferred which will fire with a dict mapping image names to exitcodes
+        :rtype: Deferred
+        """
+        if stats is None:
+            stats = BuildStats()
+        preexec_cache = PreexecCache()
+        semaphore = defer.DeferredSemaphore(concurrency)
+        keys = []
+        ds = []
+        for image in images:
+            if image.preexec_command is None:
+                continue
+            key = (image.buildpath, json.dumps(image.preexec_command))
+            if key not in keys:
+                keys.append(key)
+                ds.append(semaphore.run(self._run_preexec_command, image, path, protocolfactory, preexec_cache))
+        durations = yield defer.gatherResults(ds, consumeErrors=True)
+        results = {}
+        for image in images:
+            if image.preexec_command is None:
+                results[image.name] = 0
+                continue
+            key = (image.buildpath, json.dumps(image.preexec_command))
+            exitcode, start, duration = durations[keys.index(key)]
+            stats.add("preexec", duration, image=image.name, start=start)
+            results[image.name] = exitcode
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def _run_preexec_command(self, image, path, protocolfactory, preexec_cache):
+        """
+        Execute the preexec command of an image and measure its duration.
+        :param image: image to execute the preexec command of
+        :type image: Image
+        :param path: path of the project files
+        :type path: str or unicode
+        :param protocolfactory: a callable which returns a protocol to communicate with the child process
+        :type protocolfactory: callable
+        :param preexec_cache: cache for the outputs of the preexec command
+        :type preexec_cache: PreexecCache
+        :return: a deferred which will fire with a tuple of (exitcode, start, duration)
+        :rtype: Deferred
+        """
+        start = time.time()
+        exitcode = yield image.preexec(path, protocolfactory=protocolfactory, preexec_cache=preexec_cache)
+        defer.returnValue((exitcode, start, time.time() - start))
+
+    @defer.inlineCallbacks
+    def build_from_zip_path(self, path, protocolfactory=None, only=None, cache=None, stats=None, resources=None):
         """
         Build the project from a zipfile at path.
         :param path: path to zipfile to build from
@@ -142,97 +428,158 @@ class Project(object):
         :type protocolfactory: callable
         :param only: which images to built, specified by their name
         :type only: str or unicode or None
+        :param cache: LayerCache to import and export the build caches from/to
+        :type cache: LayerCache or None
+        :param stats: stats to record the duration of the phases in
+        :type stats: BuildStats or None
+        :param resources: pool of the resources the concurrent builds need
+        :type resources: ResourcePool or None
         :return: a deferred which will fire when the project was built
         :rtype: Deferred
         """
         with zipfile.ZipFile(path, "r", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-            res = yield self.build_from_zip(zf, protocolfactory=protocolfactory, only=only)
+            res = yield self.build_from_zip(zf, protocolfactory=protocolfactory, only=only, cache=cache, stats=stats, resources=resources)
         defer.returnValue(res)
 
-    def get_temp_build_dir_path(self):
+    @staticmethod
+    def get_temp_build_dir_path():
         """
         Return a path to a temporary build directory.
         :return: path to a temporary dir
         :rtype: str
         """
-        return os.path.join(
-            tempfile.gettempdir(),
-            constants.TEMP_DIR_NAME,
-            uuid.uuid4().hex,
-            )
+        return get_workspace_path()
 
-    @contextlib.contextmanager
     def get_temp_build_dir(self):
         """
         A contextmanager for working with a temporary build directory.
         The directory will be created before the body of the 'with'-statement
         is executed and will be removed when the body is left.
         """
-        tp = self.get_temp_build_dir_path()
-        os.makedirs(tp)
-        try:
-            yield tp
-        finally:
-            shutil.rmtree(tp)
+        return temporary_workspace()
 
     @defer.inlineCallbacks
-    def push(self, only=None, protocolfactory=None):
+    def push(self, only=None, protocolfactory=None, concurrency=constants.PUSH_CONCURRENCY, stats=None):
         """
         Push all Images to a docker registry.
         If only is not None, only push images whose name is in only.
+        Images already present in the registry are skipped.
         :param only: names of images to push
         :type only: list or None
         :param protocolfactory: a callable which returns a protocol to communicate with the push child process
         :type protocolfactory: callable
-        :return: a deferred which will fire when the command executed successfully
+        :param concurrency: maximum number of images to push concurrently
+        :type concurrency: int
+        :param stats: stats to record the duration of the phases in
+        :type stats: BuildStats or None
+        :return: a deferred which will fire with the exitcodes of the pushes
         :rtype: Deferred
         """
+        sem = defer.DeferredSemaphore(concurrency)
+        ds = []
         for image in self.images:
             if only is not None:
                 if image.name not in only:
                     # skip image
                     continue
-            yield image.push(protocolfactory=protocolfactory)
+            ds.append(sem.run(self._push_image, image, protocolfactory, stats))
+        exitcodes = yield defer.gatherResults(ds, consumeErrors=True)
+        defer.returnValue(exitcodes)
+
+    @defer.inlineCallbacks
+    def _push_image(self, image, protocolfactory, stats):
+        """
+        Push an image and measure the duration of the push.
+        :param image: image to push
+        :type image: Image
+        :param protocolfactory: a callable which returns a protocol to communicate with the push child process
+        :type protocolfactory: callable
+        :param stats: stats to record the duration in
+        :type stats: BuildStats or None
+        :return: a deferred which will fire with the exitcode of the push
+        :rtype: Deferred
+        """
+        if stats is None:
+            stats = BuildStats()
+        with stats.measure("push", image=image.name):
+            exitcode = yield image.push(protocolfactory=protocolfactory)
+        defer.returnValue(exitcode)
 
     @defer.inlineCallbacks
-    def deploy_compose(self, path, pull=False, protocolfactory=None):
+    def deploy_compose(self, path, pull=False, protocolfactory=None, hosts=None):
         """
         Deploy a stack/... defined in a docker-compose.yml.
         This methode should work in both swarm and standalone mode.
+        When deploying to multiple docker hosts, they are deployed to concurrently.
         :param path: path to docker-compose.yml, relative to project_path
         :type path: str or unicode
         :param pull: if True, pull images before deploying.
         :type pull: bool
         :param protocolfactory: a callable which returns a protocol to communicate with the push child process
         :type protocolfactory: callable
+        :param hosts: docker hosts to deploy to, defaults to deploy_hosts
+        :type hosts: list of str or None
+        :return: a deferred which will fire with the exitcodes of the deploy commands, one per host
+        :rtype: Deferred
+        """
+        if hosts is None:
+            hosts = self.deploy_hosts
+        if not hosts:
+            hosts = [None]
+        ds = [self._deploy_compose_to(path, host, pull=pull, protocolfactory=protocolfactory) for host in hosts]
+        try:
+            exitcodes = yield defer.gatherResults(ds, consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+        defer.returnValue(exitcodes)
+
+    @defer.inlineCallbacks
+    def _deploy_compose_to(self, path, host, pull=False, protocolfactory=None):
+        """
+        Deploy a stack/... defined in a docker-compose.yml to a single docker host.
+        :param path: path to docker-compose.yml
+        :type path: str or unicode
+        :param host: the docker host or None for the local docker daemon
+        :type host: str or None
+        :param pull: if True, pull images before deploying.
+        :type pull: bool
+        :param protocolfactory: a callable which returns a protocol to communicate with the push child process
+        :type protocolfactory: callable
+        :return: a deferred which will fire with the exitcode of the deploy command
+        :rtype: Deferred
         """
         p = tempfile.gettempdir()
-        if pull:
+        options = get_host_options(host)
+        swarm = yield get_swarm_state(host)
+        if pull and not swarm:
+            # swarm nodes pull the images themselves
             yield run_command(
                 path=p,
-                executable=constants.DOCKER_EXECUTABLE,
-                command=["docker-compose", "--file", path, "pull"],
+                executable=get_docker_compose_executable(),
+                command=["docker-compose"] + options + ["--file", path, "pull"],
                 protocolfactory=protocolfactory,
             )
-        if in_swarm():
-            yield run_command(
+        if swarm:
+            exitcode = yield run_command(
                 path=p,
-                executable=constants.DOCKER_EXECUTABLE,
-                command=["docker", "stack", "deploy", "-c", path, self.name],
+                executable=get_docker_executable(),
+                command=["docker"] + options + ["stack", "deploy", "-c", path, self.name],
                 protocolfactory=protocolfactory,
             )
         else:
-            yield run_command(
+            exitcode = yield run_command(
                 path=p,
-                executable=constants.DOCKER_COMPOSE_EXECUTABLE,
-                command=["docker-compose", "--file", path, "up", "--no-build", "--force-recreate", "--detach"],
+                executable=get_docker_compose_executable(),
+                command=["docker-compose"] + options + ["--file", path, "up", "--no-build", "--force-recreate", "--detach"],
                 protocolfactory=protocolfactory,
             )
+        defer.returnValue(exitcode)
 
     @defer.inlineCallbacks
-    def deploy_from_zip(self, path, pull=False, protocolfactory=None):
+    def deploy_from_zip(self, path, pull=False, protocolfactory=None, hosts=None):
         """
         Deploy a stack/... defined in a docker-compose.yml in the given zipfile.
+        Only the docker-compose.yml and the files it references are extracted.
         This methode should work in both swarm and standalone mode.
         :param path: path to zipfile
         :type path: str or unicode
@@ -240,11 +587,28 @@ class Project(object):
         :type pull: bool
         :param protocolfactory: a callable which returns a protocol to communicate with the push child process
         :type protocolfactory: callable
+        :param hosts: docker hosts to deploy to, defaults to deploy_hosts
+        :type hosts: list of str or None
+        :return: a deferred which will fire with the exitcodes of the deploy commands, one per host
+        :rtype: Deferred
         """
         with self.get_temp_build_dir() as tbp:
-            with zipfile.ZipFile(path, "r", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-                zf.extractall(tbp)
-            yield self.deploy_compose(os.path.join(tbp, self._compose_file), pull=pull, protocolfactory=protocolfactory)
+            cp = yield threads.deferToThread(self._extract_compose_files, path, tbp)
+            exitcodes = yield self.deploy_compose(cp, pull=pull, protocolfactory=protocolfactory, hosts=hosts)
+        defer.returnValue(exitcodes)
+
+    def _extract_compose_files(self, path, dest):
+        """
+        Extract the docker-compose.yml and the files it references from a zipfile.
+        :param path: path to zipfile
+        :type path: str or unicode
+        :param dest: directory to extract to
+        :type dest: str or unicode
+        :return: the path of the extracted docker-compose.yml
+        :rtype: str
+        """
+        with zipfile.ZipFile(path, "r", allowZip64=True) as zf:
+            return extract_compose_files(zf, self._compose_file, dest)
 
     def dumps(self):
         """
@@ -257,6 +621,8 @@ class Project(object):
             "name": self.name,
             "images": imd,
             "compose_file": self._compose_file,
+            "deploy_hosts": self.deploy_hosts,
+            "distribute_to": self.distribute_to,
             }
         return json.dumps(jdata).encode(constants.ENCODING)
 
@@ -280,6 +646,9 @@ class Project(object):
         """
         parser = argparse.ArgumentParser(description="Build script for this project")
         parser.add_argument("-v", "--verbose", help="be more verbose", action="store_true")
+        parser.add_argument("--profile", action="store", metavar="FILE", default=None, help="profile this run and write a pstats dump to this file")
+        parser.add_argument("--loop-stats", action="store", metavar="FILE", dest="loop_stats", default=None, help="append samples of the event loop lag and thread pool queue depth as JSON lines to this file")
+        parser.add_argument("--loop-stats-interval", action="store", type=float, dest="loop_stats_interval", default=constants.LOOP_STATS_INTERVAL, help="seconds between samples of the event loop")
         subparsers = parser.add_subparsers(dest="command", help="subcommand to execute")
 
         parser_build = subparsers.add_parser("build", help="build this project")
@@ -289,23 +658,83 @@ class Project(object):
         parser_build.add_argument("-P", "--password", action="store", help="password for the buildserver", default=None)
         parser_build.add_argument("-o", "--only", action="store", help="only build images with this name", default=None)
         parser_build.add_argument("--push", action="store_true", dest="do_push", help="push built images to registry")
+        parser_build.add_argument("--push-concurrency", action="store", type=int, dest="push_concurrency", default=constants.PUSH_CONCURRENCY, help="maximum number of images to push concurrently")
         parser_build.add_argument("--deploy", action="store_true", dest="do_deploy", help="deploy project")
+        parser_build.add_argument("--deploy-host", action="append", dest="deploy_hosts", metavar="HOST", default=None, help="docker host or swarm manager to deploy to (instead of the docker daemon of the buildserver). Multiple hosts may be specified.")
+        parser_build.add_argument("--distribute", action="append", dest="distribute_to", metavar="HOST[:PORT]", default=None, help="send the built images to this buildserver, which loads them without using a registry. Multiple buildservers may be specified.")
+        parser_build.add_argument("-d", "--detach", action="store_true", help="do not wait for the build to finish, print the job ids instead")
+        parser_build.add_argument("-a", "--arch", action="append", default=None, help="when building using a broker, build each image on a buildserver of this architecture. Multiple architectures may be specified.")
+        parser_build.add_argument("-D", "--daemon", action="store", nargs="?", const="", metavar="SOCKET", default=None, help="build using the client daemon (fbad-daemon), which keeps sessions to the buildservers between builds")
+        parser_build.add_argument("-t", "--trace", action="store", metavar="FILE", default=None, help="append the spans of the build as JSON lines to this file")
+        parser_build.add_argument("-r", "--report", action="store", metavar="FILE", default=None, help="write the durations of the build phases as JSON to this file")
+        parser_build.add_argument("-c", "--changed", action="store", metavar="REVRANGE", default=None, help="only build images affected by the changes in this git revision range and images based on them")
+
+        parser_watch = subparsers.add_parser("watch", help="rebuild images when their files change")
+        parser_watch.add_argument("-s", "--buildserver", action="append", help="build on target server. Mulitple servers may be specified.", default=None)
+        parser_watch.add_argument("-m", "--buildmode", action="store", choices=("parallel", "multi"), default="parallel", help="How to build images if more then one buildserver is specified")
+        parser_watch.add_argument("-p", "--port", action="store", type=int, help="Connect to this port.", default=constants.DEFAULT_PORT)
+        parser_watch.add_argument("-P", "--password", action="store", help="password for the buildserver", default=None)
+        parser_watch.add_argument("-o", "--only", action="store", help="only build images with this name", default=None)
+        parser_watch.add_argument("--push", action="store_true", dest="do_push", help="push rebuilt images to registry")
+        parser_watch.add_argument("--push-concurrency", action="store", type=int, dest="push_concurrency", default=constants.PUSH_CONCURRENCY, help="maximum number of images to push concurrently")
+        parser_watch.add_argument("--deploy", action="store_true", dest="do_deploy", help="deploy project after each rebuild")
+        parser_watch.add_argument("--debounce", action="store", type=float, default=constants.WATCH_DEBOUNCE, help="seconds to wait for further changes before rebuilding")
+
+        parser_attach = subparsers.add_parser("attach", help="attach to a build job running on a buildserver")
+        parser_attach.add_argument("job", action="store", help="id of the job to attach to")
+        parser_attach.add_argument("-s", "--buildserver", action="store", required=True, help="buildserver the job is running on")
+        parser_attach.add_argument("-p", "--port", action="store", type=int, help="Connect to this port.", default=constants.DEFAULT_PORT)
+        parser_attach.add_argument("-P", "--password", action="store", help="password for the buildserver", default=None)
+        parser_attach.add_argument("-O", "--offset", action="store", type=int, help="start showing the output at this offset", default=0)
+
+        parser_cancel = subparsers.add_parser("cancel", help="cancel a build job running on a buildserver")
+        parser_cancel.add_argument("job", action="store", help="id of the job to cancel")
+        parser_cancel.add_argument("-s", "--buildserver", action="store", required=True, help="buildserver the job is running on")
+        parser_cancel.add_argument("-p", "--port", action="store", type=int, help="Connect to this port.", default=constants.DEFAULT_PORT)
+        parser_cancel.add_argument("-P", "--password", action="store", help="password for the buildserver", default=None)
+
+        parser_status = subparsers.add_parser("status", help="show the status of build jobs on a buildserver")
+        parser_status.add_argument("job", action="store", nargs="?", help="id of the job to show (defaults to all jobs)", default=None)
+        parser_status.add_argument("-s", "--buildserver", action="store", required=True, help="buildserver to query")
+        parser_status.add_argument("-p", "--port", action="store", type=int, help="Connect to this port.", default=constants.DEFAULT_PORT)
+        parser_status.add_argument("-P", "--password", action="store", help="password for the buildserver", default=None)
+
+        parser_deploy = subparsers.add_parser("deploy", help="deploy the project without building it")
+        parser_deploy.add_argument("-H", "--deploy-host", action="append", dest="deploy_hosts", metavar="HOST", default=None, help="docker host or swarm manager to deploy to. Multiple hosts may be specified and are deployed to concurrently.")
+        parser_deploy.add_argument("--pull", action="store_true", help="pull the images before deploying")
 
         ns = parser.parse_args()
 
         if ns.verbose:
             log.startLogging(sys.stdout)
 
-        if ns.command == "build":
-            if ns.buildserver is None:
-                from fbad import server  # import here so server can import project
-                hosts = ["localhost"]
-                factory = server.FBADServerFactory(ns.password)
-                ep = endpoints.TCP4ServerEndpoint(reactor, port=ns.port, interface="localhost")
-                ep.listen(factory)
-            else:
-                hosts = ns.buildserver
-                factory = None
+        from twisted.internet import reactor
+        setup_profiling(reactor, profile=ns.profile, loop_stats=ns.loop_stats, interval=ns.loop_stats_interval)
+
+        if ns.command == "attach":
+            task.react(_run_attach, (ns.buildserver, ns.port, ns.job, ns.offset, sys.stdout, ns.password))
+
+        elif ns.command == "watch":
+            only = (self.expand_names([ns.only]) if ns.only is not None else None)
+            task.react(_run_watch, (self, ns.buildserver, ns.port, only, sys.stdout, ns.password, ns.buildmode, ns.do_push, ns.do_deploy, ns.push_concurrency, ns.debounce))
+
+        elif ns.command == "cancel":
+            task.react(_run_cancel, (ns.buildserver, ns.port, ns.job, sys.stdout, ns.password))
+
+        elif ns.command == "status":
+            task.react(_run_status, (ns.buildserver, ns.port, ns.job, sys.stdout, ns.password))
+
+        elif ns.command == "deploy":
+            if ns.deploy_hosts is not None:
+                self.deploy_hosts = ns.deploy_hosts
+            task.react(_run_deploy, (self, sys.stdout, ns.pull))
+
+        elif ns.command == "build":
+            hosts = ns.buildserver
+            if ns.deploy_hosts is not None:
+                self.deploy_hosts = ns.deploy_hosts
+            if ns.distribute_to is not None:
+                self.distribute_to = ns.distribute_to
 
             if ns.only is None:
                 only = None
@@ -318,18 +747,219 @@ class Project(object):
                 only = [ns.only]
             else:
                 only = None
+            if only is not None:
+                only = self.expand_names(only)
+
+            if ns.changed is not None:
+                try:
+                    only = self.get_changed_images(ns.changed, only=only)
+                except GitError as e:
+                    parser.error(str(e))
+                if len(only) == 0:
+                    print "No images affected."
+                    sys.exit(0)
+                print "Affected images: " + ", ".join(only)
 
-            if len(hosts) == 1:
+            if ns.trace is not None:
+                tracer = Tracer(ns.trace, service="fbad-client@" + socket.gethostname())
+            else:
+                tracer = None
+
+            if ns.arch is not None and (hosts is None or len(hosts) != 1):
+                parser.error("--arch requires a single broker as buildserver")
+            if ns.daemon is not None:
+                if hosts is None:
+                    parser.error("--daemon requires a buildserver")
+                if ns.detach or ns.arch is not None or tracer is not None:
+                    parser.error("--daemon can not be combined with --detach, --arch or --trace")
+                task.react(_run_daemon_build, (ns.daemon, self, hosts, ns.port, only, sys.stdout, ns.password, ns.buildmode, ns.do_push, ns.do_deploy, ns.push_concurrency, ns.report))
+            if hosts is None:
+                if ns.detach:
+                    parser.error("--detach requires a buildserver")
+                task.react(_run_local_build, (self, only, sys.stdout, ns.do_push, ns.do_deploy, ns.push_concurrency, ns.report, tracer, False, None, ns.password))
+            elif len(hosts) == 1:
                 host = hosts[0]
-                task.react(_run_single_build, (host, ns.port, self, only, sys.stdout, ns.password, ns.do_push, ns.do_deploy))
+                task.react(_run_single_build, (host, ns.port, self, only, sys.stdout, ns.password, ns.do_push, ns.do_deploy, ns.detach, ns.push_concurrency, False, ns.report, None, tracer, None, None, ns.arch))
             if ns.buildmode == "multi":
-                task.react(_run_multi_build, (hosts, ns.port, self, only, sys.stdout, ns.password, ns.do_push, ns.do_deploy))
+                task.react(_run_multi_build, (hosts, ns.port, self, only, sys.stdout, ns.password, ns.do_push, ns.do_deploy, ns.detach, ns.push_concurrency, ns.report, tracer))
             elif ns.buildmode == "parallel":
-                task.react(_run_parallel_build, (hosts, ns.port, self, only, sys.stdout, ns.password, ns.do_push, ns.do_deploy))
+                task.react(_run_parallel_build, (hosts, ns.port, self, only, sys.stdout, ns.password, ns.do_push, ns.do_deploy, ns.detach, ns.push_concurrency, ns.report, tracer))
 
 
 @defer.inlineCallbacks
-def _run_single_build(reactor, host, port, project, only, out, password=None, push=False, deploy=False, noexit=False):
+def _run_local_build(reactor, project, only, out, push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, report_path=None, tracer=None, noexit=False, report=None, password=None):
+    """
+    Build the project directly in the project directory, without a buildserver.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param project: the project to build
+    :type project: Project
+    :param only: which images to build
+    :type only: list or None
+    :param out: file to write output to
+    :type out: file-like object
+    :param push: whether to push built images to registry or not
+    :type push: bool
+    :param deploy: whether to deploy project after the build or not.
+    :type deploy: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param report_path: path to write the JSON report to
+    :type report_path: str or unicode or None
+    :param tracer: tracer to write the spans of the build to
+    :type tracer: Tracer or None
+    :param noexit: return the exitcodes instead of exiting
+    :type noexit: bool
+    :param report: report to add the stats of the build to
+    :type report: BuildReport or None
+    :param password: password for the buildservers the images are distributed to
+    :type password: str or None
+    :return: a deferred which will fire with the exit codes if noexit is True.
+    :rtype: Deferred
+    """
+    from fbad import server  # import here so server can import project
+    from fbad.distribution import Distributor
+    jobs = JobManager()
+    job = jobs.create(project, source_path=project.project_path, receive=False)
+    job.stats.span = span = _start_root_span(tracer, project)
+    job.add_listener(OutputWriter(out))
+    protofactory = lambda job=job: server.OutputRelayProtocol(job)
+    trigger = reactor.addSystemEventTrigger("before", "shutdown", job.cancel)
+    try:
+        exitcodes = yield job.start(protofactory, only=only, push=push, deploy=deploy, push_concurrency=push_concurrency, distributor=Distributor(password=password))
+    finally:
+        reactor.removeSystemEventTrigger(trigger)
+        if span is not None:
+            span.end()
+        # the output was already written to out, so the log is not needed
+        jobs.remove(job)
+    if report is None:
+        report = BuildReport()
+    report.add("local", job.stats)
+    if noexit:
+        defer.returnValue(exitcodes)
+    _exit_with_exitcodes(exitcodes, report=report, report_path=report_path)
+
+
+def _run_watch(reactor, project, hosts, port, only, out, password=None, buildmode="parallel", push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, debounce=constants.WATCH_DEBOUNCE):
+    """
+    Watch the project and rebuild affected images when files change.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param project: the project to watch
+    :type project: Project
+    :param hosts: hosts of the buildservers or None to build locally
+    :type hosts: list of str or None
+    :param port: port of the buildservers
+    :type port: int
+    :param only: which images to build
+    :type only: list or None
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildservers
+    :type password: str
+    :param buildmode: how to build images if more than one buildserver is specified
+    :type buildmode: str
+    :param push: whether to push rebuilt images to registry or not
+    :type push: bool
+    :param deploy: whether to deploy project after each rebuild or not.
+    :type deploy: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param debounce: seconds to wait for further changes before rebuilding
+    :type debounce: float
+    :return: a deferred which will fire when the watcher was stopped
+    :rtype: Deferred
+    """
+    from fbad.watch import Watcher  # import here so server can import project
+    watcher = Watcher(
+        reactor,
+        project,
+        hosts,
+        port,
+        out,
+        password=password,
+        only=only,
+        buildmode=buildmode,
+        push=push,
+        deploy=deploy,
+        push_concurrency=push_concurrency,
+        debounce=debounce,
+        )
+    reactor.addSystemEventTrigger("before", "shutdown", watcher.stop)
+    return watcher.start()
+
+
+class OutputWriter(object):
+    """
+    A job listener writing the output of the job to a file.
+    :param out: file to write output to
+    :type out: file-like object
+    """
+    def __init__(self, out):
+        self.out = out
+
+    def send_message(self, msg):
+        """
+        Write a message.
+        :param msg: the message
+        :type msg: str or unicode
+        """
+        self.out.write(msg)
+
+    def send_exitcodes(self, exitcodes, stats=None):
+        """
+        Called when the job finished.
+        :param exitcodes: list of the exitcodes of the processes.
+        :type exitcodes: list of ints
+        :param stats: the stats of the job
+        :type stats: dict or None
+        """
+        pass
+
+
+def _start_root_span(tracer, project):
+    """
+    Start the root span of a build.
+    :param tracer: tracer to write the span to
+    :type tracer: Tracer or None
+    :param project: the project to build
+    :type project: Project
+    :return: the span or None if tracer is None
+    :rtype: Span or None
+    """
+    if tracer is None:
+        return None
+    span = tracer.start_span("build", attributes={"project": project.name})
+    log.msg("Trace id: " + span.trace_id)
+    return span
+
+
+def _exit_with_exitcodes(exitcodes, report=None, report_path=None):
+    """
+    Print the exitcodes and exit the script accordingly.
+    If a report is specified, a summary of the durations of the build phases is printed first.
+    :param exitcodes: the exitcodes of the build
+    :type exitcodes: list of int
+    :param report: the report of the build
+    :type report: BuildReport or None
+    :param report_path: path to write the report to as JSON
+    :type report_path: str or unicode or None
+    """
+    if report is not None and len(report.servers) > 0:
+        print report.format_table()
+        if report_path is not None:
+            report.write(report_path)
+    if len(exitcodes) == 0:
+        print "Error: no images built!"
+        sys.exit(1)
+    else:
+        print "Exitcodes: " + repr(exitcodes)
+        sys.exit(max(exitcodes))
+
+
+@defer.inlineCallbacks
+def _run_single_build(reactor, host, port, project, only, out, password=None, push=False, deploy=False, detach=False, push_concurrency=constants.PUSH_CONCURRENCY, noexit=False, report_path=None, report=None, tracer=None, span=None, jobs=None, arch=None):
     """
     Run a remote build with a single buildserver.
     :param reactor: the twisted reactor
@@ -350,31 +980,59 @@ def _run_single_build(reactor, host, port, project, only, out, password=None, pu
     :type push: bool
     :param deploy: whether to deploy project after the build or not.
     :type deploy: bool
+    :param detach: do not wait for the build, print the job id instead.
+    :type detach: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
     :param noexit: skip script exit
     :type noexit: boolean
+    :param report_path: path to write the JSON report to
+    :type report_path: str or unicode or None
+    :param report: report to add the stats of the build to
+    :type report: BuildReport or None
+    :param tracer: tracer to write the spans of the build to, if span is None
+    :type tracer: Tracer or None
+    :param span: parent span of the build
+    :type span: Span or None
+    :param jobs: if not None, a dict of server and job id is appended for each detached job
+    :type jobs: list or None
+    :param arch: when building using a broker, build each image once for each of these architectures
+    :type arch: list of str or None
     :return: a deferred which will fire with the exit codes.
     :rtype: Deferred
     """
-    d = defer.Deferred()
-    proto = client.FBADClientProtocol(password=password, d=d, out=out)
-    ep = endpoints.TCP4ClientEndpoint(reactor, host, port)
-    endpoints.connectProtocol(ep, proto)
-    exitcodes = yield _run_remote_build(reactor, project, only, d, out=out, push=push, deploy=deploy)
+    if report is None:
+        report = BuildReport()
+    if span is None:
+        root = span = _start_root_span(tracer, project)
+    else:
+        root = None
+    from fbad.client import connect
+    d = connect(reactor, host, port, password=password, out=out)
+    label = "{}:{}".format(host, port)
+    try:
+        result = yield _run_remote_build(reactor, project, only, d, out=out, push=push, deploy=deploy, detach=detach, push_concurrency=push_concurrency, report=report, label=label, span=span, arch=arch)
+    finally:
+        if root is not None:
+            root.end()
 
+    if detach:
+        out.write("Started job {} on {}\n".format(result, label))
+        if jobs is not None:
+            jobs.append({"server": label, "job": result})
+        exitcodes = []
+    else:
+        exitcodes = result
 
     if noexit:
         defer.returnValue(exitcodes)
-
-    if len(exitcodes) == 0:
-        print "Error: no images built!"
-        sys.exit(1)
-    else:
-        print "Exitcodes: " + repr(exitcodes)
-        sys.exit(max(exitcodes))
+    if detach:
+        sys.exit(0)
+    _exit_with_exitcodes(exitcodes, report=report, report_path=report_path)
 
 
 @defer.inlineCallbacks
-def _run_multi_build(reactor, hosts, port, project, only, out, password=None, push=False, deploy=False):
+def _run_multi_build(reactor, hosts, port, project, only, out, password=None, push=False, deploy=False, detach=False, push_concurrency=constants.PUSH_CONCURRENCY, report_path=None, tracer=None, noexit=False, report=None, jobs=None):
     """
     Run a remote build with on each buildserver.
     :param reactor: the twisted reactor
@@ -395,28 +1053,48 @@ def _run_multi_build(reactor, hosts, port, project, only, out, password=None, pu
     :type push: bool
     :param deploy: whether to deploy project after the build or not.
     :type deploy: bool
+    :param detach: do not wait for the build, print the job ids instead.
+    :type detach: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param report_path: path to write the JSON report to
+    :type report_path: str or unicode or None
+    :param tracer: tracer to write the spans of the build to
+    :type tracer: Tracer or None
+    :param noexit: return the exitcodes instead of exiting
+    :type noexit: bool
+    :param report: report to add the stats of the build to
+    :type report: BuildReport or None
+    :param jobs: if not None, a dict of server and job id is appended for each detached job
+    :type jobs: list or None
     :return: a deferred which will fire with the exit codes.
     :rtype: Deferred
     """
+    if report is None:
+        report = BuildReport()
+    span = _start_root_span(tracer, project)
     ds = []
     for host in hosts:
-        d = _run_single_build(reactor, host, port, project, only=only, out=out, password=password, push=push, deploy=deploy, noexit=True)
+        d = _run_single_build(reactor, host, port, project, only=only, out=out, password=password, push=push, deploy=deploy, detach=detach, push_concurrency=push_concurrency, noexit=True, report=report, span=span, jobs=jobs)
         ds.append(d)
-    exitcodeslists = yield defer.gatherResults(ds)
+    try:
+        exitcodeslists = yield defer.gatherResults(ds)
+    finally:
+        if span is not None:
+            span.end()
     exitcodes = []
     for ecl in exitcodeslists:
         exitcodes += ecl
 
-    if len(exitcodes) == 0:
-        print "Error: no images built!"
-        sys.exit(1)
-    else:
-        print "Exitcodes: " + repr(exitcodes)
-        sys.exit(max(exitcodes))
+    if noexit:
+        defer.returnValue(exitcodes)
+    if detach:
+        sys.exit(0)
+    _exit_with_exitcodes(exitcodes, report=report, report_path=report_path)
 
 
 @defer.inlineCallbacks
-def _run_parallel_build(reactor, hosts, port, project, only, out, password=None, push=False, deploy=False):
+def _run_parallel_build(reactor, hosts, port, project, only, out, password=None, push=False, deploy=False, detach=False, push_concurrency=constants.PUSH_CONCURRENCY, report_path=None, tracer=None, noexit=False, report=None, jobs=None):
     """
     Run a remote build distributed between multiple buildservers.
     :param reactor: the twisted reactor
@@ -437,14 +1115,108 @@ def _run_parallel_build(reactor, hosts, port, project, only, out, password=None,
     :type push: bool
     :param deploy: whether to deploy project after the build or not.
     :type deploy: bool
+    :param detach: do not wait for the build, print the job ids instead.
+    :type detach: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param report_path: path to write the JSON report to
+    :type report_path: str or unicode or None
+    :param tracer: tracer to write the spans of the build to
+    :type tracer: Tracer or None
+    :param noexit: return the exitcodes instead of exiting
+    :type noexit: bool
+    :param report: report to add the stats of the build to
+    :type report: BuildReport or None
+    :param jobs: if not None, a dict of server and job id is appended for each detached job
+    :type jobs: list or None
     :return: a deferred which will fire with the exit codes.
     :rtype: Deferred
     """
+    if report is None:
+        report = BuildReport()
+    span = _start_root_span(tracer, project)
+    ds = []
+    for host, batch in _get_parallel_batches(project, hosts, only):
+        d = _run_single_build(reactor, host, port, project, only=batch, out=out, password=password, push=push, deploy=deploy, detach=detach, push_concurrency=push_concurrency, noexit=True, report=report, span=span, jobs=jobs)
+        ds.append(d)
+
+    try:
+        exitcodeslists = yield defer.gatherResults(ds)
+    finally:
+        if span is not None:
+            span.end()
+    exitcodes = []
+    for ecl in exitcodeslists:
+        exitcodes += ecl
+
+    if noexit:
+        defer.returnValue(exitcodes)
+    if detach:
+        sys.exit(0)
+    _exit_with_exitcodes(exitcodes, report=report, report_path=report_path)
+
+
+@defer.inlineCallbacks
+def _run_daemon_build(reactor, socket_path, project, hosts, port, only, out, password=None, buildmode="parallel", push=False, deploy=False, push_concurrency=constants.PUSH_CONCURRENCY, report_path=None):
+    """
+    Run a remote build using the client daemon.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param socket_path: path of the unix socket of the daemon or an empty string for the default path
+    :type socket_path: str
+    :param project: the project to build
+    :type project: Project
+    :param hosts: hosts of the buildservers
+    :type hosts: list of str
+    :param port: port of the buildservers
+    :type port: int
+    :param only: which images to build
+    :type only: list or None
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildservers
+    :type password: str
+    :param buildmode: how to build images if more than one buildserver is specified
+    :type buildmode: str
+    :param push: whether to push built images to registry or not
+    :type push: bool
+    :param deploy: whether to deploy project after the build or not.
+    :type deploy: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param report_path: path to write the JSON report to
+    :type report_path: str or unicode or None
+    :return: a deferred which will fire when the build is done
+    :rtype: Deferred
+    """
+    from fbad import daemon  # import here to keep the startup of the command line fast
+    if not socket_path:
+        socket_path = daemon.get_socket_path()
+    exitcodes, report = yield daemon.build_with_daemon(reactor, socket_path, project, hosts, port, out, password=password, only=only, buildmode=buildmode, push=push, deploy=deploy, push_concurrency=push_concurrency)
+    _exit_with_exitcodes(exitcodes, report=report, report_path=report_path)
+
+
+def _get_parallel_batches(project, hosts, only):
+    """
+    Distribute the images to build between the buildservers.
+    Variants of the same image assigned to the same buildserver are put in the same batch.
+    :param project: the project to build
+    :type project: Project
+    :param hosts: hosts of the buildservers
+    :type hosts: list of str
+    :param only: which images to build
+    :type only: list or None
+    :return: a list of (host, names of the images) tuples, each to be built using a single upload
+    :rtype: list of tuple of (str, list of str)
+    """
     if only is None:
         names = [image.name for image in project.images]
     else:
-        names = only
-    ds = []
+        names = list(only)
+    # variants of the same image assigned to the same host share a single upload
+    variant_of = dict([(image.name, image.variant_of) for image in project.images])
+    batches = []
+    shared = {}
     i = 0
     while len(names) > 0:
         name = names.pop(0)
@@ -452,24 +1224,19 @@ def _run_parallel_build(reactor, hosts, port, project, only, out, password=None,
         i += 1
         if i >= len(hosts):
             i = 0
-        d = _run_single_build(reactor, host, port, project, only=[name], out=out, password=password, push=push, deploy=deploy, noexit=True)
-        ds.append(d)
-
-    exitcodeslists = yield defer.gatherResults(ds)
-    exitcodes = []
-    for ecl in exitcodeslists:
-        exitcodes += ecl
-
-    if len(exitcodes) == 0:
-        print "Error: no images built!"
-        sys.exit(1)
-    else:
-        print "Exitcodes: " + repr(exitcodes)
-        sys.exit(max(exitcodes))
+        key = (host, variant_of.get(name, None))
+        if key[1] is not None and key in shared:
+            shared[key].append(name)
+            continue
+        batch = [name]
+        batches.append((host, batch))
+        if key[1] is not None:
+            shared[key] = batch
+    return batches
 
 
 @defer.inlineCallbacks
-def _run_remote_build(reactor, project, only, d, out, push=False, deploy=False):
+def _run_remote_build(reactor, project, only, d, out, push=False, deploy=False, detach=False, push_concurrency=constants.PUSH_CONCURRENCY, report=None, label=None, span=None, arch=None):
     """
     Run a remote build.
     :param reactor: the twisted reactor
@@ -486,13 +1253,143 @@ def _run_remote_build(reactor, project, only, d, out, push=False, deploy=False):
     :type push: bool
     :param deploy: whether to deploy project after the build or not.
     :type deploy: bool
-    :return: a deferred which will fire with the exit codes.
+    :param detach: do not wait for the build, fire with the job id instead.
+    :type detach: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param report: report to add the stats of the build to
+    :type report: BuildReport or None
+    :param label: name of the buildserver in the report
+    :type label: str or None
+    :param span: parent span of the build
+    :type span: Span or None
+    :param arch: when building using a broker, build each image once for each of these architectures
+    :type arch: list of str or None
+    :return: a deferred which will fire with the exit codes or the job id.
     :rtype: Deferred
     """
     client = yield d
-    with project.get_temp_build_dir() as p:
-        uzp = os.path.join(p, "up.zip")
-        yield threads.deferToThread(project.create_zip, uzp)
-        exitcodes = yield client.remote_build(project, uzp, only=only, push=push, deploy=deploy)
+    if span is not None:
+        span = span.child("remote build", attributes={"server": label})
+    if not detach:
+        # cancel the build on the server when this script is interrupted
+        trigger = reactor.addSystemEventTrigger("before", "shutdown", client.cancel_build)
+    try:
+        with project.get_temp_build_dir() as p:
+            uzp = os.path.join(p, "up.zip")
+            prefetch = project.get_base_images(only=only)
+            start = time.time()
+            yield threads.deferToThread(project.create_zip, uzp)
+            archive_time = time.time() - start
+            if span is not None:
+                span.child("archive", start=start).end(start + archive_time)
+            result = yield client.remote_build(project, uzp, only=only, push=push, deploy=deploy, detach=detach, prefetch=prefetch, push_concurrency=push_concurrency, span=span, arch=arch)
+    finally:
+        if not detach:
+            reactor.removeSystemEventTrigger(trigger)
+        if span is not None:
+            span.end()
+    if report is not None and not detach:
+        client.stats.add("archive", archive_time)
+        report.add(label, client.stats)
     yield client.disconnect()
-    defer.returnValue(exitcodes)
+    defer.returnValue(result)
+
+
+@defer.inlineCallbacks
+def _run_deploy(reactor, project, out, pull=False):
+    """
+    Deploy the project from the project directory.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param project: the project to deploy
+    :type project: Project
+    :param out: file to write output to
+    :type out: file-like object
+    :param pull: whether to pull the images before deploying or not
+    :type pull: bool
+    :return: a deferred which will fire when done
+    :rtype: Deferred
+    """
+    from fbad import server  # import here so server can import project
+    writer = OutputWriter(out)
+    path = os.path.join(project.project_path, project.compose_file)
+    exitcodes = yield project.deploy_compose(path, pull=pull, protocolfactory=lambda: server.OutputRelayProtocol(writer))
+    _exit_with_exitcodes(exitcodes)
+
+
+@defer.inlineCallbacks
+def _run_attach(reactor, host, port, job_id, offset, out, password=None):
+    """
+    Attach to a job running on a buildserver.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param host: host of the buildserver
+    :type host: str
+    :param port: port of the buildserver
+    :type port: int
+    :param job_id: id of the job to attach to
+    :type job_id: str
+    :param offset: offset in the log to start at
+    :type offset: int
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildserver
+    :type password: str
+    """
+    from fbad.client import connect
+    proto = yield connect(reactor, host, port, password=password, out=out)
+    exitcodes = yield proto.attach(job_id, offset=offset)
+    yield proto.disconnect()
+    _exit_with_exitcodes(exitcodes)
+
+
+@defer.inlineCallbacks
+def _run_cancel(reactor, host, port, job_id, out, password=None):
+    """
+    Cancel a job running on a buildserver.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param host: host of the buildserver
+    :type host: str
+    :param port: port of the buildserver
+    :type port: int
+    :param job_id: id of the job to cancel
+    :type job_id: str
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildserver
+    :type password: str
+    """
+    from fbad.client import connect
+    proto = yield connect(reactor, host, port, password=password, out=out)
+    status = yield proto.cancel(job_id)
+    yield proto.disconnect()
+    out.write("Job {job} is now {state}.\n".format(**status))
+
+
+@defer.inlineCallbacks
+def _run_status(reactor, host, port, job_id, out, password=None):
+    """
+    Show the status of jobs running on a buildserver.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param host: host of the buildserver
+    :type host: str
+    :param port: port of the buildserver
+    :type port: int
+    :param job_id: id of the job to show or None
+    :type job_id: str or None
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildserver
+    :type password: str
+    """
+    from fbad.client import connect
+    proto = yield connect(reactor, host, port, password=password, out=out)
+    status = yield proto.get_status(job_id)
+    yield proto.disconnect()
+    if job_id is not None:
+        status = [status]
+    for st in status:
+        out.write("{job}  {project:<20}  {state:<10}  log: {log_start}-{log_end}  exitcodes: {exitcodes}\n".format(**st))
@@ -0,0 +1,185 @@
+"""this module implements packing concurrent builds against the CPUs and memory of a buildserver."""
+import os
+import multiprocessing
+
+from twisted.internet import defer
+
+from fbad import constants
+
+
+def get_host_resources():
+    """
+    Return the number of CPUs and the physical memory of this machine.
+    :return: a tuple of (cpus, memory in bytes)
+    :rtype: tuple of (float, int)
+    """
+    try:
+        cpus = float(multiprocessing.cpu_count())
+    except NotImplementedError:
+        cpus = 1.0
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        memory = None
+    return cpus, memory
+
+
+class ResourcePool(object):
+    """
+    Limits concurrent builds by the CPUs and memory they declared instead of by their number.
+    Requests are granted in order, but a later request which fits may be granted before an
+    earlier one which does not fit yet, unless the earlier request was passed max_bypass times.
+    Requests exceeding the capacity are limited to the capacity, so they run alone.
+    :param cpus: number of CPUs available for builds
+    :type cpus: float
+    :param memory: bytes of memory available for builds or None for no limit
+    :type memory: int or None
+    :param max_bypass: how often a waiting request may be passed by later requests
+    :type max_bypass: int
+    """
+    def __init__(self, cpus, memory=None, max_bypass=constants.RESOURCE_MAX_BYPASS):
+        self.cpus = float(cpus)
+        self.memory = memory
+        self.max_bypass = max_bypass
+        self.used_cpus = 0.0
+        self.used_memory = 0
+        self.running = 0
+        self.waiting = []  # list of [cpus, memory, deferred, times passed]
+
+    def clamp(self, cpus, memory):
+        """
+        Limit a request to the capacity of this pool.
+        :param cpus: requested CPUs
+        :type cpus: float
+        :param memory: requested bytes of memory
+        :type memory: int
+        :return: a tuple of (cpus, memory)
+        :rtype: tuple of (float, int)
+        """
+        cpus = min(float(cpus), self.cpus)
+        if self.memory is None:
+            memory = 0
+        else:
+            memory = min(memory, self.memory)
+        return cpus, memory
+
+    def fits(self, cpus, memory):
+        """
+        Check whether a clamped request can be granted now.
+        :param cpus: requested CPUs
+        :type cpus: float
+        :param memory: requested bytes of memory
+        :type memory: int
+        :return: True if the request fits
+        :rtype: bool
+        """
+        if self.used_cpus + cpus > self.cpus + 1e-9:
+            return False
+        if self.memory is not None and self.used_memory + memory > self.memory:
+            return False
+        return True
+
+    def acquire(self, cpus, memory):
+        """
+        Acquire resources.
+        :param cpus: requested CPUs
+        :type cpus: float
+        :param memory: requested bytes of memory
+        :type memory: int
+        :return: a deferred which will fire with the granted (cpus, memory), which must be passed to release()
+        :rtype: Deferred
+        """
+        cpus, memory = self.clamp(cpus, memory)
+        entry = [cpus, memory, None, 0]
+        entry[2] = defer.Deferred(canceller=lambda d: self._cancel(entry))
+        self.waiting.append(entry)
+        self._grant()
+        return entry[2]
+
+    def release(self, granted):
+        """
+        Release resources acquired using acquire().
+        :param granted: the value the deferred returned by acquire() fired with
+        :type granted: tuple of (float, int)
+        """
+        cpus, memory = granted
+        self.used_cpus = max(self.used_cpus - cpus, 0.0)
+        self.used_memory = max(self.used_memory - memory, 0)
+        self.running -= 1
+        self._grant()
+
+    @defer.inlineCallbacks
+    def run(self, cpus, memory, f, *args, **kwargs):
+        """
+        Acquire resources, call f(*args, **kwargs) and release the resources when it is done.
+        :param cpus: requested CPUs
+        :type cpus: float
+        :param memory: requested bytes of memory
+        :type memory: int
+        :param f: callable to call, may return a deferred
+        :type f: callable
+        :return: a deferred which will fire with the result of f
+        :rtype: Deferred
+        """
+        granted = yield self.acquire(cpus, memory)
+        try:
+            result = yield defer.maybeDeferred(f, *args, **kwargs)
+        finally:
+            self.release(granted)
+        defer.returnValue(result)
+
+    def _grant(self):
+        """
+        Grant waiting requests which fit.
+        """
+        granted = []
+        i = 0
+        while i < len(self.waiting):
+            entry = self.waiting[i]
+            cpus, memory, d, passed = entry
+            if self.fits(cpus, memory):
+                del self.waiting[i]
+                # requests waiting before this one were passed
+                for earlier in self.waiting[:i]:
+                    earlier[3] += 1
+                self.used_cpus += cpus
+                self.used_memory += memory
+                self.running += 1
+                granted.append(entry)
+                continue
+            if passed >= self.max_bypass:
+                # do not let later requests starve this one
+                break
+            i += 1
+        # fire after updating the state, as the callbacks may release resources again
+        for cpus, memory, d, passed in granted:
+            d.callback((cpus, memory))
+
+    def _cancel(self, entry):
+        """
+        Remove a cancelled request.
+        :param entry: the request
+        :type entry: list
+        """
+        for i, e in enumerate(self.waiting):
+            if e is entry:
+                del self.waiting[i]
+                self._grant()
+                break
+
+    def get_status(self):
+        """
+        Return a dict describing the capacity and usage of this pool.
+        :return: the status
+        :rtype: dict
+        """
+        return {
+            "cpus": self.cpus,
+            "memory": self.memory,
+            "used_cpus": self.used_cpus,
+            "used_memory": self.used_memory,
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "waiting_cpus": sum([e[0] for e in self.waiting]),
+            "waiting_memory": sum([e[1] for e in self.waiting]),
+            }
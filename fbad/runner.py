@@ -1,13 +1,23 @@
 """runner functions for entry points"""
 import argparse
+import socket
 import sys
 
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.endpoints import TCP4ServerEndpoint, UNIXServerEndpoint
 
 from fbad import constants
 from fbad.server import FBADServerFactory
+from fbad.cache import LayerCache, parse_peer
+from fbad.dockerutils import setup_buildx_builder
+from fbad.errors import BuilderError
+from fbad.broker import BrokerFactory, BrokerRegistration
+from fbad.metrics import get_metrics_site
+from fbad.tracing import Tracer, merge_traces
+from fbad.profiling import ConnectionProfiler, setup_profiling
+from fbad.utils import parse_size
+from fbad.daemon import ClientDaemon, DaemonFactory, get_socket_path
 
 
 def server_main():
@@ -16,6 +26,28 @@ def server_main():
     parser.add_argument("-i", "--interface", action="store", help="interface to listen on", default="0.0.0.0")
     parser.add_argument("-p", "--port", action="store", type=int, default=constants.DEFAULT_PORT, help="port to listen on")
     parser.add_argument("-P", "--password", action="store", default=None, help="protect this server using this password")
+    parser.add_argument("-c", "--layer-cache", action="store", dest="layer_cache", default=None, help="export and import BuildKit build caches from/to this directory")
+    parser.add_argument("--cache-peer", action="append", dest="cache_peers", default=[], help="share build caches with this buildserver (host[:port]). May be specified multiple times.")
+    parser.add_argument("--builder", action="store", default=constants.BUILDX_BUILDER_NAME, help="buildx builder to build with when using --layer-cache. It is created using the 'docker-container' driver if it does not exist.")
+    parser.add_argument("--cache-peer-password", action="store", dest="cache_peer_password", default=None, help="password for the cache peers (defaults to --password)")
+    parser.add_argument("--prefetch-concurrency", action="store", type=int, dest="prefetch_concurrency", default=constants.PREFETCH_CONCURRENCY, help="maximum number of base images to pull concurrently per build")
+    parser.add_argument("--metrics-port", action="store", type=int, dest="metrics_port", default=None, help="serve metrics in the prometheus text format on this port")
+    parser.add_argument("--metrics-interface", action="store", dest="metrics_interface", default=None, help="interface to serve metrics on (defaults to --interface)")
+    parser.add_argument("--trace", action="store", metavar="FILE", default=None, help="append the spans of all jobs as JSON lines to this file")
+    parser.add_argument("--cpus", action="store", type=float, default=None, help="CPUs available for builds (defaults to the number of CPUs). Images are built concurrently as long as the CPUs they need fit.")
+    parser.add_argument("--memory", action="store", type=parse_size, default=None, metavar="SIZE", help="memory available for builds (e.g. 16G, defaults to the physical memory). Used like --cpus.")
+    parser.add_argument("--ram-workspace", action="store", dest="ram_workspace", metavar="DIR", default=None, help="receive and extract project files in this directory backed by memory (e.g. /dev/shm) if they fit into --ram-budget")
+    parser.add_argument("--ram-budget", action="store", type=parse_size, dest="ram_budget", default=None, metavar="SIZE", help="memory the workspaces in --ram-workspace may use together (defaults to a quarter of the physical memory, which is not available for builds)")
+    parser.add_argument("--ram-threshold", action="store", type=parse_size, dest="ram_threshold", default=constants.RAM_WORKSPACE_THRESHOLD, metavar="SIZE", help="place workspaces larger than this (archive and extracted files) on disk")
+    parser.add_argument("--disk-budget", action="store", type=parse_size, dest="disk_budget", default=None, metavar="SIZE", help="keep at least this much disk space (e.g. 20G) free by removing the least recently built images")
+    parser.add_argument("--collect-interval", action="store", type=float, dest="collect_interval", default=constants.COLLECT_INTERVAL, help="seconds between removals of stale workspaces (and images, see --disk-budget)")
+    parser.add_argument("--profile", action="store", metavar="DIR", default=None, help="profile the server and write a pstats dump to this directory whenever a connection was closed")
+    parser.add_argument("--loop-stats", action="store", metavar="FILE", dest="loop_stats", default=None, help="append samples of the event loop lag and thread pool queue depth as JSON lines to this file")
+    parser.add_argument("--loop-stats-interval", action="store", type=float, dest="loop_stats_interval", default=constants.LOOP_STATS_INTERVAL, help="seconds between samples of the event loop")
+    parser.add_argument("--distribute-password", action="store", dest="distribute_password", default=None, help="password for the buildservers built images are distributed to (defaults to --password)")
+    parser.add_argument("--broker", action="store", metavar="HOST[:PORT]", default=None, help="register with this broker")
+    parser.add_argument("--broker-password", action="store", dest="broker_password", default=None, help="password for the broker (defaults to --password)")
+    parser.add_argument("--advertise", action="store", metavar="HOST[:PORT]", default=None, help="address the broker should connect to (defaults to the address the broker sees and --port)")
     parser.add_argument("-v", "--verbose", action="store_true", help="be more verbose")
     parser.add_argument("-V", "--version", action="store_true", help="print version and exit")
     ns = parser.parse_args()
@@ -30,8 +62,135 @@ def server_main():
     if ns.verbose:
         log.startLogging(sys.stdout)
 
-    factory = FBADServerFactory(ns.password)
+    if ns.layer_cache is not None:
+        if ns.cache_peer_password is not None:
+            peer_password = ns.cache_peer_password
+        else:
+            peer_password = ns.password
+        peers = [parse_peer(p) for p in ns.cache_peers]
+        try:
+            setup_buildx_builder(ns.builder)
+        except BuilderError as e:
+            parser.error(str(e))
+        layer_cache = LayerCache(ns.layer_cache, peers=peers, password=peer_password, builder=ns.builder)
+        log.msg("Warning: declared CPUs and memory of images are only used for scheduling, not enforced as limits, while using a layer cache")
+    else:
+        layer_cache = None
+
+    if ns.trace is not None:
+        tracer = Tracer(ns.trace, service="fbad-server@{}:{}".format(socket.gethostname(), ns.port))
+    else:
+        tracer = None
+
+    if ns.profile is not None:
+        profiler = ConnectionProfiler(ns.profile)
+        profiler.start()
+        reactor.addSystemEventTrigger("after", "shutdown", profiler.stop_all)
+    else:
+        profiler = None
+    setup_profiling(reactor, loop_stats=ns.loop_stats, interval=ns.loop_stats_interval)
+
+    factory = FBADServerFactory(ns.password, layer_cache=layer_cache, prefetch_concurrency=ns.prefetch_concurrency, tracer=tracer, profiler=profiler, disk_budget=ns.disk_budget, collect_interval=ns.collect_interval, cpus=ns.cpus, memory=ns.memory,
+        distribute_password=(ns.distribute_password if ns.distribute_password is not None else ns.password),
+        ram_workspace=ns.ram_workspace, ram_budget=ns.ram_budget, ram_threshold=ns.ram_threshold,
+        )
+    reactor.callWhenRunning(factory.collector.start)
     ep = TCP4ServerEndpoint(reactor, port=ns.port, interface=ns.interface)
     ep.listen(factory)
 
+    if ns.broker is not None:
+        broker_host, broker_port = parse_peer(ns.broker)
+        if ":" not in ns.broker:
+            broker_port = constants.DEFAULT_BROKER_PORT
+        if ns.advertise is not None:
+            advertise_host, advertise_port = parse_peer(ns.advertise)
+            if ":" not in ns.advertise:
+                advertise_port = ns.port
+        else:
+            advertise_host, advertise_port = None, ns.port
+        registration = BrokerRegistration(
+            factory,
+            broker_host,
+            broker_port,
+            password=(ns.broker_password if ns.broker_password is not None else ns.password),
+            advertise_host=advertise_host,
+            advertise_port=advertise_port,
+            )
+        reactor.callWhenRunning(registration.start)
+        reactor.addSystemEventTrigger("before", "shutdown", registration.stop)
+
+    if ns.metrics_port is not None:
+        if ns.metrics_interface is not None:
+            metrics_interface = ns.metrics_interface
+        else:
+            metrics_interface = ns.interface
+        mep = TCP4ServerEndpoint(reactor, port=ns.metrics_port, interface=metrics_interface)
+        mep.listen(get_metrics_site(factory.metrics))
+
     reactor.run()
+
+
+def broker_main():
+    """entry point for the broker"""
+    parser = argparse.ArgumentParser(description="The FBAD Broker, distributing builds across registered buildservers")
+    parser.add_argument("-i", "--interface", action="store", help="interface to listen on", default="0.0.0.0")
+    parser.add_argument("-p", "--port", action="store", type=int, default=constants.DEFAULT_BROKER_PORT, help="port to listen on")
+    parser.add_argument("-P", "--password", action="store", default=None, help="password for clients and buildservers connecting to the broker")
+    parser.add_argument("--worker-password", action="store", dest="worker_password", default=None, help="password for connecting to the buildservers (defaults to --password)")
+    parser.add_argument("--metrics-port", action="store", type=int, dest="metrics_port", default=None, help="serve metrics in the prometheus text format on this port")
+    parser.add_argument("--trace", action="store", metavar="FILE", default=None, help="append the spans of all jobs as JSON lines to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="be more verbose")
+    ns = parser.parse_args()
+
+    if ns.verbose:
+        log.startLogging(sys.stdout)
+
+    if ns.trace is not None:
+        tracer = Tracer(ns.trace, service="fbad-broker@{}:{}".format(socket.gethostname(), ns.port))
+    else:
+        tracer = None
+
+    worker_password = (ns.worker_password if ns.worker_password is not None else ns.password)
+    factory = BrokerFactory(ns.password, worker_password=worker_password, tracer=tracer)
+    ep = TCP4ServerEndpoint(reactor, port=ns.port, interface=ns.interface)
+    ep.listen(factory)
+
+    if ns.metrics_port is not None:
+        mep = TCP4ServerEndpoint(reactor, port=ns.metrics_port, interface=ns.interface)
+        mep.listen(get_metrics_site(factory.metrics))
+
+    reactor.run()
+
+
+def daemon_main():
+    """entry point for the client daemon"""
+    parser = argparse.ArgumentParser(description="The FBAD client daemon, keeping sessions to the buildservers between builds")
+    parser.add_argument("-s", "--socket", action="store", default=None, help="path of the unix socket to listen on (defaults to a socket in $XDG_RUNTIME_DIR or the temp directory)")
+    parser.add_argument("--session-timeout", action="store", type=float, dest="session_timeout", default=constants.DAEMON_SESSION_TIMEOUT, help="seconds after the last build to close a session to a buildserver")
+    parser.add_argument("-v", "--verbose", action="store_true", help="be more verbose")
+    ns = parser.parse_args()
+
+    if ns.verbose:
+        log.startLogging(sys.stdout)
+
+    if ns.socket is not None:
+        socket_path = ns.socket
+    else:
+        socket_path = get_socket_path()
+    daemon = ClientDaemon(reactor, session_timeout=ns.session_timeout)
+    reactor.addSystemEventTrigger("before", "shutdown", daemon.stop)
+    # only the current user may connect, as builds use the passwords of the buildservers
+    ep = UNIXServerEndpoint(reactor, socket_path, mode=0o600, wantPID=True)
+    ep.listen(DaemonFactory(daemon))
+
+    reactor.run()
+
+
+def trace_main():
+    """entry point for merging trace files"""
+    parser = argparse.ArgumentParser(description="Merge FBAD trace files into a single timeline")
+    parser.add_argument("files", nargs="+", help="files written using --trace")
+    parser.add_argument("-o", "--output", action="store", required=True, help="file to write the merged trace to")
+    parser.add_argument("-f", "--format", action="store", choices=("chrome", "otlp"), default="chrome", help="format of the merged trace")
+    ns = parser.parse_args()
+    merge_traces(ns.files, ns.output, format=ns.format)
@@ -2,16 +2,32 @@
 import os
 import hashlib
 import json
+import signal
+import shutil
+import time
 
-from twisted.internet import defer, error
+from twisted.internet import defer, error, reactor, task, threads
+from twisted.python import log
 from twisted.protocols.basic import IntNStringReceiver
+from twisted.protocols.policies import TimeoutMixin
 from twisted.internet.protocol import Factory, ProcessProtocol
 
 from fbad import constants
 from fbad.project import Project
-
-
-class FBADServerProtocol(IntNStringReceiver):
+from fbad.jobs import JobManager
+from fbad.shutils import kill_process_tree, kill_pids, run_command, CollectingProcessProtocol
+from fbad.cache import get_arch
+from fbad.dockerutils import get_image_layers, get_docker_executable
+from fbad.distribution import Distributor
+from fbad.resources import ResourcePool, get_host_resources
+from fbad.timing import get_buffer_size
+from fbad.metrics import ServerMetrics
+from fbad.collector import Collector
+from fbad.workspace import WorkspaceAllocator, get_zip_content_size, temporary_workspace
+from fbad.errors import UploadTooLarge
+
+
+class FBADServerProtocol(IntNStringReceiver, TimeoutMixin):
     """The protocol for the FBAD server."""
     structFormat = constants.MESSAGE_LENGTH_PREFIX
     prefixLength = constants.MESSAGE_LENGTH_PREFIX_LENGTH
@@ -28,10 +44,38 @@ class FBADServerProtocol(IntNStringReceiver):
         """
         Called when the connection to a client was established.
         """
+        self.factory.metrics.connections.inc()
         self.state = self.STATE_WAIT_VERSION
         self.project = None  # current project
         self.outf = None  # file to write received data to
         self.recv_d = None  # deferred to callback when a file was received.
+        self.recv_limit = None  # maximum number of bytes to receive or None
+        self.job = None  # job this connection is listening to
+        self.session_path = None  # project files kept between builds
+        self.setTimeout(constants.HEARTBEAT_TIMEOUT)
+        self.heartbeat_loop = task.LoopingCall(self.send_heartbeat)
+        self.heartbeat_loop.start(constants.HEARTBEAT_INTERVAL, now=False)
+
+    def dataReceived(self, data):
+        """
+        Called when data was received.
+        :param data: the received data
+        :type data: str
+        """
+        self.resetTimeout()
+        IntNStringReceiver.dataReceived(self, data)
+
+    def timeoutConnection(self):
+        """
+        Called when the client did not send anything (including heartbeats) for too long.
+        """
+        self.transport.abortConnection()
+
+    def send_heartbeat(self):
+        """
+        Send a heartbeat to the client.
+        """
+        self.sendString(constants.HEARTBEAT_MESSAGE)
 
     def stringReceived(self, msg):
         """
@@ -40,7 +84,11 @@ class FBADServerProtocol(IntNStringReceiver):
         :type msg: str
         """
 
-        if self.state == self.STATE_IGNORE:
+        if msg == constants.HEARTBEAT_MESSAGE:
+            # heartbeat; the timeout was already reset
+            pass
+
+        elif self.state == self.STATE_IGNORE:
             # ignore message
             pass
 
@@ -56,6 +104,9 @@ class FBADServerProtocol(IntNStringReceiver):
         elif self.state == self.STATE_FILE_RECEIVE:
             self.handle_file_data(msg)
 
+        elif self.state == self.STATE_BUILDING:
+            self.handle_building_command(msg)
+
         else:
             self.handle_protocol_violation(msg)
 
@@ -95,7 +146,6 @@ class FBADServerProtocol(IntNStringReceiver):
             self.state = self.STATE_IGNORE
             self.transport.loseConnection()
 
-    @defer.inlineCallbacks
     def handle_command(self, msg):
         """
         Handle a command.
@@ -103,37 +153,527 @@ class FBADServerProtocol(IntNStringReceiver):
         :type msg: str
         """
         info = json.loads(msg.decode(constants.ENCODING))
-        if info["command"] == "build":
+        command = info.get("command", None)
+        if command == "build":
+            self.handle_build(info)
+        elif command == "update":
+            self.handle_update(info)
+        elif command == "attach":
+            self.handle_attach(info)
+        elif command == "status":
+            self.handle_status(info)
+        elif command == "cancel":
+            self.handle_cancel(info)
+        elif command == "info":
+            self.handle_info(info)
+        elif command == "cache_put":
+            self.handle_cache_put(info)
+        elif command == "cache_blobs":
+            self.handle_cache_blobs(info)
+        elif command == "image_layers":
+            self.handle_image_layers(info)
+        elif command == "image_load":
+            self.handle_image_load(info)
+        else:
+            self.handle_protocol_violation(msg)
+
+    def handle_info(self, info):
+        """
+        Handle an info command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        jdata = {
+            "type": "info",
+            "version": constants.COM_VERSION,
+            "arch": get_arch(),
+            }
+        self.sendString(json.dumps(jdata).encode(constants.ENCODING))
+
+    @defer.inlineCallbacks
+    def handle_cache_put(self, info):
+        """
+        Handle a cache_put command.
+        The build cache will be received and stored in the layer cache.
+        :param info: the decoded command
+        :type info: dict
+        """
+        cache = self.factory.layer_cache
+        self.state = self.STATE_BUILDING
+        self.recv_d = defer.Deferred()
+        with temporary_workspace() as tp:
+            zp = os.path.join(tp, "cache.zip")
+            self.outf = open(zp, "wb")
+            self.state = self.STATE_FILE_RECEIVE
+            try:
+                yield self.recv_d
+            except Exception:
+                # upload failed or connection lost
+                return
+            finally:
+                self.outf.close()
+                self.outf = None
+                self.recv_d = None
+            self.state = self.STATE_BUILDING
+            if cache is None:
+                self.send_error("This server has no layer cache!")
+            elif info.get("arch", None) != cache.arch:
+                self.send_error("Architecture mismatch!")
+            else:
+                try:
+                    yield threads.deferToThread(cache.unpack, info["key"], zp, blobs=info.get("blobs", None))
+                except Exception:
+                    log.err(None, "Error storing received cache")
+                    self.send_error("Could not store cache!")
+                else:
+                    self.sendString(json.dumps({"type": "ok"}).encode(constants.ENCODING))
+            self.state = self.STATE_READY
+
+    @defer.inlineCallbacks
+    def handle_cache_blobs(self, info):
+        """
+        Handle a cache_blobs command.
+        The blobs of a build cache in the layer cache will be send.
+        :param info: the decoded command
+        :type info: dict
+        """
+        cache = self.factory.layer_cache
+        self.state = self.STATE_BUILDING
+        if cache is None:
+            self.send_error("This server has no layer cache!")
+        elif info.get("arch", None) != cache.arch:
+            self.send_error("Architecture mismatch!")
+        else:
+            try:
+                blobs = yield threads.deferToThread(cache.list_blobs, info["key"])
+            except Exception:
+                log.err(None, "Error listing cache blobs")
+                self.send_error("Could not list cache blobs!")
+            else:
+                self.sendString(json.dumps({"type": "blobs", "blobs": blobs}).encode(constants.ENCODING))
+        self.state = self.STATE_READY
+
+    @defer.inlineCallbacks
+    def handle_image_layers(self, info):
+        """
+        Handle an image_layers command.
+        The diff ids of the layers of all images of the docker daemon will be send.
+        :param info: the decoded command
+        :type info: dict
+        """
+        self.state = self.STATE_BUILDING
+        layers = yield get_image_layers()
+        self.sendString(json.dumps({"type": "layers", "layers": layers}).encode(constants.ENCODING))
+        self.state = self.STATE_READY
+
+    @defer.inlineCallbacks
+    def handle_image_load(self, info):
+        """
+        Handle an image_load command.
+        The archive written by 'docker save' will be received and loaded into the docker daemon.
+        :param info: the decoded command
+        :type info: dict
+        """
+        self.state = self.STATE_BUILDING
+        self.recv_d = defer.Deferred()
+        with temporary_workspace() as tp:
+            ap = os.path.join(tp, "images.tar")
+            self.outf = open(ap, "wb")
+            self.state = self.STATE_FILE_RECEIVE
+            try:
+                yield self.recv_d
+            except Exception:
+                # upload failed or connection lost
+                return
+            finally:
+                self.outf.close()
+                self.outf = None
+                self.recv_d = None
             self.state = self.STATE_BUILDING
-            projectdata = info["project"]
-            only = info.get("only", None)
-            do_push = info.get("push", False)
-            do_deploy = info.get("deploy", False)
-            do_pull = do_push
-            self.project = Project.loads(projectdata)
+            protocol = CollectingProcessProtocol()
+            exitcode = yield run_command(
+                path=tp,
+                executable=get_docker_executable(),
+                command=["docker", "load", "-i", ap],
+                protocolfactory=lambda: protocol,
+                )
+            if exitcode != 0:
+                self.send_error("Could not load images: " + protocol.output.strip())
+            else:
+                self.sendString(json.dumps({"type": "ok", "output": protocol.output}).encode(constants.ENCODING))
+            self.state = self.STATE_READY
+
+    def handle_building_command(self, msg):
+        """
+        Handle a command received while a build is in progress.
+        Only cancelling the current job is allowed.
+        :param msg: the command
+        :type msg: str
+        """
+        info = json.loads(msg.decode(constants.ENCODING))
+        if info.get("command", None) == "cancel" and self.job is not None:
+            self.job.cancel()
+        else:
+            self.handle_protocol_violation(msg)
+
+    def handle_cancel(self, info):
+        """
+        Handle a cancel command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        job = self.factory.jobs.get(info.get("job", None))
+        if job is None:
+            self.send_error("No such job!")
+            return
+        job.cancel()
+        jdata = {
+            "type": "status",
+            "status": job.get_status(),
+            }
+        self.sendString(json.dumps(jdata).encode(constants.ENCODING))
 
+    def handle_build(self, info):
+        """
+        Handle a build command.
+        If 'keep' is set, the project files are kept on the server as a session
+        which can be modified using the update command.
+        :param info: the decoded command
+        :type info: dict
+        """
+        self.project = Project.loads(info["project"])
+        if info.get("keep", False):
+            self.remove_session()
+            self.session_path = self.factory.workspaces.allocate(info.get("context_size", None))
+            self.factory.sessions.add(self.session_path)
+        self.receive_and_run(info, source_path=self.session_path)
+
+    def handle_update(self, info):
+        """
+        Handle an update command.
+        The received archive contains the changed files of the session.
+        :param info: the decoded command
+        :type info: dict
+        """
+        if self.session_path is None:
+            self.discard_upload("No session!")
+            return
+        self.receive_and_run(info, source_path=self.session_path, deleted=info.get("deleted", []))
+
+    @defer.inlineCallbacks
+    def discard_upload(self, errormsg):
+        """
+        Receive and discard a file, then send an error message.
+        :param errormsg: the error message to send
+        :type errormsg: str or unicode
+        """
+        self.recv_d = defer.Deferred()
+        self.outf = open(os.devnull, "wb")
+        self.state = self.STATE_FILE_RECEIVE
+        try:
+            yield self.recv_d
+        except Exception:
+            # connection lost
+            return
+        finally:
+            self.outf.close()
+            self.outf = None
+            self.recv_d = None
+        self.send_error(errormsg)
+        self.state = self.STATE_READY
+
+    def remove_session(self):
+        """
+        Remove the project files of the current session.
+        If a job is still using them, they will be removed when the job is done.
+        """
+        if self.session_path is None:
+            return
+        sp, self.session_path = self.session_path, None
+        self.factory.sessions.discard(sp)
+        if self.job is not None and self.job.d is not None:
+            self.job.d.addBoth(lambda r, sp=sp: self.remove_workspace(sp) or r)
+        else:
+            self.remove_workspace(sp)
+
+    def remove_workspace(self, path):
+        """
+        Remove a workspace and release the memory reserved for it.
+        :param path: path of the workspace
+        :type path: str or unicode
+        """
+        shutil.rmtree(path, ignore_errors=True)
+        self.factory.workspaces.release(path)
+
+    @defer.inlineCallbacks
+    def receive_and_run(self, info, source_path=None, deleted=None):
+        """
+        Create a job, receive the project files and run the job.
+        :param info: the decoded build or update command
+        :type info: dict
+        :param source_path: if specified, extract the received files into this directory and build there
+        :type source_path: str or unicode or None
+        :param deleted: paths to remove from source_path before building
+        :type deleted: list of str or None
+        """
+        self.state = self.STATE_BUILDING
+        detach = info.get("detach", False)
+        workspaces = self.factory.workspaces
+        size = info.get("size", None)
+        context_size = info.get("context_size", None)
+        if source_path is not None:
+            workspace_size = size
+        elif size is not None and context_size is not None:
+            # the archive is extracted into the workspace of the job
+            workspace_size = size + context_size
+        else:
+            workspace_size = None
+        self.job = job = self.factory.jobs.create(self.project, source_path=source_path, allocator=workspaces, size=workspace_size)
+        prefetch = info.get("prefetch", None)
+        if prefetch:
+            # pull base images while the project files are received
+            job.prefetch(prefetch, concurrency=self.factory.prefetch_concurrency)
+        if self.factory.collector is not None:
+            # make room for this job without delaying it
+            self.factory.collector.collect()
+        span = self.start_job_span(job, info.get("trace", None))
+        job.stats.span = span
+        if not detach:
+            job.add_listener(self)
+        self.send_job(job)
+
+        # jobs failing before they are started are recorded as well
+        try:
             # receive project data
             self.recv_d = defer.Deferred()
-            with self.project.get_temp_build_dir() as tp:
-                zp = os.path.join(tp, "projectdata.zip")
-                self.outf = open(zp, "wb")
-                self.state = self.STATE_FILE_RECEIVE
+            if workspaces.in_memory(job.workspace):
+                # do not let the client exceed the memory reserved for the archive
+                self.recv_limit = size
+            self.outf = open(job.archive_path, "wb")
+            self.state = self.STATE_FILE_RECEIVE
+            job.d = self.recv_d
+            receive_start = time.time()
+            try:
                 yield self.recv_d
-                self.srare = self.STATE_BUILDING
-                self.outf.flush()
+            except Exception as e:
+                # upload failed, cancelled or connection lost
+                cancelled_by_client = (self.state == self.STATE_BUILDING)
+                if not cancelled_by_client:
+                    job.remove_listener(self)
+                if isinstance(e, defer.CancelledError):
+                    job.send_message("Job cancelled.\n")
+                    job.abort(job.STATE_CANCELLED)
+                else:
+                    job.abort()
+                if cancelled_by_client:
+                    self.job = None
+                    self.state = self.STATE_READY
+                elif self.state == self.STATE_FILE_RECEIVE:
+                    self.state = self.STATE_IGNORE
+                    self.transport.loseConnection()
+                return
+            finally:
+                job.stats.add("receive", time.time() - receive_start, start=receive_start)
+                job.d = None
                 self.outf.close()
-                protofactory = lambda self=self: OutputRelayProtocol(self, d=defer.Deferred())
-                exitcodes = yield self.project.build_from_zip_path(zp, protocolfactory=protofactory, only=only)
-                if do_push:
-                    yield self.project.push(only=only, protocolfactory=protofactory)
-                if do_deploy:
-                    yield self.project.deploy_from_zip(zp, pull=do_pull, protocolfactory=protofactory)
-                self.send_exitcodes(exitcodes)
+                self.outf = None
+                self.recv_d = None
+                self.recv_limit = None
+            self.state = self.STATE_BUILDING
+            # moving a workspace can not be interrupted, so a job cancelled meanwhile is aborted afterwards
+            cancelled = []
+            job.d = defer.Deferred(canceller=lambda d: cancelled.append(True))
+            job.d.addErrback(lambda f: f.trap(defer.CancelledError))
+            try:
+                yield self.spill_workspaces(job, info)
+            except Exception:
+                log.err(None, "Could not move workspace of job {} to disk".format(job.id))
+                job.remove_listener(self)
+                job.abort()
+                self.send_error("Could not store the project files!")
+                self.job = None
+                self.state = self.STATE_READY
+                return
+            finally:
+                job.d = None
+            if len(cancelled) > 0:
+                job.send_message("Job cancelled.\n")
+                job.abort(job.STATE_CANCELLED)
+                self.job = None
+                self.state = self.STATE_READY
+                return
+            if detach:
+                self.job = None
+                self.state = self.STATE_READY
+            else:
+                self.state = self.STATE_BUILDING
+            yield self.start_job(job, info, deleted=deleted)
+        finally:
+            self.factory.metrics.observe_job(job)
+            if self.factory.collector is not None:
+                self.factory.collector.observe_job(job)
+            if span is not None:
+                span.attributes["state"] = job.state
+                span.end()
 
-            self.state = self.STATE_READY
+    @defer.inlineCallbacks
+    def spill_workspaces(self, job, info):
+        """
+        Move the workspace of a job and the session it builds to disk if the received
+        files turned out not to fit into the memory reserved for them.
+        :param job: the job which received the files
+        :type job: Job
+        :param info: the decoded build or update command
+        :type info: dict
+        :return: a deferred which will fire when done
+        :rtype: Deferred
+        """
+        workspaces = self.factory.workspaces
+        sp = job.source_path
+        if not workspaces.in_memory(job.workspace) and (sp is None or not workspaces.in_memory(sp)):
+            return
+        content_size = yield threads.deferToThread(get_zip_content_size, job.archive_path)
+        if sp is None:
+            size = None
+            if content_size is not None:
+                size = os.path.getsize(job.archive_path) + content_size
+            if not workspaces.resize(job.workspace, size):
+                job.workspace = yield workspaces.spill(job.workspace)
+        elif workspaces.in_memory(sp):
+            if content_size is not None and info.get("command", None) == "update":
+                # files are replaced or added, so this may overestimate
+                content_size += workspaces.reserved[sp]
+            in_use = [j for j in self.factory.jobs.jobs.values() if j is not job and not j.done and j.source_path == sp]
+            # a session can not be moved while other jobs build it, so it is kept in memory over budget
+            if workspaces.resize(sp, content_size, force=(len(in_use) > 0)):
+                return
+            if len(in_use) > 0:
+                log.msg("Session {} exceeds the memory budget, but is in use by {} job(s)".format(sp, len(in_use)))
+                job.send_message("Warning: project files exceed the memory reserved for them.\n")
+            else:
+                # if moving fails, the session is kept in memory
+                job.source_path = yield workspaces.spill(sp)
+                self.factory.sessions.discard(sp)
+                self.factory.sessions.add(job.source_path)
+                if self.session_path == sp:
+                    self.session_path = job.source_path
+
+    def start_job(self, job, info, deleted=None):
+        """
+        Start a job after its project files were received.
+        :param job: the job
+        :type job: Job
+        :param info: the decoded build or update command
+        :type info: dict
+        :param deleted: paths to remove from the source path before building
+        :type deleted: list of str or None
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        metrics = self.factory.metrics
+        protofactory = lambda job=job: OutputRelayProtocol(job, metrics=metrics)
+        return job.start(
+            protofactory,
+            only=info.get("only", None),
+            push=info.get("push", False),
+            deploy=info.get("deploy", False),
+            cache=self.factory.layer_cache,
+            push_concurrency=info.get("push_concurrency", constants.PUSH_CONCURRENCY),
+            deleted=deleted,
+            resources=self.factory.resources,
+            distributor=self.factory.distributor,
+            )
+
+    def start_job_span(self, job, context):
+        """
+        Start the span of a job, if this server writes traces.
+        :param job: the job
+        :type job: Job
+        :param context: the trace context propagated by the client or None
+        :type context: dict or None
+        :return: the span or None
+        :rtype: Span or None
+        """
+        if self.factory.tracer is None:
+            return None
+        if context is None:
+            context = {}
+        return self.factory.tracer.start_span(
+            "job",
+            trace_id=context.get("trace_id", None),
+            parent_id=context.get("span_id", None),
+            attributes={"job": job.id, "project": self.project.name},
+            )
+
+    def handle_attach(self, info):
+        """
+        Handle an attach command.
+        The log of the job will be send starting at the requested offset,
+        followed by all further output and the exitcodes.
+        :param info: the decoded command
+        :type info: dict
+        """
+        job = self.factory.jobs.get(info.get("job", None))
+        if job is None:
+            self.send_error("No such job!")
+            return
+        offset = info.get("offset", 0)
+        self.state = self.STATE_BUILDING
+        while offset < job.log.end:
+            data, offset = job.log.read(offset)
+            if len(data) == 0:
+                break
+            self.send_message(data)
+        if job.done:
+            self.send_exitcodes(job.exitcodes or [], stats=job.stats.to_dict())
+        else:
+            self.job = job
+            job.add_listener(self)
 
+    def handle_status(self, info):
+        """
+        Handle a status command.
+        If a job id is specified, send the status of this job.
+        Otherwise, send the status of all jobs.
+        :param info: the decoded command
+        :type info: dict
+        """
+        job_id = info.get("job", None)
+        if job_id is None:
+            status = self.factory.jobs.get_status()
         else:
-            self.handle_protocol_violation(msg)
+            job = self.factory.jobs.get(job_id)
+            if job is None:
+                self.send_error("No such job!")
+                return
+            status = job.get_status()
+        jdata = {
+            "type": "status",
+            "status": status,
+            }
+        self.sendString(json.dumps(jdata).encode(constants.ENCODING))
+
+    def connectionLost(self, reason):
+        """
+        Called when the connection was lost.
+        Running jobs continue, but an incomplete upload is discarded.
+        :param reason: reason the connection was lost
+        :type reason: Failure
+        """
+        self.factory.metrics.connections.dec()
+        self.setTimeout(None)
+        if self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+        if self.state == self.STATE_FILE_RECEIVE and self.recv_d is not None:
+            self.recv_d.errback(reason)
+        self.remove_session()
+        if self.job is not None:
+            self.job.remove_listener(self)
+            self.job = None
+        self.state = self.STATE_IGNORE
+        if self.factory.profiler is not None:
+            peer = self.transport.getPeer()
+            self.factory.profiler.connection_lost("{}:{}".format(getattr(peer, "host", "unknown"), getattr(peer, "port", 0)))
 
     def handle_file_data(self, msg):
         """
@@ -145,14 +685,24 @@ class FBADServerProtocol(IntNStringReceiver):
             return
         prefix = msg[0]
         data = msg[1:]
-        if prefix == constants.MESSAGE_PREFIX_CONTINUE:
-            self.outf.write(data)
-        elif prefix == constants.MESSAGE_PREFIX_END:
-            if len(data) > 0:
-                self.outf.write(data)
-            self.recv_d.callback(None)
-        else:
+        if self.job is not None:
+            self.job.stats.add_bytes_received(len(data))
+        if prefix == constants.MESSAGE_PREFIX_CANCEL and self.job is not None:
+            # the client ended the upload to cancel the build, so the connection stays usable
+            self.state = self.STATE_BUILDING
+            self.recv_d.cancel()
+            return
+        if prefix not in (constants.MESSAGE_PREFIX_CONTINUE, constants.MESSAGE_PREFIX_END):
             self.handle_protocol_violation(msg)
+            return
+        if self.recv_limit is not None and self.outf.tell() + len(data) > self.recv_limit:
+            self.state = self.STATE_IGNORE
+            self.transport.loseConnection()
+            self.recv_d.errback(UploadTooLarge("Received more data than announced"))
+            return
+        self.outf.write(data)
+        if prefix == constants.MESSAGE_PREFIX_END:
+            self.recv_d.callback(None)
 
     def handle_protocol_violation(self, msg=None):
         """
@@ -184,16 +734,50 @@ class FBADServerProtocol(IntNStringReceiver):
             }
         tosend = json.dumps(jdata).encode(constants.ENCODING)
         self.sendString(tosend)
+        self.factory.metrics.relayed_bytes.inc(len(msg))
+        if self.job is not None:
+            self.job.stats.update_buffered(get_buffer_size(self.transport))
 
-    def send_exitcodes(self, exitcodes):
+    def send_exitcodes(self, exitcodes, stats=None):
         """
         Sends the exitcodes to the client.
         :param exitcodes: list of the exitcodes of the process.
         :type exitcodes: list of ints
+        :param stats: the stats of the job, as returned by BuildStats.to_dict()
+        :type stats: dict or None
         """
         jdata = {
             "type": "finish",
             "exitcodes": exitcodes,
+            "stats": stats,
+            }
+        tosend = json.dumps(jdata).encode(constants.ENCODING)
+        self.sendString(tosend)
+        self.job = None
+        self.state = self.STATE_READY
+
+    def send_job(self, job):
+        """
+        Sends the id of a job to the client.
+        :param job: the job
+        :type job: Job
+        """
+        jdata = {
+            "type": "job",
+            "job": job.id,
+            }
+        tosend = json.dumps(jdata).encode(constants.ENCODING)
+        self.sendString(tosend)
+
+    def send_error(self, msg):
+        """
+        Sends an error message to the client.
+        :param msg: the error message
+        :type msg: str or unicode
+        """
+        jdata = {
+            "type": "error",
+            "message": msg,
             }
         tosend = json.dumps(jdata).encode(constants.ENCODING)
         self.sendString(tosend)
@@ -204,24 +788,128 @@ class FBADServerFactory(Factory):
     The Factory for the fbad server.
     :param password: password for the authentification
     :type password: str or None
+    :param jobs: the JobManager to use (defaults to a new one)
+    :type jobs: JobManager or None
+    :param layer_cache: LayerCache to import and export build caches from/to
+    :type layer_cache: LayerCache or None
+    :param prefetch_concurrency: maximum number of concurrent pulls of base images per build
+    :type prefetch_concurrency: int
+    :param tracer: tracer to write the spans of jobs to
+    :type tracer: Tracer or None
+    :param profiler: profiler to write a dump to whenever a connection was closed
+    :type profiler: ConnectionProfiler or None
+    :param disk_budget: bytes of disk space to keep free by removing images or None
+    :type disk_budget: int or None
+    :param collect_interval: seconds between removals of stale workspaces and images
+    :type collect_interval: float
+    :param cpus: CPUs available for the builds of all jobs (defaults to the CPUs of this machine)
+    :type cpus: float or None
+    :param memory: bytes of memory available for the builds of all jobs (defaults to the memory of this machine)
+    :type memory: int or None
+    :param distribute_password: password for the buildservers built images are distributed to
+    :type distribute_password: str or None
+    :param ram_workspace: directory backed by memory (e.g. a tmpfs) to place small workspaces in
+    :type ram_workspace: str or None
+    :param ram_budget: bytes of memory the workspaces in ram_workspace may use (defaults to a fraction of the memory of this machine)
+    :type ram_budget: int or None
+    :param ram_threshold: workspaces larger than this are placed on disk
+    :type ram_threshold: int
+    :param collect: whether to remove stale workspaces and images (see collector)
+    :type collect: bool
     """
     protocol = FBADServerProtocol
 
-    def __init__(self, password=None):
+    def __init__(self, password=None, jobs=None, layer_cache=None, prefetch_concurrency=constants.PREFETCH_CONCURRENCY, tracer=None, profiler=None, disk_budget=None, collect_interval=constants.COLLECT_INTERVAL, cpus=None, memory=None, distribute_password=None, ram_workspace=None, ram_budget=None, ram_threshold=constants.RAM_WORKSPACE_THRESHOLD, collect=True):
         self.password = password
+        if jobs is None:
+            jobs = JobManager()
+        self.jobs = jobs
+        self.layer_cache = layer_cache
+        self.prefetch_concurrency = prefetch_concurrency
+        self.metrics = ServerMetrics(self)
+        self.tracer = tracer
+        self.profiler = profiler
+        self.sessions = set()  # paths of the project files kept between builds
+        if collect:
+            self.collector = Collector(self, budget=disk_budget, interval=collect_interval)
+        else:
+            self.collector = None
+        host_cpus, host_memory = get_host_resources()
+        if ram_workspace is not None and ram_budget is None:
+            ram_budget = int((host_memory or 0) * constants.RAM_WORKSPACE_BUDGET_FRACTION)
+        if ram_workspace is not None and memory is None and host_memory is not None:
+            # the memory used by workspaces is not available for builds
+            memory = max(host_memory - ram_budget, 0)
+        self.workspaces = WorkspaceAllocator(ram_workspace, budget=(ram_budget or 0), threshold=ram_threshold)
+        self.resources = ResourcePool(
+            (cpus if cpus is not None else host_cpus),
+            (memory if memory is not None else host_memory),
+            )
+        self.distributor = Distributor(password=distribute_password)
 
 
 class OutputRelayProtocol(ProcessProtocol):
     """
     A protocol for relaying subprocess outputs and exit codes.
-    :param client: protocol connected with the client
-    :type client: FBADServerProtocol
+    When the deferred is cancelled, the process and all of its descendants are killed.
+    :param client: protocol connected with the client or the job to relay to
+    :type client: FBADServerProtocol or Job
     :param d: deferred which will be fired with the exit code of the process
-    :type d: Deferred
+    :type d: Deferred or None
+    :param metrics: metrics to count the subprocess in
+    :type metrics: ServerMetrics or None
     """
-    def __init__(self, client, d):
+    def __init__(self, client, d=None, metrics=None):
         self.client = client
+        if d is None:
+            d = defer.Deferred(canceller=self.cancel)
         self.d = d
+        self.ended = False
+        self.metrics = metrics
+        self.end_waiters = []  # deferreds to fire when the process ended
+
+    def connectionMade(self):
+        """
+        Called when the process was started.
+        """
+        if self.metrics is not None:
+            self.metrics.subprocesses_started.inc()
+            self.metrics.subprocesses_running.inc()
+
+    def cancel(self, d):
+        """
+        Kill the process and its descendants.
+        If they do not terminate in time, they will be killed using SIGKILL.
+        :param d: the cancelled deferred
+        :type d: Deferred
+        """
+        if self.ended or self.transport is None or self.transport.pid is None:
+            return
+        kd = kill_process_tree(self.transport.pid, signal.SIGTERM)
+        kd.addCallback(lambda pids: reactor.callLater(constants.KILL_TIMEOUT, self._force_kill, pids))
+        kd.addErrback(log.err, "Error killing process")
+
+    def wait_ended(self):
+        """
+        Wait until the process ended.
+        The deferred of the process is fired as soon as it was cancelled, but the process may still be running.
+        :return: a deferred which will fire when the process ended
+        :rtype: Deferred
+        """
+        if self.ended or self.transport is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.end_waiters.append(d)
+        return d
+
+    def _force_kill(self, pids):
+        """
+        Kill the specified processes if the main process is still running.
+        :param pids: pids of the processes to kill
+        :type pids: list of int
+        """
+        if not self.ended:
+            kill_pids(pids, signal.SIGKILL)
 
     def outReceived(self, data):
         """
@@ -260,4 +948,11 @@ class OutputRelayProtocol(ProcessProtocol):
             exitcode = sv.exitCode
         else:
             raise Exception("Unexpected status result of process!")
-        self.d.callback(exitcode)
+        self.ended = True
+        if self.metrics is not None:
+            self.metrics.subprocesses_running.dec()
+        if not self.d.called:
+            self.d.callback(exitcode)
+        waiters, self.end_waiters = self.end_waiters, []
+        for d in waiters:
+            d.callback(None)
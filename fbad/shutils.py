@@ -1,8 +1,37 @@
 """shell and subprocess utilities."""
-from twisted.internet import reactor
+import os
+import errno
+import signal
+import subprocess
+from distutils.spawn import find_executable
 
+from twisted.internet import defer, error, utils
+from twisted.internet.protocol import ProcessProtocol
 
-def run_command(path, executable, command, protocolfactory=None):
+
+def apply_io_weight(executable, command, io_weight):
+    """
+    Wrap a command using 'ionice', so it runs with a best-effort I/O priority derived from io_weight.
+    If 'ionice' is not available, the command is returned unchanged.
+    :param executable: executable to run
+    :type executable: str or unicode
+    :param command: command to execute
+    :type command: list
+    :param io_weight: relative I/O weight from 1 to 1000 (500 is the default priority)
+    :type io_weight: int
+    :return: a tuple of (executable, command)
+    :rtype: tuple of (str, list)
+    """
+    ionice = find_executable("ionice")
+    if ionice is None:
+        return executable, command
+    io_weight = min(max(int(io_weight), 1), 1000)
+    # the best-effort class has the levels 0 (highest) to 7 (lowest)
+    level = int(round(7 - (io_weight - 1) * 7.0 / 999))
+    return ionice, ["ionice", "-c", "2", "-n", str(level), executable] + list(command[1:])
+
+
+def run_command(path, executable, command, protocolfactory=None, io_weight=None):
     """
     Run a command.
     If protocolfactory is not None, use it for subprocess communication.
@@ -15,14 +44,211 @@ def run_command(path, executable, command, protocolfactory=None):
     :type command: list
     :param protocolfactory: a callable which returns a protocol to communicate with the child process
     :type protocolfactory: callable
+    :param io_weight: if not None, run the command with an I/O priority derived from this weight (see apply_io_weight())
+    :type io_weight: int or None
     :return: a deferred which will fire when the command executed successfully
     :rtype: Deferred
     """
+    if io_weight is not None:
+        executable, command = apply_io_weight(executable, command, io_weight)
     if protocolfactory is None:
         c = subprocess.call(command, cwd=path, executable=executable)
         return defer.succeed(c)
     else:
         protocol = protocolfactory()
         d = protocol.d
+        from twisted.internet import reactor
         reactor.spawnProcess(protocol, executable, args=command, path=path)
         return d
+
+
+class CollectingProcessProtocol(ProcessProtocol):
+    """
+    A protocol collecting the output of a subprocess.
+    The output (stdout and stderr) is stored in the 'output' attribute,
+    stdout alone in the 'stdout' attribute (for parsing the output).
+    :param d: deferred which will be fired with the exit code of the process
+    :type d: Deferred or None
+    """
+    def __init__(self, d=None):
+        if d is None:
+            d = defer.Deferred(canceller=self.cancel)
+        self.d = d
+        self.output = ""
+        self.stdout = ""
+
+    def cancel(self, d):
+        """
+        Called when the deferred was cancelled. Terminates the process.
+        :param d: the deferred
+        :type d: Deferred
+        """
+        if self.transport is None:
+            return
+        try:
+            self.transport.signalProcess("TERM")
+        except error.ProcessExitedAlready:
+            pass
+
+    def outReceived(self, data):
+        """
+        Called when data was received on stdout.
+        :param data: received data
+        :type data: str
+        """
+        self.output += data
+        self.stdout += data
+
+    def errReceived(self, data):
+        """
+        Called when data was received on stderr.
+        :param data: received data
+        :type data: str
+        """
+        self.output += data
+
+    def processEnded(self, status):
+        """
+        Called when the process ended.
+        :param status: the exit status of the process
+        :type status: Failure
+        """
+        sv = status.value
+        if isinstance(sv, error.ProcessTerminated):
+            exitcode = sv.exitCode
+        else:
+            exitcode = 0
+        if not self.d.called:
+            self.d.callback(exitcode)
+
+
+def read_parent_pids():
+    """
+    Return the parent of each process by reading /proc.
+    :return: a dict of pid -> pid of the parent
+    :rtype: dict
+    """
+    parents = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", name, "stat"), "r") as fin:
+                stat = fin.read()
+        except IOError:
+            # process ended in the meantime
+            continue
+        # the name of the process may contain spaces and parentheses
+        fields = stat[stat.rfind(")") + 2:].split()
+        if len(fields) > 1:
+            parents[int(name)] = int(fields[1])
+    return parents
+
+
+def parse_parent_pids(output):
+    """
+    Parse the output of 'ps -e -o pid=,ppid='.
+    :param output: the output of ps
+    :type output: str
+    :return: a dict of pid -> pid of the parent
+    :rtype: dict
+    """
+    parents = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        parents[int(parts[0])] = int(parts[1])
+    return parents
+
+
+def get_descendant_pids(pid):
+    """
+    Return the pids of all descendants of a process.
+    /proc is read if available, otherwise ps is run without blocking.
+    :param pid: pid of the process
+    :type pid: int
+    :return: a deferred which will fire with a list of pids, children before grandchildren
+    :rtype: Deferred
+    """
+    if os.path.isdir("/proc"):
+        d = defer.succeed(read_parent_pids())
+    else:
+        ps = find_executable("ps")
+        if ps is None:
+            return defer.succeed([])
+        d = utils.getProcessOutput(ps, ["-e", "-o", "pid=,ppid="], env=os.environ)
+        d.addCallback(parse_parent_pids)
+        d.addErrback(lambda f: {})
+    d.addCallback(_get_descendants, pid)
+    return d
+
+
+def _get_descendants(parents, pid):
+    """
+    Return the pids of all descendants of a process.
+    :param parents: a dict of pid -> pid of the parent
+    :type parents: dict
+    :param pid: pid of the process
+    :type pid: int
+    :return: list of pids, children before grandchildren
+    :rtype: list of int
+    """
+    children = {}
+    for cpid, ppid in parents.items():
+        children.setdefault(ppid, []).append(cpid)
+    pids = []
+    todo = [pid]
+    while len(todo) > 0:
+        p = todo.pop(0)
+        for cpid in sorted(children.get(p, [])):
+            pids.append(cpid)
+            todo.append(cpid)
+    return pids
+
+
+def is_process_running(pid):
+    """
+    Check whether a process exists.
+    :param pid: pid of the process
+    :type pid: int
+    :return: True if the process exists
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # the process exists, but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def kill_pids(pids, sig=signal.SIGTERM):
+    """
+    Send a signal to multiple processes, ignoring processes which no longer exist.
+    :param pids: pids of the processes
+    :type pids: list of int
+    :param sig: signal to send
+    :type sig: int
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+
+def kill_process_tree(pid, sig=signal.SIGTERM):
+    """
+    Send a signal to a process and all of its descendants.
+    :param pid: pid of the process
+    :type pid: int
+    :param sig: signal to send
+    :type sig: int
+    :return: a deferred which will fire with the pids the signal was sent to
+    :rtype: Deferred
+    """
+    d = get_descendant_pids(pid)
+    d.addCallback(lambda pids: [pid] + pids)
+    d.addCallback(lambda pids: kill_pids(pids, sig) or pids)
+    return d
@@ -0,0 +1,245 @@
+"""this module implements the measurement of the duration of build phases."""
+import contextlib
+import json
+import time
+
+
+PHASES = ("archive", "upload", "receive", "extract", "preexec", "build", "push", "distribute", "deploy")
+
+
+def get_buffer_size(transport):
+    """
+    Return the number of bytes buffered by a transport which were not yet written.
+    :param transport: the transport
+    :type transport: ITransport
+    :return: the number of buffered bytes
+    :rtype: int
+    """
+    buf = getattr(transport, "dataBuffer", "")
+    offset = getattr(transport, "offset", 0)
+    return len(buf) - offset + getattr(transport, "_tempDataLen", 0)
+
+
+class BuildStats(object):
+    """
+    The durations of the phases of a build and the amount of transferred data.
+    Phases of the whole project (e.g. receive, deploy) and of single images
+    (e.g. preexec, build, push) are stored separately.
+    If span is set, a child span is written for each measured phase.
+    :param span: span of the build
+    :type span: Span or None
+    """
+    def __init__(self, span=None):
+        self.span = span
+        self.project = {}
+        self.images = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.peak_buffered = 0
+
+    def add(self, phase, seconds, image=None, start=None):
+        """
+        Add the duration of a phase.
+        :param phase: name of the phase
+        :type phase: str
+        :param seconds: duration of the phase
+        :type seconds: float
+        :param image: name of the image or None if the phase belongs to the project
+        :type image: str or unicode or None
+        :param start: start time of the phase, required to write a span
+        :type start: float or None
+        """
+        if self.span is not None and start is not None:
+            attributes = {"image": image} if image is not None else None
+            self.span.child(phase, attributes=attributes, start=start).end(start + seconds)
+        if image is None:
+            phases = self.project
+        else:
+            phases = self.images.setdefault(image, {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def measure(self, phase, image=None):
+        """
+        Context manager measuring the duration of a phase.
+        :param phase: name of the phase
+        :type phase: str
+        :param image: name of the image or None if the phase belongs to the project
+        :type image: str or unicode or None
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start, image=image, start=start)
+
+    def add_bytes_received(self, n):
+        """
+        Add to the number of received bytes.
+        :param n: number of bytes
+        :type n: int
+        """
+        self.bytes_received += n
+
+    def add_bytes_sent(self, n):
+        """
+        Add to the number of send bytes.
+        :param n: number of bytes
+        :type n: int
+        """
+        self.bytes_sent += n
+
+    def update_buffered(self, n):
+        """
+        Update the peak number of buffered output bytes.
+        :param n: number of currently buffered bytes
+        :type n: int
+        """
+        self.peak_buffered = max(self.peak_buffered, n)
+
+    def merge(self, other):
+        """
+        Add the phases and byte counts of other stats to these stats.
+        :param other: stats to merge
+        :type other: BuildStats
+        """
+        for phase, seconds in other.project.items():
+            self.add(phase, seconds)
+        for image, phases in other.images.items():
+            for phase, seconds in phases.items():
+                self.add(phase, seconds, image=image)
+        self.bytes_received += other.bytes_received
+        self.bytes_sent += other.bytes_sent
+        self.peak_buffered = max(self.peak_buffered, other.peak_buffered)
+
+    def to_dict(self):
+        """
+        Return a dict representing these stats.
+        :return: the stats as a JSON-serializable dict
+        :rtype: dict
+        """
+        return {
+            "project": self.project,
+            "images": self.images,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "peak_buffered": self.peak_buffered,
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Load stats from a dict returned by to_dict().
+        :param d: dict to load from
+        :type d: dict
+        :return: the loaded stats
+        :rtype: BuildStats
+        """
+        stats = cls()
+        stats.project = dict(d.get("project", {}))
+        stats.images = dict([(k, dict(v)) for k, v in d.get("images", {}).items()])
+        stats.bytes_received = d.get("bytes_received", 0)
+        stats.bytes_sent = d.get("bytes_sent", 0)
+        stats.peak_buffered = d.get("peak_buffered", 0)
+        return stats
+
+
+class BuildReport(object):
+    """
+    Aggregates the BuildStats of multiple buildservers.
+    """
+    def __init__(self):
+        self.servers = {}
+
+    def add(self, server, stats):
+        """
+        Add the stats of a build on a server.
+        Stats of multiple builds on the same server are merged.
+        :param server: the server the build ran on
+        :type server: str
+        :param stats: the stats of the build
+        :type stats: BuildStats
+        """
+        if server in self.servers:
+            self.servers[server].merge(stats)
+        else:
+            self.servers[server] = stats
+
+    def get_rows(self):
+        """
+        Return the rows of the summary table.
+        :return: list of (server, image, phases) tuples, with image being '*' for project phases
+        :rtype: list of tuple of (str, str, dict)
+        """
+        rows = []
+        for server in sorted(self.servers.keys()):
+            stats = self.servers[server]
+            if len(stats.project) > 0:
+                rows.append((server, "*", stats.project))
+            for image in sorted(stats.images.keys()):
+                rows.append((server, image, stats.images[image]))
+        return rows
+
+    def format_table(self):
+        """
+        Return a summary table of the durations of all phases.
+        :return: the table
+        :rtype: str
+        """
+        phases = [p for p in PHASES if any([p in row[2] for row in self.get_rows()])]
+        header = ["server", "image"] + phases + ["total"]
+        lines = [header]
+        totals = dict([(p, 0.0) for p in phases])
+        for server, image, times in self.get_rows():
+            line = [server, image]
+            for p in phases:
+                if p in times:
+                    line.append("{:.2f}".format(times[p]))
+                    totals[p] += times[p]
+                else:
+                    line.append("-")
+            line.append("{:.2f}".format(sum([times.get(p, 0.0) for p in phases])))
+            lines.append(line)
+        lines.append(["total", ""] + ["{:.2f}".format(totals[p]) for p in phases] + ["{:.2f}".format(sum(totals.values()))])
+        widths = [max([len(line[i]) for line in lines]) for i in range(len(header))]
+        text = ""
+        for line in lines:
+            text += "  ".join([c.ljust(w) for c, w in zip(line, widths)]).rstrip() + "\n"
+        received = sum([s.bytes_received for s in self.servers.values()])
+        sent = sum([s.bytes_sent for s in self.servers.values()])
+        peak = max([s.peak_buffered for s in self.servers.values()] + [0])
+        text += "bytes uploaded: {}, output bytes: {}, peak buffered output: {}\n".format(received, sent, peak)
+        return text
+
+    def to_dict(self):
+        """
+        Return a dict representing this report.
+        :return: the report as a JSON-serializable dict
+        :rtype: dict
+        """
+        return {
+            "servers": dict([(server, stats.to_dict()) for server, stats in self.servers.items()]),
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Load a report from a dict returned by to_dict().
+        :param d: dict to load from
+        :type d: dict
+        :return: the loaded report
+        :rtype: BuildReport
+        """
+        report = cls()
+        for server, sd in d.get("servers", {}).items():
+            report.add(server, BuildStats.from_dict(sd))
+        return report
+
+    def write(self, path):
+        """
+        Write this report as JSON to a file.
+        :param path: path of the file
+        :type path: str or unicode
+        """
+        with open(path, "w") as fout:
+            json.dump(self.to_dict(), fout, indent=2, sort_keys=True)
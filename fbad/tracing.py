@@ -0,0 +1,247 @@
+"""this module implements the export of trace spans correlating client and server activity."""
+import json
+import socket
+import time
+import uuid
+
+
+def new_trace_id():
+    """
+    Return a new random trace id.
+    :return: the trace id (32 hex digits)
+    :rtype: str
+    """
+    return uuid.uuid4().hex
+
+
+def new_span_id():
+    """
+    Return a new random span id.
+    :return: the span id (16 hex digits)
+    :rtype: str
+    """
+    return uuid.uuid4().hex[:16]
+
+
+class Span(object):
+    """
+    A timed operation which is part of a trace.
+    Spans are written to the tracer when they end.
+    :param tracer: the tracer to write this span to
+    :type tracer: Tracer
+    :param name: name of the operation
+    :type name: str
+    :param trace_id: id of the trace this span is part of
+    :type trace_id: str
+    :param parent_id: id of the parent span or None
+    :type parent_id: str or None
+    :param attributes: additional attributes of this span
+    :type attributes: dict or None
+    :param start: start time (defaults to now)
+    :type start: float or None
+    """
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None, start=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start = start if start is not None else time.time()
+        self.end_time = None
+
+    def child(self, name, attributes=None, start=None):
+        """
+        Start a child span of this span.
+        :param name: name of the operation
+        :type name: str
+        :param attributes: additional attributes of the span
+        :type attributes: dict or None
+        :param start: start time (defaults to now)
+        :type start: float or None
+        :return: the child span
+        :rtype: Span
+        """
+        return Span(self.tracer, name, self.trace_id, parent_id=self.span_id, attributes=attributes, start=start)
+
+    def end(self, end=None):
+        """
+        End this span and write it.
+        :param end: end time (defaults to now)
+        :type end: float or None
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = end if end is not None else time.time()
+        self.tracer.write(self)
+
+    def get_context(self):
+        """
+        Return the context to propagate to remote children of this span.
+        :return: the context
+        :rtype: dict
+        """
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            }
+
+    def to_dict(self):
+        """
+        Return a dict representing this span, using the field names of OTLP-JSON.
+        :return: the span as a JSON-serializable dict
+        :rtype: dict
+        """
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "service": self.tracer.service,
+            "startTimeUnixNano": int(self.start * 1e9),
+            "endTimeUnixNano": int(self.end_time * 1e9),
+            "attributes": self.attributes,
+            }
+
+
+class Tracer(object):
+    """
+    Writes spans as JSON lines to a file.
+    :param path: path of the file to append spans to
+    :type path: str or unicode
+    :param service: name of the service emitting the spans (defaults to the hostname)
+    :type service: str or None
+    """
+    def __init__(self, path, service=None):
+        self.path = path
+        if service is None:
+            service = socket.gethostname()
+        self.service = service
+
+    def start_span(self, name, trace_id=None, parent_id=None, attributes=None, start=None):
+        """
+        Start a new span.
+        :param name: name of the operation
+        :type name: str
+        :param trace_id: id of the trace (defaults to a new trace)
+        :type trace_id: str or None
+        :param parent_id: id of the parent span or None
+        :type parent_id: str or None
+        :param attributes: additional attributes of the span
+        :type attributes: dict or None
+        :param start: start time (defaults to now)
+        :type start: float or None
+        :return: the span
+        :rtype: Span
+        """
+        if trace_id is None:
+            trace_id = new_trace_id()
+        return Span(self, name, trace_id, parent_id=parent_id, attributes=attributes, start=start)
+
+    def write(self, span):
+        """
+        Append a span to the file.
+        :param span: the span to write
+        :type span: Span
+        """
+        with open(self.path, "a") as fout:
+            fout.write(json.dumps(span.to_dict(), sort_keys=True) + "\n")
+
+
+def load_spans(paths):
+    """
+    Load the spans written by one or more tracers.
+    :param paths: paths of the files to load
+    :type paths: list of str
+    :return: the spans, sorted by their start time
+    :rtype: list of dict
+    """
+    spans = []
+    for path in paths:
+        with open(path, "r") as fin:
+            for line in fin:
+                line = line.strip()
+                if line:
+                    spans.append(json.loads(line))
+    spans.sort(key=lambda s: s["startTimeUnixNano"])
+    return spans
+
+
+def to_chrome_trace(spans):
+    """
+    Convert spans to the chrome trace event format.
+    Each service becomes a process and each image a thread.
+    :param spans: spans returned by load_spans()
+    :type spans: list of dict
+    :return: the trace
+    :rtype: dict
+    """
+    services = []
+    events = []
+    for span in spans:
+        if span["service"] not in services:
+            services.append(span["service"])
+            events.append({"name": "process_name", "ph": "M", "pid": len(services), "args": {"name": span["service"]}})
+        start = span["startTimeUnixNano"] // 1000
+        events.append({
+            "name": span["name"],
+            "cat": "fbad",
+            "ph": "X",
+            "ts": start,
+            "dur": span["endTimeUnixNano"] // 1000 - start,
+            "pid": services.index(span["service"]) + 1,
+            "tid": span["attributes"].get("image", span["attributes"].get("server", "project")),
+            "args": dict(span["attributes"], trace_id=span["traceId"], span_id=span["spanId"]),
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def to_otlp(spans):
+    """
+    Convert spans to OTLP-JSON.
+    :param spans: spans returned by load_spans()
+    :type spans: list of dict
+    :return: the trace
+    :rtype: dict
+    """
+    by_service = {}
+    for span in spans:
+        attributes = [{"key": k, "value": {"stringValue": str(v)}} for k, v in sorted(span["attributes"].items())]
+        by_service.setdefault(span["service"], []).append({
+            "traceId": span["traceId"],
+            "spanId": span["spanId"],
+            "parentSpanId": span["parentSpanId"],
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(span["startTimeUnixNano"]),
+            "endTimeUnixNano": str(span["endTimeUnixNano"]),
+            "attributes": attributes,
+            })
+    resource_spans = []
+    for service in sorted(by_service.keys()):
+        resource_spans.append({
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+            "scopeSpans": [{"scope": {"name": "fbad"}, "spans": by_service[service]}],
+            })
+    return {"resourceSpans": resource_spans}
+
+
+def merge_traces(paths, dest, format="chrome"):
+    """
+    Merge the spans of multiple files into a single trace file.
+    :param paths: paths of the files written by the tracers
+    :type paths: list of str
+    :param dest: path to write the merged trace to
+    :type dest: str
+    :param format: 'chrome' for the chrome trace event format, 'otlp' for OTLP-JSON
+    :type format: str
+    """
+    spans = load_spans(paths)
+    if format == "chrome":
+        data = to_chrome_trace(spans)
+    elif format == "otlp":
+        data = to_otlp(spans)
+    else:
+        raise ValueError("Unknown trace format: " + repr(format))
+    with open(dest, "w") as fout:
+        json.dump(data, fout)
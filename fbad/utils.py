@@ -0,0 +1,19 @@
+"""this module contains helpers shared by the client, the server and the project definitions."""
+import re
+
+
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(s):
+    """
+    Parse a size like '512M' or '10G'.
+    :param s: the size, optionally with a K, M, G or T suffix
+    :type s: str
+    :return: the size in bytes
+    :rtype: int
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", s, re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid size: " + repr(s))
+    return int(float(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()])
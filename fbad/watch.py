@@ -0,0 +1,335 @@
+"""this module implements the watch mode, which rebuilds images when their files change."""
+import os
+
+from twisted.internet import defer, error, threads
+from twisted.python import filepath, log
+
+from fbad import constants, client
+from fbad.jobs import JobManager
+from fbad.server import OutputRelayProtocol
+
+
+class Watcher(object):
+    """
+    Watch the files of a project and rebuild the affected images when they change.
+    If hosts are specified, a session is kept open to each buildserver and only
+    changed files are send to them. Lost sessions are opened again by uploading
+    the whole project. Otherwise, images are built locally in the watched directory,
+    so the declared preexec_outputs and all changes during a build are ignored.
+    :param reactor: the twisted reactor
+    :type reactor: IReactor
+    :param project: the project to watch
+    :type project: Project
+    :param hosts: hosts of the buildservers or None
+    :type hosts: list of str or None
+    :param port: port of the buildservers
+    :type port: int
+    :param out: file to write output to
+    :type out: file-like object
+    :param password: password for the buildservers
+    :type password: str
+    :param only: which images to build
+    :type only: list or None
+    :param buildmode: 'parallel' to distribute images between the buildservers, 'multi' to build them on each.
+    :type buildmode: str
+    :param push: whether to push rebuilt images to registry or not
+    :type push: bool
+    :param deploy: whether to deploy the project after each rebuild or not
+    :type deploy: bool
+    :param push_concurrency: maximum number of images to push concurrently
+    :type push_concurrency: int
+    :param debounce: seconds to wait for further changes before rebuilding
+    :type debounce: float
+    """
+    def __init__(
+        self,
+        reactor,
+        project,
+        hosts,
+        port,
+        out,
+        password=None,
+        only=None,
+        buildmode="parallel",
+        push=False,
+        deploy=False,
+        push_concurrency=constants.PUSH_CONCURRENCY,
+        debounce=constants.WATCH_DEBOUNCE,
+        ):
+            self.reactor = reactor
+            self.project = project
+            self.hosts = hosts
+            self.port = port
+            self.out = out
+            self.password = password
+            self.only = only
+            self.buildmode = buildmode
+            self.push = push
+            self.deploy = deploy
+            self.push_concurrency = push_concurrency
+            self.debounce = debounce
+
+            self.root = os.path.abspath(project.project_path)
+            self.generated = self.get_generated_paths()
+            self.sessions = []  # list of (host, FBADClientProtocol)
+            self.jobs = JobManager()
+            self.pending = set()
+            self.delayed_call = None
+            self.running = False
+            self.notifier = None
+            self.done_d = defer.Deferred()
+
+    @defer.inlineCallbacks
+    def start(self):
+        """
+        Connect to the buildservers, upload the project and start watching.
+        :return: a deferred which will fire when the watcher was stopped
+        :rtype: Deferred
+        """
+        from twisted.internet import inotify  # only available on linux
+        if self.hosts is not None:
+            self.sessions = [(host, None) for host in self.hosts]
+            yield defer.gatherResults([self._open_session(i) for i in range(len(self.hosts))], consumeErrors=True)
+        self.notifier = inotify.INotify(reactor=self.reactor)
+        self.notifier.startReading()
+        mask = inotify.IN_CHANGED | inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+        self.notifier.watch(
+            filepath.FilePath(self.root),
+            mask=mask,
+            autoAdd=True,
+            recursive=True,
+            callbacks=[self.on_change],
+            )
+        self.out.write("Watching {} for changes...\n".format(self.root))
+        result = yield self.done_d
+        defer.returnValue(result)
+
+    def stop(self):
+        """
+        Stop watching and close all sessions.
+        """
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        for host, session in self.sessions:
+            if session is not None:
+                session.disconnect()
+        self.sessions = []
+        if not self.done_d.called:
+            self.done_d.callback(None)
+
+    def get_generated_paths(self):
+        """
+        Return the paths of the files generated by the preexec_commands of the images.
+        :return: paths of the declared preexec_outputs, relative to the project path
+        :rtype: set of str
+        """
+        paths = set()
+        for image in self.project.images:
+            for p in (image.preexec_outputs or []):
+                paths.add(os.path.normpath(os.path.join(image.buildpath, p)))
+        return paths
+
+    @staticmethod
+    def is_connected(session):
+        """
+        Check whether a session can still be used.
+        :param session: the connection to the buildserver or None
+        :type session: FBADClientProtocol or None
+        :return: True if the session is connected
+        :rtype: bool
+        """
+        return session is not None and session.state not in (session.STATE_IGNORE, session.STATE_ERROR)
+
+    @defer.inlineCallbacks
+    def _open_session(self, i, only=None, push=False, deploy=False):
+        """
+        Connect to the i-th buildserver and upload the whole project.
+        :param i: index of the buildserver
+        :type i: int
+        :param only: which images to build (defaults to none)
+        :type only: list or None
+        :param push: whether to push built images to registry or not
+        :type push: bool
+        :param deploy: whether to deploy project after the build or not.
+        :type deploy: bool
+        :return: a deferred which will fire with the exitcodes when the session is ready
+        :rtype: Deferred
+        """
+        if only is None:
+            only = []
+        host, old = self.sessions[i]
+        if old is not None:
+            old.disconnect()
+            self.sessions[i] = (host, None)
+        session = yield client.connect(self.reactor, host, self.port, password=self.password, out=self.out)
+        try:
+            with self.project.get_temp_build_dir() as p:
+                uzp = os.path.join(p, "up.zip")
+                yield threads.deferToThread(self.project.create_zip, uzp)
+                exitcodes = yield session.remote_build(self.project, uzp, only=only, push=push, deploy=deploy, push_concurrency=self.push_concurrency, keep=True)
+        except Exception:
+            session.disconnect()
+            raise
+        self.sessions[i] = (host, session)
+        defer.returnValue(exitcodes)
+
+    @defer.inlineCallbacks
+    def _update_session(self, i, uzp, deleted, only, push=False, deploy=False):
+        """
+        Send changed files to the i-th buildserver and rebuild images.
+        If the session was lost, it is opened again.
+        :param i: index of the buildserver
+        :type i: int
+        :param uzp: path of the zip containing the changed files
+        :type uzp: str
+        :param deleted: paths of deleted files, relative to the project path
+        :type deleted: list of str
+        :param only: which images to build
+        :type only: list
+        :param push: whether to push built images to registry or not
+        :type push: bool
+        :param deploy: whether to deploy project after the build or not.
+        :type deploy: bool
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        host, session = self.sessions[i]
+        if self.is_connected(session):
+            try:
+                exitcodes = yield session.remote_update(uzp, deleted=deleted, only=only, push=push, deploy=deploy, push_concurrency=self.push_concurrency)
+            except (error.ConnectionLost, error.ConnectionDone):
+                pass
+            else:
+                defer.returnValue(exitcodes)
+        self.out.write("Session to {} lost, uploading the project again...\n".format(host))
+        exitcodes = yield self._open_session(i, only=only, push=push, deploy=deploy)
+        defer.returnValue(exitcodes)
+
+    def on_change(self, ignored, fp, mask):
+        """
+        Called by inotify when a file changed.
+        :param ignored: the watch
+        :type ignored: object
+        :param fp: path of the changed file
+        :type fp: FilePath
+        :param mask: the event mask
+        :type mask: int
+        """
+        rp = os.path.relpath(fp.path, self.root)
+        if rp == "." or rp.split(os.sep)[0] in constants.WATCH_IGNORE:
+            return
+        if self.hosts is None:
+            if self.running:
+                # written by the local build, which runs in the watched directory
+                return
+            if any([rp == g or rp.startswith(g + os.sep) for g in self.generated]):
+                return
+        self.pending.add(rp)
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.reset(self.debounce)
+        else:
+            self.delayed_call = self.reactor.callLater(self.debounce, self.flush)
+
+    @defer.inlineCallbacks
+    def flush(self):
+        """
+        Send all pending changes and rebuild the affected images.
+        :return: a deferred which will fire when the images were rebuilt
+        :rtype: Deferred
+        """
+        if self.running:
+            # flush again when the current rebuild is done
+            return
+        self.running = True
+        try:
+            while len(self.pending) > 0:
+                paths, self.pending = self.pending, set()
+                try:
+                    yield self.rebuild(paths)
+                except Exception:
+                    log.err(None, "Error rebuilding images")
+                    self.out.write("Error rebuilding images!\n")
+        finally:
+            self.running = False
+
+    @defer.inlineCallbacks
+    def rebuild(self, paths):
+        """
+        Rebuild the images affected by changes of paths.
+        :param paths: paths of the changed files, relative to the project path
+        :type paths: set of str
+        :return: a deferred which will fire with the exitcodes
+        :rtype: Deferred
+        """
+        names = self.project.get_affected_images(paths, only=self.only)
+        self.out.write("{} file(s) changed, rebuilding: {}\n".format(len(paths), ", ".join(names) or "-"))
+        if self.hosts is None:
+            if len(names) == 0:
+                defer.returnValue([])
+            job = self.jobs.create(self.project, source_path=self.root, receive=False)
+            job.add_listener(self)
+            protofactory = lambda job=job: OutputRelayProtocol(job)
+            try:
+                exitcodes = yield job.start(protofactory, only=names, push=self.push, deploy=self.deploy, push_concurrency=self.push_concurrency)
+            finally:
+                self.jobs.remove(job)
+        else:
+            with self.project.get_temp_build_dir() as p:
+                uzp = os.path.join(p, "changes.zip")
+                deleted = yield threads.deferToThread(self.project.create_partial_zip, uzp, paths)
+                ds = []
+                for i in range(len(self.sessions)):
+                    # changed files are send to every buildserver, so all sessions stay up to date
+                    hostnames = self.get_images_for_host(names, i)
+                    d = self._update_session(
+                        i,
+                        uzp,
+                        deleted,
+                        hostnames,
+                        push=(self.push and len(hostnames) > 0),
+                        deploy=(self.deploy and i == 0),
+                        )
+                    ds.append(d)
+                exitcodeslists = yield defer.gatherResults(ds, consumeErrors=True)
+            exitcodes = []
+            for ecl in exitcodeslists:
+                exitcodes += ecl
+        self.out.write("Exitcodes: {}\n".format(repr(exitcodes)))
+        defer.returnValue(exitcodes)
+
+    def get_images_for_host(self, names, i):
+        """
+        Return the names of the images the i-th buildserver should build.
+        :param names: names of the images to build
+        :type names: list of str
+        :param i: index of the buildserver
+        :type i: int
+        :return: names of the images to build on the buildserver
+        :rtype: list of str
+        """
+        if self.buildmode == "multi":
+            return names
+        allnames = [image.name for image in self.project.images]
+        return [n for n in names if allnames.index(n) % len(self.sessions) == i]
+
+    def send_message(self, msg):
+        """
+        Write output of a local build.
+        :param msg: the message
+        :type msg: str or unicode
+        """
+        self.out.write(msg)
+
+    def send_exitcodes(self, exitcodes, stats=None):
+        """
+        Called when a local build finished.
+        :param exitcodes: list of the exitcodes of the processes.
+        :type exitcodes: list of ints
+        :param stats: the stats of the build
+        :type stats: dict or None
+        """
+        pass
+
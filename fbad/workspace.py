@@ -0,0 +1,246 @@
+"""this module implements the allocation of workspaces in memory (e.g. on a tmpfs) or on disk."""
+import os
+import uuid
+import shutil
+import zipfile
+import tempfile
+import contextlib
+
+from twisted.internet import threads
+from twisted.python import failure
+
+from fbad import constants
+
+
+active_workspaces = set()  # paths of the temporary workspaces in use by this process
+
+
+def get_process_dir(root):
+    """
+    Return the directory of this process in a directory shared with other processes.
+    The garbage collection of a buildserver only removes stale directories in its own
+    directory and the directories of processes which are no longer running.
+    :param root: the shared directory
+    :type root: str or unicode
+    :return: the directory of this process
+    :rtype: str
+    """
+    return os.path.join(root, str(os.getpid()))
+
+
+def get_workspace_path(root=None):
+    """
+    Return a path to a new workspace.
+    :param root: directory to create the workspace in, defaults to the temp directory
+    :type root: str or unicode or None
+    :return: path of the workspace
+    :rtype: str
+    """
+    if root is None:
+        root = tempfile.gettempdir()
+    return os.path.join(get_process_dir(os.path.join(root, constants.TEMP_DIR_NAME)), uuid.uuid4().hex)
+
+
+@contextlib.contextmanager
+def temporary_workspace():
+    """
+    A contextmanager for working with a temporary workspace.
+    The workspace will be created before the body of the 'with'-statement
+    is executed and will be removed when the body is left.
+    It is never removed by the garbage collection while in use.
+    """
+    tp = get_workspace_path()
+    os.makedirs(tp)
+    active_workspaces.add(tp)
+    try:
+        yield tp
+    finally:
+        active_workspaces.discard(tp)
+        shutil.rmtree(tp)
+
+
+def get_zip_content_size(path):
+    """
+    Return the number of bytes the files of a zip take up when extracted.
+    :param path: path of the zip
+    :type path: str or unicode
+    :return: the number of bytes or None if the file is not a valid zip
+    :rtype: int or None
+    """
+    try:
+        with zipfile.ZipFile(path, "r", allowZip64=True) as zf:
+            return sum([info.file_size for info in zf.infolist()])
+    except (zipfile.BadZipfile, IOError):
+        return None
+
+
+def move_workspace(src, dest):
+    """
+    Move a workspace, which may be on another filesystem.
+    :param src: path of the workspace
+    :type src: str or unicode
+    :param dest: path to move the workspace to
+    :type dest: str or unicode
+    :return: dest
+    :rtype: str or unicode
+    """
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    shutil.move(src, dest)
+    return dest
+
+
+class WorkspaceAllocator(object):
+    """
+    Places workspaces in a directory backed by memory (e.g. a tmpfs) if they are small enough
+    and the memory budget allows it, so receiving and extracting the project files does not
+    compete with docker for the disk. Other workspaces are placed on disk.
+    Workspaces which turn out to be larger than expected are moved to disk using spill().
+    :param path: directory backed by memory or None to place all workspaces on disk
+    :type path: str or unicode or None
+    :param budget: bytes of memory all workspaces in memory may use together
+    :type budget: int
+    :param threshold: workspaces larger than this are always placed on disk
+    :type threshold: int
+    """
+    def __init__(self, path=None, budget=0, threshold=constants.RAM_WORKSPACE_THRESHOLD):
+        self.path = path
+        self.budget = budget
+        self.threshold = threshold
+        self.reserved = {}  # path of workspace in memory -> reserved bytes
+        self.used = 0
+        self.moving = set()  # paths workspaces are currently moved to
+
+    @property
+    def root(self):
+        """the directory containing the workspaces in memory or None."""
+        if self.path is None:
+            return None
+        return os.path.join(self.path, constants.TEMP_DIR_NAME)
+
+    def fits(self, size, current=0):
+        """
+        Check whether a workspace of the specified size can be placed in memory.
+        :param size: bytes the workspace needs or None if unknown
+        :type size: int or None
+        :param current: bytes already reserved for the workspace
+        :type current: int
+        :return: True if the workspace fits
+        :rtype: bool
+        """
+        if self.path is None or size is None or size > self.threshold:
+            return False
+        if self.used - current + size > self.budget:
+            return False
+        try:
+            st = os.statvfs(self.path)
+        except OSError:
+            return False
+        # the filesystem may be shared with other programs
+        return st.f_bavail * st.f_frsize >= size - current
+
+    def allocate(self, size=None):
+        """
+        Create a workspace.
+        :param size: bytes the workspace needs or None if unknown
+        :type size: int or None
+        :return: path of the created workspace
+        :rtype: str
+        """
+        if self.fits(size):
+            path = get_workspace_path(self.path)
+            os.makedirs(path)
+            self.reserved[path] = size
+            self.used += size
+        else:
+            path = get_workspace_path()
+            os.makedirs(path)
+        return path
+
+    def in_memory(self, path):
+        """
+        Check whether a workspace is placed in memory.
+        :param path: path of the workspace
+        :type path: str or unicode
+        :return: True if the workspace is placed in memory
+        :rtype: bool
+        """
+        return path in self.reserved
+
+    def resize(self, path, size, force=False):
+        """
+        Change the bytes reserved for a workspace.
+        :param path: path of the workspace
+        :type path: str or unicode
+        :param size: bytes the workspace needs now or None if unknown
+        :type size: int or None
+        :param force: reserve the bytes even if this exceeds the budget (e.g. if the workspace can not be moved)
+        :type force: bool
+        :return: False if the workspace is placed in memory, but no longer fits
+        :rtype: bool
+        """
+        if path not in self.reserved:
+            return True
+        current = self.reserved[path]
+        if size is not None and size <= current:
+            return True
+        fits = self.fits(size, current=current)
+        if (fits or force) and size is not None:
+            self.reserved[path] = size
+            self.used += size - current
+        return fits
+
+    def release(self, path):
+        """
+        Release the memory reserved for a workspace.
+        The workspace itself must be removed by the caller.
+        :param path: path of the workspace
+        :type path: str or unicode
+        """
+        self.used -= self.reserved.pop(path, 0)
+
+    def spill(self, path):
+        """
+        Move a workspace to disk in a thread and release its memory.
+        :param path: path of the workspace
+        :type path: str or unicode
+        :return: a deferred which will fire with the new path of the workspace
+        :rtype: Deferred
+        """
+        dest = get_workspace_path()
+        self.moving.add(dest)
+        d = threads.deferToThread(move_workspace, path, dest)
+        d.addBoth(self._spilled, path, dest)
+        return d
+
+    def _spilled(self, result, path, dest):
+        """
+        Called when moving a workspace to disk is done.
+        :param result: the new path of the workspace or the error
+        :type result: str or Failure
+        :param path: the previous path of the workspace
+        :type path: str or unicode
+        :param dest: the new path of the workspace
+        :type dest: str
+        :return: result
+        :rtype: str or Failure
+        """
+        self.moving.discard(dest)
+        if not isinstance(result, failure.Failure):
+            self.release(path)
+        return result
+
+    def get_status(self):
+        """
+        Return a dict describing the usage of the memory.
+        :return: the status
+        :rtype: dict
+        """
+        return {
+            "path": self.path,
+            "budget": self.budget,
+            "threshold": self.threshold,
+            "used": self.used,
+            "workspaces": len(self.reserved),
+            }
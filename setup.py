@@ -30,6 +30,9 @@ setup(
     entry_points={
         "console_scripts": [
             "fbad-server=fbad.runner:server_main",
+            "fbad-broker=fbad.runner:broker_main",
+            "fbad-daemon=fbad.runner:daemon_main",
+            "fbad-trace=fbad.runner:trace_main",
         ],
     }
 )
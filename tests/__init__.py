@@ -0,0 +1 @@
+"""tests for fbad."""
@@ -0,0 +1,38 @@
+"""tests for fbad.distribution."""
+import hashlib
+
+from twisted.trial import unittest
+
+from fbad.distribution import get_chain_ids, get_missing_layers
+
+
+class ChainIdTests(unittest.TestCase):
+    """tests for get_chain_ids()."""
+
+    def test_empty(self):
+        """an image without layers has no chain ids."""
+        self.assertEqual(get_chain_ids([]), [])
+
+    def test_chain(self):
+        """the chain id of the lowest layer is its diff id, the others include the layers below."""
+        diff_ids = ["sha256:aaa", "sha256:bbb", "sha256:ccc"]
+        second = "sha256:" + hashlib.sha256("sha256:aaa sha256:bbb").hexdigest()
+        third = "sha256:" + hashlib.sha256(second + " sha256:ccc").hexdigest()
+        self.assertEqual(get_chain_ids(diff_ids), ["sha256:aaa", second, third])
+
+    def test_depends_on_lower_layers(self):
+        """the same layer on top of different layers has different chain ids."""
+        a = get_chain_ids(["sha256:aaa", "sha256:ccc"])
+        b = get_chain_ids(["sha256:bbb", "sha256:ccc"])
+        self.assertNotEqual(a[-1], b[-1])
+
+
+class MissingLayerTests(unittest.TestCase):
+    """tests for get_missing_layers()."""
+
+    def test_missing(self):
+        """only layers whose chain id is not present are required."""
+        layers = [("l1/layer.tar", "sha256:1"), ("l2/layer.tar", "sha256:2"), ("l3/layer.tar", "sha256:3")]
+        self.assertEqual(get_missing_layers(layers, set()), set(["l1/layer.tar", "l2/layer.tar", "l3/layer.tar"]))
+        self.assertEqual(get_missing_layers(layers, set(["sha256:1", "sha256:2"])), set(["l3/layer.tar"]))
+        self.assertEqual(get_missing_layers(layers, set(["sha256:1", "sha256:2", "sha256:3"])), set())
@@ -0,0 +1,42 @@
+"""tests for fbad.image."""
+from twisted.trial import unittest
+
+from fbad.image import Image
+
+
+class VariantTests(unittest.TestCase):
+    """tests for Image.get_variants()."""
+
+    def test_no_matrix(self):
+        """an image without a matrix is its only variant."""
+        image = Image("app")
+        self.assertEqual(image.get_variants(), [image])
+
+    def test_placeholders(self):
+        """build args of the matrix are substituted into name and tag."""
+        image = Image("app", name="app-py{PYTHON}", tag="app:py{PYTHON}-{arch}", matrix={"PYTHON": ["2.7", "3.8"]})
+        variants = image.get_variants()
+        self.assertEqual([v.name for v in variants], ["app-py2.7", "app-py3.8"])
+        # buildserver-specific placeholders are left to format_tag()
+        self.assertEqual([v.tag for v in variants], ["app:py{PYTHON}-{arch}"] * 2)
+        self.assertEqual([v.build_args for v in variants], [{"PYTHON": "2.7"}, {"PYTHON": "3.8"}])
+        self.assertEqual([v.variant_of for v in variants], ["app-py{PYTHON}"] * 2)
+
+    def test_append_values(self):
+        """values are appended to name and tag if they do not contain them as placeholders."""
+        image = Image("app", build_args={"BASE": "alpine"}, matrix={"PYTHON": [2, 3], "DEBUG": [0, 1]})
+        variants = image.get_variants()
+        # keys are combined in sorted order
+        self.assertEqual([v.name for v in variants], ["app-0-2", "app-0-3", "app-1-2", "app-1-3"])
+        self.assertEqual([v.tag for v in variants], ["app-0-2", "app-0-3", "app-1-2", "app-1-3"])
+        self.assertEqual(variants[0].build_args, {"BASE": "alpine", "DEBUG": "0", "PYTHON": "2"})
+
+    def test_unknown_placeholder(self):
+        """the name may not contain placeholders which are not build args."""
+        image = Image("app", name="app-{arch}", matrix={"PYTHON": ["2.7"]})
+        self.assertRaises(ValueError, image.get_variants)
+
+    def test_build_arg_placeholder(self):
+        """the name may contain build args which are not in the matrix."""
+        image = Image("app", name="{BASE}-app", build_args={"BASE": "alpine"}, matrix={"PYTHON": ["2.7"]})
+        self.assertEqual([v.name for v in image.get_variants()], ["alpine-app-2.7"])
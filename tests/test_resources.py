@@ -0,0 +1,95 @@
+"""tests for fbad.resources."""
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from fbad.resources import ResourcePool
+
+
+GB = 1024 ** 3
+
+
+class ResourcePoolTests(unittest.TestCase):
+    """tests for ResourcePool."""
+
+    def test_grant_in_order(self):
+        """requests which fit are granted immediately and in order."""
+        pool = ResourcePool(4, 8 * GB)
+        granted = []
+        pool.acquire(2, GB).addCallback(lambda r: granted.append(1))
+        pool.acquire(2, GB).addCallback(lambda r: granted.append(2))
+        d = pool.acquire(1, GB)
+        d.addCallback(lambda r: granted.append(3))
+        self.assertEqual(granted, [1, 2])
+        self.assertEqual(pool.get_status()["running"], 2)
+        self.assertEqual(pool.get_status()["waiting"], 1)
+        pool.release((2.0, GB))
+        self.assertEqual(granted, [1, 2, 3])
+        self.assertEqual(pool.get_status()["waiting"], 0)
+
+    def test_later_request_may_pass(self):
+        """a later request which fits is granted before an earlier one which does not fit yet."""
+        pool = ResourcePool(4, 8 * GB, max_bypass=2)
+        granted = []
+        pool.acquire(3, GB)
+        pool.acquire(2, GB).addCallback(lambda r: granted.append("big"))
+        pool.acquire(1, GB).addCallback(lambda r: granted.append("small"))
+        self.assertEqual(granted, ["small"])
+
+    def test_max_bypass(self):
+        """a waiting request is not passed more than max_bypass times."""
+        pool = ResourcePool(4, 8 * GB, max_bypass=1)
+        granted = []
+        pool.acquire(3, GB)
+        pool.acquire(2, GB).addCallback(lambda r: granted.append("big"))
+        pool.acquire(0.5, GB).addCallback(lambda r: granted.append("small 1"))
+        pool.acquire(0.5, GB).addCallback(lambda r: granted.append("small 2"))
+        # the second small request would fit as well, but the big one was passed once already
+        self.assertEqual(granted, ["small 1"])
+        pool.release((3.0, GB))
+        self.assertEqual(granted, ["small 1", "big", "small 2"])
+
+    def test_clamp(self):
+        """requests exceeding the capacity are limited to it and run alone."""
+        pool = ResourcePool(4, 8 * GB)
+        self.assertEqual(pool.clamp(16, 32 * GB), (4.0, 8 * GB))
+        self.assertEqual(pool.clamp(1, GB), (1.0, GB))
+        results = []
+        pool.acquire(16, 32 * GB).addCallback(results.append)
+        self.assertEqual(results, [(4.0, 8 * GB)])
+        d = pool.acquire(1, GB)
+        d.addCallback(results.append)
+        self.assertEqual(len(results), 1)
+        pool.release(results[0])
+        self.assertEqual(results[1], (1.0, GB))
+
+    def test_clamp_without_memory_limit(self):
+        """memory is not accounted if the pool has no memory limit."""
+        pool = ResourcePool(2)
+        self.assertEqual(pool.clamp(1, 64 * GB), (1.0, 0))
+
+    def test_cancel(self):
+        """cancelling a waiting request removes it and lets the next one be granted."""
+        pool = ResourcePool(4, 8 * GB, max_bypass=0)
+        granted = []
+        pool.acquire(4, GB)
+        d = pool.acquire(2, GB)
+        pool.acquire(1, GB).addCallback(lambda r: granted.append("small"))
+        # max_bypass=0, so the small request waits behind the cancelled one
+        self.assertEqual(granted, [])
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(pool.get_status()["waiting"], 1)
+        pool.release((4.0, GB))
+        self.assertEqual(granted, ["small"])
+
+    def test_run_releases(self):
+        """run() releases the resources when the function failed."""
+        pool = ResourcePool(1)
+
+        def fail():
+            raise ValueError("build failed")
+
+        d = pool.run(1, 0, fail)
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(pool.get_status()["used_cpus"], 0.0)
+        self.assertEqual(pool.get_status()["running"], 0)
@@ -0,0 +1,36 @@
+"""tests for fbad.utils."""
+from twisted.trial import unittest
+
+from fbad.utils import parse_size
+
+
+class ParseSizeTests(unittest.TestCase):
+    """tests for parse_size()."""
+
+    def test_plain(self):
+        """sizes without a suffix are bytes."""
+        self.assertEqual(parse_size("512"), 512)
+        self.assertEqual(parse_size(" 512 "), 512)
+
+    def test_suffixes(self):
+        """K, M, G and T are powers of 1024."""
+        self.assertEqual(parse_size("2K"), 2 * 1024)
+        self.assertEqual(parse_size("512M"), 512 * 1024 ** 2)
+        self.assertEqual(parse_size("10G"), 10 * 1024 ** 3)
+        self.assertEqual(parse_size("1T"), 1024 ** 4)
+
+    def test_suffix_variants(self):
+        """suffixes are case insensitive and may be followed by 'iB' or 'B'."""
+        self.assertEqual(parse_size("4g"), 4 * 1024 ** 3)
+        self.assertEqual(parse_size("4GiB"), 4 * 1024 ** 3)
+        self.assertEqual(parse_size("4GB"), 4 * 1024 ** 3)
+        self.assertEqual(parse_size("4 G"), 4 * 1024 ** 3)
+
+    def test_fraction(self):
+        """sizes may be fractional."""
+        self.assertEqual(parse_size("1.5G"), int(1.5 * 1024 ** 3))
+
+    def test_invalid(self):
+        """invalid sizes raise a ValueError."""
+        for s in ("", "G", "-1G", "10X", "ten"):
+            self.assertRaises(ValueError, parse_size, s)